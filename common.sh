@@ -60,6 +60,12 @@ VALUE_RPMTRACKEDFILES=$PREUPGRADE_CACHE/rpmtrackedfiles.log
 #
 VALUE_RPM_RHSIGNED=$PREUPGRADE_CACHE/rpm_rhsigned.log
 
+#
+# Full path to directory with index of installed packages, it contains
+# a file per package name with 'signed key_id vendor' separated by tabs
+#
+VALUE_RPM_INDEX=$PREUPGRADE_CACHE/rpm_index
+
 #
 # Full path to log file with all local files
 #
@@ -424,10 +430,38 @@ is_pkg_installed() {
     # Parameter is a package name which will be checked.
     # Return: 0 - package is installed
     #         1 - package is NOT installed
+    if [ -d "$VALUE_RPM_INDEX" ]; then
+        # package names never contain '/', the name must not lead out of the index
+        case "$1" in
+            ""|*/*) return 1 ;;
+        esac
+        [ -f "$VALUE_RPM_INDEX/$1" ] || return 1
+        return 0
+    fi
     grep -q "^$1[[:space:]]" $VALUE_RPM_QA || return 1
     return 0
 }
 
+_is_pkg_signed() {
+    #
+    # Function checks if installed package is signed by Red Hat.
+    #
+    # Return: 0 - package is signed
+    #         1 - package is NOT signed or NOT installed
+    local signed
+    if [ -d "$VALUE_RPM_INDEX" ]; then
+        case "$1" in
+            ""|*/*) return 1 ;;
+        esac
+        [ -f "$VALUE_RPM_INDEX/$1" ] || return 1
+        read -r signed < "$VALUE_RPM_INDEX/$1"
+        [ "${signed%%[[:space:]]*}" == "1" ] || return 1
+        return 0
+    fi
+    grep "^$1[[:space:]]" $VALUE_RPM_RHSIGNED > /dev/null || return 1
+    return 0
+}
+
 check_rpm_to() {
     #
     # Function checks if relevant package is installed and if relevant binary exists on the system.
@@ -452,7 +486,7 @@ check_rpm_to() {
         RPM_NAME=$(echo "$RPM_NAME" | tr "," " ")
         for pkg in $RPM_NAME
         do
-            grep "^$pkg[[:space:]]" $VALUE_RPM_QA > /dev/null
+            is_pkg_installed "$pkg"
             if [ $? -ne 0 ]; then
                 log_high_risk "Package $pkg is not installed."
                 NOT_APPLICABLE=1
@@ -503,6 +537,48 @@ service_is_enabled() {
     return 1
 }
 
+# index of changed config files (path -> verify flags) read from
+# VALUE_CONFIGCHANGED by _load_changed_configs when it is needed first
+declare -A _CHANGED_CONFIGS
+_CHANGED_CONFIGS_LOADED=0
+
+_load_changed_configs() {
+    local line
+    [ $_CHANGED_CONFIGS_LOADED -eq 1 ] && return 0
+    _CHANGED_CONFIGS_LOADED=1
+    [ -f "$VALUE_CONFIGCHANGED" ] || return 0
+    # e.g. 'S.5....T.  c /etc/foo.conf'
+    while IFS= read -r line; do
+        [[ "$line" == *" /"* ]] || continue
+        _CHANGED_CONFIGS["/${line#* /}"]="${line%%[[:space:]]*}"
+    done < "$VALUE_CONFIGCHANGED"
+    return 0
+}
+
+config_file_changed() {
+    #
+    # Function checks if config file has been changed (is listed
+    # in VALUE_CONFIGCHANGED).
+    #
+    # Return: 0 - config file has been changed
+    #         1 - config file hasn't been changed
+    _load_changed_configs
+    [ -n "$1" ] && [ -n "${_CHANGED_CONFIGS["$1"]+x}" ] || return 1
+    return 0
+}
+
+get_config_file_flags() {
+    #
+    # Function prints verify flags of changed config file
+    # (e.g. S.5....T. or missing).
+    #
+    # Return: 0 - config file has been changed
+    #         1 - config file hasn't been changed
+    config_file_changed "$1" || return 1
+    echo "${_CHANGED_CONFIGS["$1"]}"
+    return 0
+}
+
 backup_config_file() {
     #
     # backup the config file
@@ -519,7 +595,7 @@ backup_config_file() {
     fi
 
     # config file is changed?
-    grep -qe " ${CONFIG_FILE}" ${VALUE_CONFIGCHANGED} || return 2
+    config_file_changed "$CONFIG_FILE" || return 2
 
     mkdir -p "${VALUE_TMP_PREUPGRADE}/$(dirname "$CONFIG_FILE")"
     cp -f "${CONFIG_FILE}" "${VALUE_TMP_PREUPGRADE}${CONFIG_FILE}"
@@ -592,13 +668,13 @@ is_dist_native() {
     fi
     local pkg=$1
 
-    grep "^$pkg[[:space:]]" $VALUE_RPM_QA > /dev/null
+    is_pkg_installed "$pkg"
     if [ $? -ne 0 ]; then
         log_warning "Package $pkg is not installed on Red Hat Enterprise Linux system."
         return 1
     fi
     if [ x"$DEVEL_MODE" == "x0" ]; then
-        grep "^$pkg[[:space:]]" $VALUE_RPM_RHSIGNED > /dev/null
+        _is_pkg_signed "$pkg"
         if [ $? -eq 0 ]; then
             return 0
         else
@@ -610,7 +686,7 @@ is_dist_native() {
                 return 0
                 ;;
             "sign")
-                grep "^$pkg[[:space:]]" $VALUE_RPM_RHSIGNED > /dev/null
+                _is_pkg_signed "$pkg"
                 if [ $? -eq 0 ]; then
                     return 0
                 else
@@ -637,7 +713,8 @@ get_dist_native_list() {
     local pkg
     local line
     while read line; do
-        pkg=$(echo "$line" | grep -Eom1 '^[^[:space:]]+')
+        pkg=${line%%[[:space:]]*}
+        [ -n "$pkg" ] || continue
         is_dist_native "$pkg" >/dev/null && echo "$pkg"
     done < "$VALUE_RPM_QA"
 }
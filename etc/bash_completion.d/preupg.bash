@@ -14,7 +14,7 @@ _preupg() {
     cur="${COMP_WORDS[COMP_CWORD]}"
     prev="${COMP_WORDS[COMP_CWORD-1]}"
     opts="-s --scan -v --verbose -d --debug --skip-common -u --upload -r --results --list-contents-set -c --contents
-     -a --apply --riskcheck --force --text -m --mode --cleanup --select-rules --list-rules"
+     -a --apply --riskcheck --force --text -m --mode --cleanup --select-rules --list-rules -j --jobs --compression"
 
     #echo "SS${COMP_CWORD} and ${COMP_WORDS} and ${prev} and ${cur}SS"
     if [[ ${COMP_CWORD} == 1 && ${COMP_WORDS} == "preupg" ]]; then
@@ -45,7 +45,7 @@ _preupg() {
         prev="${COMP_WORDS[COMP_CWORD-2]}"
         case "${prev}" in
             "-s"|"--scan")
-            opts="-v --verbose -d --debug --skip-common --riskcheck --force --text"
+            opts="-v --verbose -d --debug --skip-common --riskcheck --force --text -j --jobs --compression"
             comps="$opts"
             ;;
             "-u"|"--upload")
@@ -134,7 +134,7 @@ install -p man/preupg-diff.1 $RPM_BUILD_ROOT%{_mandir}/man1/
 
 %if %{build_ui}
 ######### UI packaging #######################################
-mkdir -m 644 -p ${RPM_BUILD_ROOT}%{_sharedstatedir}/preupgrade/{results,upload,static}
+mkdir -m 644 -p ${RPM_BUILD_ROOT}%{_sharedstatedir}/preupgrade/{results,upload,static,queue,cache}
 touch ${RPM_BUILD_ROOT}%{_sharedstatedir}/preupgrade/{db.sqlite,secret_key}
 
 sed -r \
@@ -146,6 +146,12 @@ sed \
     -e 's;STATIC_PATH;%{_sharedstatedir}/preupgrade/static;g' \
     -i ${RPM_BUILD_ROOT}%{_sysconfdir}/httpd/conf.d/99-preup-httpd.conf.{private,public}
 
+%if 0%{?_unitdir:1}
+# worker importing submitted reports
+install -D -p -m 644 packaging/preupgrade-assistant-ui-import.service \
+    ${RPM_BUILD_ROOT}%{_unitdir}/preupgrade-assistant-ui-import.service
+%endif
+
 # install django
 pushd Django-%{django_version}
 %{__python} setup.py install --skip-build --root ${RPM_BUILD_ROOT}
@@ -210,6 +216,8 @@ rm -rf $RPM_BUILD_ROOT
 %post ui
 # populate DB and/or apply DB migrations
 su apache - -s /bin/bash -c "preupg-ui-manage syncdb --migrate --noinput" >/dev/null || :
+# index results imported before the search index existed
+su apache - -s /bin/bash -c "preupg-ui-manage index_results" >/dev/null || :
 # collect static files
 su apache - -s /bin/bash -c "preupg-ui-manage collectstatic --noinput" >/dev/null || :
 if [ "$1" == 1 ]; then
@@ -219,6 +227,18 @@ if [ "$1" == 1 ]; then
 fi
 # restart apache
 service httpd condrestart
+%if 0%{?_unitdir:1}
+systemctl daemon-reload >/dev/null 2>&1 || :
+systemctl try-restart preupgrade-assistant-ui-import.service >/dev/null 2>&1 || :
+%endif
+
+%preun ui
+%if 0%{?_unitdir:1}
+if [ "$1" == 0 ]; then
+    systemctl --no-reload disable preupgrade-assistant-ui-import.service >/dev/null 2>&1 || :
+    systemctl stop preupgrade-assistant-ui-import.service >/dev/null 2>&1 || :
+fi
+%endif
 
 %postun ui
 # $1 holds the number of preupgrade-assistant-ui
@@ -265,6 +285,9 @@ fi
 %ghost %config(noreplace) %{_sharedstatedir}/preupgrade/db.sqlite
 %ghost %config(noreplace) %{_sharedstatedir}/preupgrade/secret_key
 %doc %{_docdir}/%{name}/README.ui
+%if 0%{?_unitdir:1}
+%{_unitdir}/preupgrade-assistant-ui-import.service
+%endif
 %endif # build_ui
 
 %files tools
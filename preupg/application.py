@@ -21,11 +21,11 @@ except ImportError:
 from preupg import xml_manager, settings, exception
 from preupg.common import Common
 from preupg.settings import ReturnValues
-from preupg.scanning import ScanProgress, ScanningHelper
+from preupg.scanning import ScanProgress, ScanningHelper, ParallelScan
 from preupg.utils import (FileHelper, ProcessHelper, DirHelper, OpenSCAPHelper,
                           MessageHelper, TarballHelper, SystemIdentification,
                           PostupgradeHelper, ConfigHelper, ConfigFilesHelper,
-                          ModuleSetUtils)
+                          ModuleSetUtils, sha1)
 from preupg.xccdf import XccdfHelper
 from preupg.logger import log_message, LoggerHelper, logger, logger_report
 from preupg.logger import logger_debug
@@ -207,15 +207,15 @@ class Application(object):
             log_message("Can't determine what tarball to upload to the UI.",
                         level=logging.ERROR)
             return False
-        file_content = FileHelper.get_file_content(tarball_results, 'rb',
-                                                   False, False)
-
-        binary = xmlrpclib.Binary(file_content)
         host = socket.gethostname()
-        response = proxy.submit.submit_new({
-            'data': binary,
-            'host': host,
-        })
+        response = self.upload_in_chunks(proxy, tarball_results, host)
+        if response is None:
+            file_content = FileHelper.get_file_content(tarball_results, 'rb',
+                                                       False, False)
+            response = proxy.submit.submit_new({
+                'data': xmlrpclib.Binary(file_content),
+                'host': host,
+            })
         try:
             status = response['status']
         except KeyError:
@@ -242,6 +242,70 @@ class Application(object):
                 return False
         return True
 
+    @staticmethod
+    def upload_in_chunks(proxy, tarball, host):
+        """
+        Upload tarball in chunks of settings.upload_chunk_size through
+        submit.begin, submit.chunk and submit.commit. Interrupted chunks
+        are resumed from the offset known to the server, failed calls are
+        retried after settings.upload_retry_delay seconds doubled by every
+        failure. Sizes and offsets are sent as strings, XML-RPC integers
+        have just 32 bits.
+        Return the response of submit.commit or None when the UI does not
+        support chunked upload.
+        """
+        import xmlrpclib
+        import socket
+        import time
+        hasher = sha1()
+        with open(tarball, 'rb') as tarball_file:
+            for block in iter(lambda: tarball_file.read(settings.upload_chunk_size), b''):
+                hasher.update(block)
+        size = os.path.getsize(tarball)
+        try:
+            response = proxy.submit.begin({'host': host,
+                                           'size': str(size),
+                                           'checksum': hasher.hexdigest()})
+        except Fault:
+            return None
+        if response.get('status') != 'OK':
+            return response
+        upload_id = response['upload_id']
+        offset = int(response['offset'])
+        failures = 0
+        with open(tarball, 'rb') as tarball_file:
+            while True:
+                try:
+                    if offset is None:
+                        # ask the server where to continue
+                        response = proxy.submit.begin({'upload_id': upload_id})
+                        if response.get('status') != 'OK':
+                            return response
+                        offset = int(response['offset'])
+                    if offset >= size:
+                        return proxy.submit.commit(upload_id)
+                    tarball_file.seek(offset)
+                    data = tarball_file.read(settings.upload_chunk_size)
+                    response = proxy.submit.chunk(upload_id, str(offset),
+                                                  xmlrpclib.Binary(data),
+                                                  sha1(data).hexdigest())
+                    if response.get('status') != 'OK':
+                        failures += 1
+                        logger_debug.debug("Chunk at %d refused: %s", offset,
+                                           response.get('message'))
+                        if failures > settings.upload_retries or 'offset' not in response:
+                            return response
+                    else:
+                        failures = 0
+                    offset = int(response['offset'])
+                except (socket.error, xmlrpclib.ProtocolError) as ex:
+                    failures += 1
+                    if failures > settings.upload_retries:
+                        raise
+                    logger_debug.debug("Upload at %s failed: %s", offset, ex)
+                    time.sleep(settings.upload_retry_delay * 2 ** (failures - 1))
+                    offset = None
+
     def prepare_scan_directories(self):
         """Used for prepartion of directories used during scan functionality"""
         dirs = [self.conf.assessment_results_dir, settings.tarball_result_dir]
@@ -283,15 +347,10 @@ class Application(object):
         self.scanning_progress = ScanProgress(self.get_total_check(), self.conf.debug)
         self.scanning_progress.set_names(self.report_parser.get_name_of_checks())
         log_message('%s:' % settings.assessment_text, new_line=True)
-        log_message('%.3d/%.3d ...running (%s)' % (
-                    1,
-                    self.get_total_check(),
-                    self.scanning_progress.get_full_name(0)),
-                    new_line=False
-                    )
         start_time = datetime.datetime.now()
-        self.scanning_progress.time = start_time
-        self.run_scan(function=self.scanning_progress.show_progress)
+        self.scanning_progress.start()
+        self.run_scan(function=self.scanning_progress.show_progress,
+                      running=self.scanning_progress.set_running)
         end_time = datetime.datetime.now()
         diff = end_time - start_time
         log_message(
@@ -299,11 +358,15 @@ class Application(object):
                                                            diff.seconds % 60)
         )
 
-    def run_scan(self, function=None):
+    def run_scan(self, function=None, running=None):
         """
         The function is used for either scanning system or
         for applying changes on the target system
         """
+        if self.conf.jobs > 1 and self.report_parser is not None:
+            scan = ParallelScan(self.openscap_helper, self.report_parser,
+                                self.conf.jobs)
+            return scan.run(function=function, running=running)
         cmd = self.openscap_helper.build_command()
         logger_debug.debug('running_command: %s', cmd)
         return ProcessHelper.run_subprocess(cmd, print_output=False, function=function)
@@ -342,15 +405,16 @@ class Application(object):
         """The function prepares a XML file for HTML creation"""
         # Reload XML file
         self.report_parser.reload_xml(self.openscap_helper.get_default_xml_result_path())
-        # strip whitespaces on start and end of stdout/stderr from modules
-        # inside the result.xml file
-        self.report_parser.strip_whitespaces()
-        # Replace fail in case of slight and medium risks with needs_inspection
-        self.report_parser.replace_inplace_risk(scanning_results=self.scanning_progress)
-        if not self.conf.debug:
-            self.report_parser.remove_debug_info()
-        self.report_parser.reload_xml(self.openscap_helper.get_default_xml_result_path())
-        self.report_parser.update_check_description()
+        # all changes are done in memory, the file is written once at the end
+        with self.report_parser.deferred_write():
+            # strip whitespaces on start and end of stdout/stderr from modules
+            # inside the result.xml file
+            self.report_parser.strip_whitespaces()
+            # Replace fail in case of slight and medium risks with needs_inspection
+            self.report_parser.replace_inplace_risk(scanning_results=self.scanning_progress)
+            if not self.conf.debug:
+                self.report_parser.remove_debug_info()
+            self.report_parser.update_check_description()
         xml_report = self.openscap_helper.get_default_xml_result_path()
         if self.old_report_style:
             ReportParser.write_xccdf_version(xml_report, direction=True)
@@ -419,7 +483,9 @@ class Application(object):
 
         # Generate final XCCDF compose under self.module_set_copy_path
         xccdf_compose = XCCDFCompose(
-            self.module_set_path, self.module_set_copy_path)
+            self.module_set_path, self.module_set_copy_path,
+            cache_dir=os.path.join(self.conf.cache_dir,
+                                   settings.compose_cache_dir))
         ret_val = xccdf_compose.generate_xml()
         if ret_val != 0:
             return ret_val
@@ -517,7 +583,11 @@ class Application(object):
         # It prints out result in table format
         ScanningHelper.format_rules_to_table(main_report, "main contents")
 
-        self.tar_ball_name = TarballHelper.tarball_result_dir(self.conf.tarball_name, self.conf.verbose)
+        self.tar_ball_name = TarballHelper.tarball_result_dir(
+            self.conf.tarball_name, self.conf.verbose,
+            compression=self.conf.tarball_compression,
+            level=self.conf.tarball_compress_level,
+            parallel=self.conf.jobs > 1)
         log_message("The tarball with results is stored in '%s' ." % self.tar_ball_name)
         log_message("The latest assessment is stored in the '%s' directory." % self.conf.assessment_results_dir)
         # pack all configuration files to tarball
@@ -191,11 +191,38 @@ class CLI(object):
             action="store_true",
             help="Generate report with simpler style than the default."
         )
+        self.parser.add_option(
+            "-j", "--jobs",
+            metavar="N",
+            type="int",
+            help="Run up to N modules at the same time. The selected modules"
+                 " are split into several parts which are assessed by"
+                 " separate OpenSCAP processes and their results are merged"
+                 " into one report. Modules of one group are run in one"
+                 " part, modules of other groups must not depend on their"
+                 " side effects (files in $VALUE_TMP_PREUPGRADE, kickstart"
+                 " or postupgrade.d files). Modules are run one by one by"
+                 " default."
+        )
+        self.parser.add_option(
+            "--compression",
+            dest="tarball_compression",
+            metavar="METHOD",
+            choices=['gzip', 'xz', 'zstd'],
+            help="Compress the tarball with results by gzip (default), xz or"
+                 " zstd. gzip is used when the selected compressor is not"
+                 " installed. Only gzip tarballs can be uploaded to the"
+                 " Web UI. The compression runs on all cores when --jobs"
+                 " is used."
+        )
 
     def resolve_option_dependencies(self):
         if self.opts.scan and self.opts.contents:
             raise OptionValueError("Use either --scan or --contents option,"
                                    " not both.")
+        if self.opts.jobs is not None and self.opts.jobs < 1:
+            raise OptionValueError("Number of jobs has to be a positive"
+                                   " integer.")
 
 
 if __name__ == '__main__':
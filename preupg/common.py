@@ -8,17 +8,212 @@ from __future__ import unicode_literals
 import os
 import datetime
 import shutil
+import threading
+import json
+import heapq
+import hashlib
+import multiprocessing
+import stat
+import subprocess
 from distutils import dir_util
-from preupg.utils import FileHelper, DirHelper, ProcessHelper
-from preupg.utils import SystemIdentification
-from preupg.logger import log_message
+from preupg.utils import FileHelper, DirHelper, ProcessHelper, ParallelHelper
+from preupg.utils import sha1
+from preupg.utils import SystemIdentification, RpmIndex
+from preupg.logger import log_message, logger_debug
 from preupg import settings
 
 
+# command in scripts.txt which generates the log by the filesystem inventory
+INVENTORY_COMMAND = "@inventory"
+# command in scripts.txt which generates the 'rpm -Va' log by RpmVerifier
+RPM_VERIFY_COMMAND = "@rpmverify"
+
+
+def _is_executable_file(dummy_path, file_stat):
+    return stat.S_ISREG(file_stat.st_mode) and file_stat.st_mode & 0o111
+
+
+class RpmVerifier(object):
+
+    """
+    Generates output of 'rpm -Va' in parallel and incrementally.
+
+    File digests are checked here with a cache of digests keyed by
+    (size, mtime, inode) of the files, so only modified files are hashed
+    again. Packages which digests match are verified by
+    'rpm -V --nofiledigest', the others (and the ones which can't be
+    checked here, e.g. prelinked binaries) by plain 'rpm -V', so the output
+    is the same as the output of 'rpm -Va'. Contiguous parts of the package
+    list are verified at the same time and the outputs are joined in the
+    order of the RPM database.
+    """
+
+    query_format = ("@%{NAME}-%{VERSION}-%{RELEASE}%|ARCH?{.%{ARCH}}|\t%{FILEDIGESTALGO}\n"
+                    "[%{FILESTATES}\t%{FILEFLAGS}\t%{FILEVERIFYFLAGS}\t%{FILEMODES}\t"
+                    "%{FILEDIGESTS}\t%{FILENAMES}\n]")
+
+    # PGPHASHALGO values used by FILEDIGESTALGO tag
+    digest_algos = {'(none)': 'md5', '1': 'md5', '2': 'sha1', '8': 'sha256',
+                    '9': 'sha384', '10': 'sha512'}
+
+    RPMFILE_STATE_NORMAL = '0'
+    RPMFILE_GHOST = 1 << 6
+    RPMVERIFY_FILEDIGEST = 1 << 0
+
+    def __init__(self, cache_path, jobs):
+        self.cache_path = cache_path
+        self.jobs = jobs
+        self.cache = {}
+        self.new_cache = {}
+        self.lock = threading.Lock()
+
+    def load_cache(self):
+        try:
+            self.cache = json.loads(FileHelper.get_file_content(self.cache_path, "rb"))
+        except (IOError, ValueError):
+            self.cache = {}
+
+    def save_cache(self):
+        FileHelper.write_to_file(self.cache_path, "wb", json.dumps(self.new_cache))
+
+    def get_packages(self):
+        """
+        Return list of (package, digest algorithm, files) in order of the RPM
+        database, files are (path, expected digest) of the files which
+        digest is verified by rpm
+        """
+        sp = subprocess.Popen([settings.rpm_binary, "-qa", "--qf", self.query_format],
+                              stdout=subprocess.PIPE)
+        packages = []
+        seen = set()
+        files = []
+        for line in sp.stdout:
+            line = line.rstrip(b"\n").decode(settings.defenc, "replace")
+            if line.startswith("@"):
+                package, algo = line[1:].split("\t", 1)
+                files = []
+                # 'rpm -V package' verifies all its installed instances
+                if package not in seen:
+                    seen.add(package)
+                    packages.append((package, self.digest_algos.get(algo), files))
+                continue
+            try:
+                state, flags, verify_flags, mode, digest, path = line.split("\t", 5)
+                if (state != self.RPMFILE_STATE_NORMAL
+                        or int(flags) & self.RPMFILE_GHOST
+                        or not int(verify_flags) & self.RPMVERIFY_FILEDIGEST
+                        or not stat.S_ISREG(int(mode) & 0o177777) or not digest):
+                    continue
+            except ValueError:
+                continue
+            files.append((path, digest))
+        sp.wait()
+        return packages
+
+    def get_digest(self, path, algo):
+        """Return digest of file (cached when its metadata did not change) or None"""
+        try:
+            file_stat = os.lstat(path)
+            if not stat.S_ISREG(file_stat.st_mode):
+                return None
+            key = [file_stat.st_size, file_stat.st_mtime, file_stat.st_ino, algo]
+            cached = self.cache.get(path)
+            if cached is not None and cached[:4] == key:
+                digest = cached[4]
+            else:
+                hasher = hashlib.new(algo)
+                with open(path, "rb") as file_obj:
+                    for block in iter(lambda: file_obj.read(1024 * 1024), b""):
+                        hasher.update(block)
+                digest = hasher.hexdigest()
+        except (IOError, OSError):
+            return None
+        self.lock.acquire()
+        try:
+            self.new_cache[path] = key + [digest]
+        finally:
+            self.lock.release()
+        return digest
+
+    def digests_match(self, algo, files):
+        if algo is None:
+            return False
+        # all the files are hashed, so the cache covers whole package
+        mismatches = [path for path, digest in files
+                      if self.get_digest(path, algo) != digest]
+        return not mismatches
+
+    def confirm_digests(self, algo, files, output):
+        """
+        Files not reported by plain 'rpm -V' have the digests expected by
+        rpm (rpm e.g. undoes prelink before the digest is computed), so
+        these digests are remembered for them
+        """
+        reported = set(line[line.find(" /") + 1:] for line in output.splitlines()
+                       if " /" in line)
+        self.lock.acquire()
+        try:
+            for path, digest in files:
+                if path not in reported and path in self.new_cache:
+                    self.new_cache[path][4] = digest
+        finally:
+            self.lock.release()
+
+    def verify_part(self, packages):
+        """Verify part of the packages, return output of rpm"""
+        # consecutive packages with the same verification are run together
+        groups = []
+        for package, algo, files in packages:
+            nodigest = self.digests_match(algo, files)
+            if not groups or groups[-1][0] != nodigest:
+                groups.append((nodigest, []))
+            groups[-1][1].append((package, algo, files))
+        output = []
+        for nodigest, group in groups:
+            cmd = [settings.rpm_binary, "-V"]
+            if nodigest:
+                cmd.append("--nofiledigest")
+            for package, dummy_algo, dummy_files in group:
+                cmd.append(package)
+            sp = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            group_output = sp.communicate()[0]
+            if not nodigest:
+                for dummy_package, algo, files in group:
+                    self.confirm_digests(algo, files,
+                                         group_output.decode(settings.defenc, "replace"))
+            output.append(group_output)
+        return b"".join(output)
+
+    def verify(self, log_file):
+        """Write output of 'rpm -Va' to log_file"""
+        self.load_cache()
+        packages = self.get_packages()
+        # more parts than jobs balance the load, parts are contiguous
+        # so their outputs are joined in order of the RPM database
+        parts_count = min(len(packages), self.jobs * 4) or 1
+        size = len(packages) // parts_count
+        rest = len(packages) % parts_count
+        parts = []
+        start = 0
+        for index in range(parts_count):
+            end = start + size + (1 if index < rest else 0)
+            parts.append(packages[start:end])
+            start = end
+        outputs = ParallelHelper.map_in_threads(self.verify_part, parts, self.jobs)
+        FileHelper.write_to_file(log_file, "wb", b"".join(outputs), False)
+        self.save_cache()
+
+
 class Common(object):
 
     """Class handles with common log files"""
 
+    # filters of the lists generated by the filesystem inventory
+    inventory_filters = {
+        'allmyfiles.log': lambda dummy_path, dummy_stat: True,
+        'executable.log': _is_executable_file,
+    }
+
     def __init__(self, conf):
         self.conf = conf
         self.cwd = ""
@@ -46,32 +241,324 @@ class Common(object):
         """Function switch back to self.cwd"""
         os.chdir(self.cwd)
 
+    def get_common_commands(self):
+        """
+        Function returns list of (cmd, log_file, name) tuples from
+        the common scripts definition file, comments are skipped
+        """
+        commands = []
+        for line in self.lines:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            cmd, log_file, dummy_bash_value, name, dummy_values = line.split("=", 4)
+            commands.append((cmd, log_file, name))
+        return commands
+
+    @staticmethod
+    def get_dependencies(commands):
+        """
+        Function returns dictionary which maps index of a command to indexes
+        of the commands it depends on. A command depends on another one
+        when it reads the log file generated by the other command.
+        """
+        dependencies = {}
+        for index, (cmd, dummy_log_file, dummy_name) in enumerate(commands):
+            dependencies[index] = [dep_index for dep_index, dep in enumerate(commands)
+                                   if dep_index != index and dep[1] in cmd]
+        return dependencies
+
+    def get_manifest_path(self):
+        return self.common_logfiles(settings.common_manifest)
+
+    def load_manifest(self):
+        """Function returns fingerprints of the cached common logs"""
+        try:
+            content = FileHelper.get_file_content(self.get_manifest_path(), "rb")
+            return json.loads(content)
+        except (IOError, ValueError):
+            return {}
+
+    def save_manifest(self, manifest):
+        FileHelper.write_to_file(self.get_manifest_path(), "wb",
+                                 json.dumps(manifest, indent=1, sort_keys=True))
+
+    @staticmethod
+    def _stat_fingerprint(hasher, file_name):
+        """Function adds state of the file to hasher, returns if it exists"""
+        try:
+            file_stat = os.lstat(file_name)
+        except OSError:
+            hasher.update(("%s missing\n" % file_name).encode(settings.defenc))
+            return False
+        hasher.update(("%s %o %d %d %d %d %d\n" % (
+            file_name, file_stat.st_mode, file_stat.st_uid, file_stat.st_gid,
+            file_stat.st_size, file_stat.st_mtime, file_stat.st_ino)).encode(settings.defenc))
+        return True
+
+    def get_input_fingerprint(self, source):
+        """
+        Function returns fingerprint of an input of a common log
+        or None when the state of the input can't be determined.
+        See settings.common_log_inputs for the known inputs.
+        """
+        hasher = sha1()
+        if source == "rpmdb":
+            rpm_db_dir = self.conf.rpm_db_dir
+            if not os.path.isdir(rpm_db_dir):
+                return None
+            found = False
+            for file_name in self.conf.rpm_db_files:
+                if Common._stat_fingerprint(hasher, os.path.join(rpm_db_dir, file_name)):
+                    found = True
+            if not found:
+                # other backend of the database (sqlite, ndb), its state is unknown
+                return None
+        elif source.startswith("files:"):
+            try:
+                files = open(self.common_logfiles(source.split(":", 1)[1]), "rb")
+            except IOError:
+                return None
+            try:
+                for file_name in files:
+                    Common._stat_fingerprint(hasher, file_name.rstrip(b"\n").decode(settings.defenc))
+            finally:
+                files.close()
+        else:
+            return None
+        return hasher.hexdigest()
+
+    def get_fingerprints(self, commands, dependencies, indexes=None, known=None):
+        """
+        Function returns list of fingerprints of the commands' logs
+        (of all of them or of those at indexes).
+        Fingerprint covers the command, its inputs and fingerprints of the
+        logs it reads, which may be given in known by index of the command.
+        None means the log has to be generated every time.
+        """
+        log_inputs = self.conf.common_log_inputs or {}
+        input_fingerprints = {}
+        fingerprints = dict(known or {})
+
+        def get_fingerprint(index):
+            if index in fingerprints:
+                return fingerprints[index]
+            fingerprints[index] = None
+            cmd, log_file, dummy_name = commands[index]
+            if log_file not in log_inputs:
+                return None
+            parts = [cmd]
+            for source in log_inputs[log_file]:
+                if source not in input_fingerprints:
+                    input_fingerprints[source] = self.get_input_fingerprint(source)
+                parts.append(input_fingerprints[source])
+            for dep_index in dependencies[index]:
+                parts.append(get_fingerprint(dep_index))
+            if None in parts:
+                return None
+            fingerprints[index] = sha1('\n'.join(parts).encode(settings.defenc)).hexdigest()
+            return fingerprints[index]
+
+        if indexes is None:
+            indexes = range(len(commands))
+        return [get_fingerprint(index) for index in indexes]
+
+    @staticmethod
+    def get_local_mounts():
+        """Function returns mount points of the local file systems"""
+        sp = subprocess.Popen(["df", "--local", "-P"],
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE)
+        stdout = sp.communicate()[0]
+        return [line.split()[-1] for line in stdout.splitlines()[1:]
+                if line.strip()]
+
+    @staticmethod
+    def walk_sorted(top):
+        """
+        Generator returns (path, stat) of top and everything below it
+        in byte order of the paths, like 'find top -xdev | LC_ALL=C sort'.
+
+        Siblings are sorted together with the subtrees of the directories
+        (keyed by 'name/'), so the output is sorted without collecting
+        all the paths first. Directories are walked with an explicit stack
+        like os.walk does, so deep trees don't hit the recursion limit.
+        """
+        try:
+            top_stat = os.lstat(top)
+        except OSError:
+            return
+        yield top, top_stat
+        device = top_stat.st_dev
+        # entries left to visit, the next one on the top of the stack
+        stack = Common._list_dir(top, top_stat, device)
+        stack.reverse()
+        while stack:
+            key, file_stat, subtree = stack.pop()
+            if subtree:
+                entries = Common._list_dir(key[:-1], file_stat, device)
+                entries.reverse()
+                stack.extend(entries)
+            else:
+                yield key, file_stat
+
+    @staticmethod
+    def _list_dir(dir_path, dir_stat, device):
+        """
+        Function returns sorted list of (key, stat, subtree) of entries of
+        the directory, subtree entries stand for content of subdirectories
+        """
+        if not stat.S_ISDIR(dir_stat.st_mode) or dir_stat.st_dev != device:
+            return []
+        try:
+            names = os.listdir(dir_path)
+        except OSError:
+            return []
+        prefix = dir_path.rstrip(b'/') + b'/'
+        keys = []
+        for name in names:
+            path = prefix + name
+            try:
+                file_stat = os.lstat(path)
+            except OSError:
+                continue
+            keys.append((path, file_stat, False))
+            if stat.S_ISDIR(file_stat.st_mode) and file_stat.st_dev == device:
+                keys.append((path + b'/', file_stat, True))
+        keys.sort(key=lambda x: x[0])
+        return keys
+
+    def create_inventory(self, log_files, mounts=None):
+        """
+        Function walks all local file systems once and writes sorted lists
+        of the files matching filters of the given log files
+        (see inventory_filters)
+        """
+        if mounts is None:
+            mounts = Common.get_local_mounts()
+        outputs = []
+        for log_file in log_files:
+            try:
+                file_filter = self.inventory_filters[log_file]
+            except KeyError:
+                log_message("Unknown inventory log '%s'" % log_file)
+                continue
+            outputs.append((open(self.common_logfiles(log_file), "wb"), file_filter))
+        try:
+            last_path = None
+            # the same path can be found on more mount points
+            # (e.g. mount point of /boot when walking /)
+            for path, file_stat in heapq.merge(*[Common.walk_sorted(x) for x in mounts]):
+                if path == last_path:
+                    continue
+                last_path = path
+                for output, file_filter in outputs:
+                    if file_filter(path, file_stat):
+                        output.write(path + b'\n')
+        finally:
+            for output, dummy_filter in outputs:
+                output.close()
+
+    def create_rpm_index(self):
+        """
+        Function writes index of the installed packages used by module
+        API functions like is_pkg_installed or is_dist_native
+        """
+        rpm_qa_path = self.common_logfiles(settings.rpm_qa_log)
+        if not os.path.exists(rpm_qa_path):
+            return
+        rpm_index = RpmIndex(rpm_qa_path,
+                             self.common_logfiles(settings.rpm_signed_log))
+        rpm_index.write_index_dir(self.common_logfiles(settings.rpm_index_dir))
+
+    def verify_packages(self, log_file):
+        """Function writes output of 'rpm -Va' to log_file (see RpmVerifier)"""
+        verifier = RpmVerifier(self.common_logfiles(settings.rpm_verify_cache),
+                               self.conf.rpm_verify_jobs or multiprocessing.cpu_count())
+        verifier.verify(log_file)
+
     def common_results(self):
-        """run common scripts"""
+        """
+        run common scripts
+
+        Independent scripts are run concurrently, the scripts reading logs
+        of other scripts are started once these logs are generated.
+        Logs which inputs did not change since the previous run
+        (e.g. RPM database is not changed) are reused.
+        """
         log_message("Gathering logs used by the Preupgrade Assistant:")
         self.switch_dir()
-        try:
-            max_length = max(max([len(x.split("=", 4)[3]) for x in self.lines]), len(settings.assessment_text))
-            # Log files which will not be updated
-            # when RPM database is not changed
-            for counter, line in enumerate(self.lines):
-                line = line.strip()
-                if line.startswith("#"):
-                    continue
-                cmd, log_file, dummy_bash_value, name, values = line.split("=", 4)
-                log_message("%s : %.2d/%d ...running" % (name.ljust(max_length),
-                                                         counter+1,
-                                                         len(self.lines)),
-                            new_line=False)
-                start_time = datetime.datetime.now()
-                common_file_path = self.common_logfiles(log_file)
+        commands = self.get_common_commands()
+        dependencies = self.get_dependencies(commands)
+        max_length = max(max([len(x[2]) for x in commands]), len(settings.assessment_text))
+        lock = threading.Lock()
+        finished = []
+        manifest = self.load_manifest()
+        inventory_lock = threading.Lock()
+        inventory_done = []
+        # the files: inputs need the logs of the previous run, so compute
+        # fingerprints before anything is regenerated
+        fingerprints = self.get_fingerprints(commands, dependencies)
+        # state of the inputs each log is generated from, taken right before
+        # the command runs, so changes made meanwhile are not taken as clean
+        new_fingerprints = {}
+
+        def report(name, msg):
+            lock.acquire()
+            try:
+                finished.append(name)
+                log_message("%s : %.2d/%d %s" % (name.ljust(max_length),
+                                                 len(finished),
+                                                 len(commands),
+                                                 msg))
+            finally:
+                lock.release()
+
+        def run_command(index):
+            cmd, log_file, name = commands[index]
+            common_file_path = self.common_logfiles(log_file)
+            if (fingerprints[index] is not None
+                    and manifest.get(log_file) == fingerprints[index]
+                    and os.path.exists(common_file_path)):
+                logger_debug.debug("Reusing cached common log '%s'", log_file)
+                report(name, "reused (not changed since the previous run)")
+                new_fingerprints[index] = fingerprints[index]
+                return
+            # logs of the dependencies are generated already
+            new_fingerprints[index] = self.get_fingerprints(
+                commands, dependencies, [index], new_fingerprints)[0]
+            start_time = datetime.datetime.now()
+            if cmd == INVENTORY_COMMAND:
+                # all the inventory logs are written by one walk
+                inventory_lock.acquire()
+                try:
+                    if not inventory_done:
+                        self.create_inventory([x[1] for x in commands
+                                               if x[0] == INVENTORY_COMMAND])
+                        inventory_done.append(True)
+                finally:
+                    inventory_lock.release()
+            elif cmd == RPM_VERIFY_COMMAND:
+                self.verify_packages(common_file_path)
+            else:
                 ProcessHelper.run_subprocess(cmd, output=common_file_path, shell=True)
-                end_time = datetime.datetime.now()
-                diff = end_time - start_time
-                log_message(" %sfinished (time %.2d:%.2ds)" % ('\b' * 8,
-                                                               diff.seconds / 60,
-                                                               diff.seconds % 60))
-                # os.chmod(common_file_path, 0640)
+            end_time = datetime.datetime.now()
+            diff = end_time - start_time
+            report(name, "finished (time %.2d:%.2ds)" % (diff.seconds / 60,
+                                                         diff.seconds % 60))
+            # os.chmod(common_file_path, 0640)
+
+        try:
+            ParallelHelper.map_in_threads(run_command, range(len(commands)),
+                                          self.conf.common_jobs or 1,
+                                          dependencies)
+            self.create_rpm_index()
+            # store the state of the inputs the logs were generated from
+            manifest = {}
+            for index, (dummy_cmd, log_file, dummy_name) in enumerate(commands):
+                if new_fingerprints.get(index) is not None:
+                    manifest[log_file] = new_fingerprints[index]
+            self.save_manifest(manifest)
             self.switch_back_dir()
         except IOError:
             return 0
@@ -2,6 +2,7 @@ from __future__ import print_function, unicode_literals
 import re
 import os
 import shutil
+from contextlib import contextmanager
 
 from preupg.utils import FileHelper
 from preupg.xccdf import XccdfHelper
@@ -60,10 +61,26 @@ class ReportParser(object):
         self.element_prefix = "{http://checklists.nist.gov/xccdf/1.2}"
         # ElementTree.fromstring can't parse safely unicode string
         content = FileHelper.get_file_content(report_path, 'rb', False, False)
+        self._rules = None
+        self._selects = None
         self.target_tree = ElementTree.fromstring(content)
         self.profile = "Profile"
         self.changed_results = {}
         self.output_data = []
+        # see deferred_write()
+        self.write_deferred = False
+        self.write_pending = False
+
+    @property
+    def target_tree(self):
+        return self._target_tree
+
+    @target_tree.setter
+    def target_tree(self, tree):
+        """Indexes of rules are built once per loaded tree"""
+        self._target_tree = tree
+        self._rules = None
+        self._selects = None
 
     def filter_children(self, tree, tag):
         return self.get_nodes(tree, tag, prefix='./')
@@ -112,8 +129,9 @@ class ReportParser(object):
         self.target_tree = ElementTree.fromstring(content.replace("\a", ""))
 
     def get_select_rules(self):
-        selected = self.filter_grandchildren(self.target_tree, self.profile, "select")
-        return selected
+        if self._selects is None:
+            self._selects = self.filter_grandchildren(self.target_tree, self.profile, "select")
+        return self._selects
 
     def get_allowed_selected_rules(self):
         selected = []
@@ -127,16 +145,22 @@ class ReportParser(object):
         return len(self.get_allowed_selected_rules())
 
     def _get_all_rules(self):
-        return self.get_nodes(self.target_tree, "Rule", prefix=".//")
+        if self._rules is None:
+            rules = self.get_nodes(self.target_tree, "Rule", prefix=".//")
+            self._rules = (rules, dict((x.get('id', ''), x) for x in rules))
+        return self._rules[0]
+
+    def get_rule(self, id_ref):
+        """Function returns Rule with id_ref or None"""
+        self._get_all_rules()
+        return self._rules[1].get(id_ref)
 
     def get_name_of_checks(self):
         """Function returns a names of rules"""
         list_names = {}
-        rule_nodes = self._get_all_rules()
         for select in self.get_allowed_selected_rules():
             id_ref = select.get('idref', '')
-            rule = [x for x in rule_nodes if x.get('id', '') == id_ref]
-            list_names[id_ref] = self.get_nodes_text(rule[0], "title")
+            list_names[id_ref] = self.get_nodes_text(self.get_rule(id_ref), "title")
         return list_names
 
     def get_all_result_rules(self):
@@ -151,12 +175,36 @@ class ReportParser(object):
         return results
 
     def write_xml(self):
-        """Function writes XML document to file"""
+        """
+        Function writes XML document to file
+
+        The tree in memory stays the same, it is not parsed again from
+        the written file. Inside of deferred_write() the document is
+        written just once at the end of the block.
+        """
+        if self.write_deferred:
+            self.write_pending = True
+            return
         self.target_tree.set('xmlns:xhtml', 'http://www.w3.org/1999/xhtml/')
         # we really must set encoding here! and suppress it in write_to_file
         data = ElementTree.tostring(self.target_tree, "utf-8")
         FileHelper.write_to_file(self.path, 'wb', data, False)
-        self.target_tree = ElementTree.parse(self.path).getroot()
+
+    @contextmanager
+    def deferred_write(self):
+        """
+        Run several modifications of the report and write it just once
+
+        Nothing is written when the block raises an exception.
+        """
+        self.write_deferred = True
+        try:
+            yield self
+        finally:
+            self.write_deferred = False
+        if self.write_pending:
+            self.write_pending = False
+            self.write_xml()
 
     def modify_result_path(self, result_dir, scenario, mode):
         """Function modifies result path in XML file"""
@@ -180,11 +228,7 @@ class ReportParser(object):
                 res.text = ReportHelper.get_needs_inspection()
             elif int(return_value)/2 == 2:
                 res.text = ReportHelper.get_needs_action()
-            for index, row in enumerate(scanning_progress.output_data):
-                if self.get_nodes_text(rule, "title") in row:
-                    scanning_progress.output_data[index] = "{0}:{1}".format(
-                        self.get_nodes_text(rule, "title"),
-                        res.text)
+            scanning_progress.set_result(rule.get("idref"), res.text)
 
     def replace_inplace_risk(self, scanning_results=None):
         """
@@ -217,7 +261,7 @@ class ReportParser(object):
                     changed, res.text = inplace_dict[inplace_num](rule)
                     logger_report.debug("Replace text '%s:%s'", changed, res.text)
                 if changed is not None:
-                    changed_fields.append(changed+":"+res.text)
+                    changed_fields.append((changed, res.text))
 
         if scanning_results:
             scanning_results.update_data(changed_fields)
@@ -313,6 +357,7 @@ class ReportParser(object):
 
         :return:
         """
+        list_rules = set(list_rules)
         for select in self.get_select_rules():
             idref = select.get('idref', None)
             logger_report.debug(select)
@@ -330,8 +375,13 @@ class ReportParser(object):
         :return: List of rules which does not exist
         """
         unknown_rules = []
+        idrefs = [i.get('idref') for i in self.get_select_rules()]
+        known_rules = set(idrefs)
         for select in list_rules:
-            found = [i for i in self.get_select_rules() if select in i.get('idref')]
+            if select in known_rules:
+                continue
+            # part of the rule name is accepted as well
+            found = [idref for idref in idrefs if select in idref]
             if not found:
                 unknown_rules.append(select)
         return unknown_rules
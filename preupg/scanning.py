@@ -1,9 +1,25 @@
 
 from __future__ import unicode_literals
 import datetime
+import fcntl
+import json
 import os
-import subprocess
-from preupg.logger import settings, logger_report, log_message, logging
+import shutil
+import signal
+import struct
+import sys
+import tempfile
+import termios
+import threading
+import time
+from preupg.logger import settings, logger_report, log_message
+from preupg.logger import logger_debug
+from preupg.utils import FileHelper, ProcessHelper, ParallelHelper
+from preupg.xccdf import XMLNS
+try:
+    from xml.etree import ElementTree
+except ImportError:
+    from elementtree import ElementTree
 
 
 class ScanningHelper(object):
@@ -21,49 +37,76 @@ class ScanningHelper(object):
                       'notapplicable': '08',
                       'notchecked': '09'}
         try:
-            dummy_title, dummy_rule_id, result = row.split(':')
-        except ValueError:
+            return test_cases[row.result]
+        except KeyError:
             return '99'
-        else:
-            try:
-                return test_cases[result]
-            except KeyError:
-                return '99'
 
     @staticmethod
     def format_rules_to_table(output_data, content):
-        """Function format output_data to table"""
+        """Function format output_data (list of RuleResult) to table"""
         if not output_data:
             # If output_data does not contain anything then do not print nothing
             return
-        max_title_length = max(x for x in [len(l.split(':')[0]) for l in output_data]) + 5
-        max_result_length = max(x for x in [len(l.split(':')[2]) for l in output_data]) + 2
+        max_title_length = max(len(x.title) for x in output_data) + 5
+        max_result_length = max(len(x.result) for x in output_data) + 2
         log_message(settings.result_text.format(content))
         message = '-' * (max_title_length + max_result_length + 4)
         log_message(message)
         for data in sorted(output_data, key=ScanningHelper.compare_data, reverse=True):
-            try:
-                title, dummy_rule_id, result = data.split(':')
-            except ValueError:
-                # data is not an information about processed test; let's log it as an error
-                log_message(data, level=logging.ERROR)
-            else:
-                log_message(u"|%s |%s|" % (title.ljust(max_title_length),
-                                          result.strip().ljust(max_result_length)))
+            log_message(u"|%s |%s|" % (data.title.ljust(max_title_length),
+                                      data.result.strip().ljust(max_result_length)))
         log_message(message)
 
 
+class RuleResult(object):
+    """Result of one rule as shown in the summary table"""
+
+    __slots__ = ('rule_id', 'title', 'result')
+
+    def __init__(self, rule_id, title, result):
+        self.rule_id = rule_id
+        self.title = title
+        self.result = result
+
+    def __repr__(self):
+        return '<RuleResult %s:%s>' % (self.rule_id, self.result)
+
+
 class ScanProgress(object):
-    """The class is used for showing progress during the scan check."""
-    def __init__(self, total_count, debug):
+    """
+    The class is used for showing progress during the scan check.
+
+    On a terminal the line with the running module is redrawn at most
+    settings.progress_frame_rate times per second. Otherwise (output
+    redirected to a file, CI) every processed module is reported as one
+    JSON line so the progress can be parsed by other tools.
+    """
+
+    # cached width of the terminal, dropped on SIGWINCH
+    terminal_width = None
+
+    def __init__(self, total_count, debug, stream=None):
         self.total_count = total_count
         self.current_count = 0
+        # results in the order of processing, indexed by rule id
         self.output_data = []
+        self.results = {}
         self.debug = debug
         self.names = {}
         self.list_names = []
+        # rules evaluated at the moment when known, see set_running
+        self.running = []
         self.width_size = 0
         self.time = datetime.datetime.now()
+        self.stream = stream or sys.stdout
+        self.interactive = ScanProgress.is_terminal(self.stream)
+        # running message currently shown on the terminal
+        self.drawn = ''
+        self.last_draw = 0
+        self.timer = None
+        self.lock = threading.Lock()
+        if self.interactive:
+            ScanProgress.watch_terminal_size()
 
     def get_full_name(self, count):
         """Function returns full name from dictionary"""
@@ -73,6 +116,37 @@ class ScanProgress(object):
             return ''
         return self.names[key]
 
+    def get_running_name(self):
+        """Function returns name of the running modules"""
+        if not self.running:
+            return self.get_full_name(self.current_count)
+        names = [self.names.get(rule_id, rule_id) for rule_id in self.running]
+        if len(names) == 1:
+            return names[0]
+        return u'%d modules: %s' % (len(names), u', '.join(names))
+
+    @staticmethod
+    def is_terminal(stream):
+        try:
+            return stream.isatty()
+        except (AttributeError, ValueError):
+            return False
+
+    @staticmethod
+    def _reset_terminal_width(signum, frame):
+        ScanProgress.terminal_width = None
+
+    @staticmethod
+    def watch_terminal_size():
+        """Function drops the cached terminal width when terminal is resized"""
+        try:
+            signal.signal(signal.SIGWINCH, ScanProgress._reset_terminal_width)
+            # do not interrupt reading of the oscap output
+            signal.siginterrupt(signal.SIGWINCH, False)
+        except (AttributeError, ValueError):
+            # not in the main thread
+            pass
+
     @staticmethod
     def get_terminal_width():
         """
@@ -80,52 +154,120 @@ class ScanProgress(object):
 
         :return:
         """
-        cmd = ["stty", "size"]
-        sp = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        return int(sp.communicate()[0].split()[1])
+        if ScanProgress.terminal_width is None:
+            try:
+                size = fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ,
+                                   struct.pack(str('HHHH'), 0, 0, 0, 0))
+                width = struct.unpack(str('HHHH'), size)[1]
+            except (AttributeError, IOError, ValueError):
+                width = 0
+            ScanProgress.terminal_width = width or 80
+        return ScanProgress.terminal_width
 
     def _return_correct_msg(self, msg):
         if len(msg) > self.width_size:
             msg = msg[:self.width_size - 7] + '...'
         return msg
 
+    def _write(self, msg, new_line):
+        if self.stream is sys.stdout:
+            log_message(msg, new_line=new_line)
+        else:
+            self.stream.write(msg + ('\n' if new_line else ''))
+            self.stream.flush()
+
+    def _draw_running(self):
+        """
+        Function shows the module which is running
+
+        The line is redrawn at most once per frame. A module finished
+        sooner than that is not shown at all, the line is drawn later
+        by a timer if the next module still runs after the frame.
+        """
+        wait = self.last_draw + 1.0 / settings.progress_frame_rate - time.time()
+        if wait > 0:
+            if self.timer is None:
+                self.timer = threading.Timer(wait, self._draw_deferred)
+                self.timer.daemon = True
+                self.timer.start()
+            return
+        msg = self._return_correct_msg(u'%.3d/%.3d ...running (%s)'
+                                       % (self.current_count + 1,
+                                          self.total_count,
+                                          self.get_running_name()))
+        self._write(u'\r' + msg.ljust(len(self.drawn)), new_line=False)
+        self.drawn = msg
+        self.last_draw = time.time()
+
+    def _draw_deferred(self):
+        with self.lock:
+            self.timer = None
+            if not self.drawn and self.total_count > self.current_count:
+                self._draw_running()
+
+    def _report(self, event, **kwargs):
+        """Function writes one line of machine readable progress"""
+        record = {'event': event,
+                  'current': self.current_count,
+                  'total': self.total_count}
+        record.update(kwargs)
+        self._write(json.dumps(record, sort_keys=True), new_line=True)
+
+    def start(self):
+        """Function shows the progress before the first module finishes"""
+        self.time = datetime.datetime.now()
+        if self.interactive:
+            self.width_size = ScanProgress.get_terminal_width()
+            self._draw_running()
+        else:
+            self._report('start')
+
     def show_progress(self, stdout_data):
         """Function shows a progress of assessment"""
-        try:
-            self.width_size = ScanProgress.get_terminal_width()
-        except IndexError:
-            self.width_size = 80
         logger_report.debug(stdout_data.strip())
         xccdf_rule = ""
-        dummy_result = ""
+        result = ""
         try:
-            xccdf_rule, dummy_result = stdout_data.strip().split(':')
+            xccdf_rule, result = stdout_data.strip().split(':')
         except ValueError:
             print (stdout_data)
             return
-        self.output_data.append(u'{0}:{1}'.format(self.names[xccdf_rule], stdout_data.strip()))
-        self.current_count += 1
-        old_width = self.width_size
-        self.width_size -= 21
-        prev_msg = self._return_correct_msg(self.get_full_name(self.current_count - 1))
-        self.width_size = old_width
-        cur_msg = self._return_correct_msg(self.get_full_name(self.current_count))
-        cnt_back = 7 + len(prev_msg) + 3
-        curr_time = datetime.datetime.now()
-        diff_time = curr_time - self.time
-        msg = (u'%sdone    (%s) (time: %.2d:%.2ds)'
-               % ('\b' * cnt_back,
-                  prev_msg,
-                  diff_time.seconds / 60,
-                  diff_time.seconds % 60))
-        log_message(msg, new_line=True)
-        if self.total_count > self.current_count:
-            msg = self._return_correct_msg(u'%.3d/%.3d ...running (%s)'
-                                           % (self.current_count + 1,
-                                              self.total_count,
-                                              cur_msg))
-            log_message(msg, new_line=False)
-        self.time = datetime.datetime.now()
+        with self.lock:
+            self.add_result(xccdf_rule, result)
+            self.current_count += 1
+            curr_time = datetime.datetime.now()
+            diff_time = curr_time - self.time
+            self.time = curr_time
+            if not self.interactive:
+                self._report('done', rule=xccdf_rule, result=result,
+                             title=self.names.get(xccdf_rule, ''),
+                             seconds=diff_time.seconds)
+                return
+            self.width_size = ScanProgress.get_terminal_width() - 21
+            prev_msg = self._return_correct_msg(self.names.get(xccdf_rule, xccdf_rule))
+            self.width_size += 21
+            msg = (u'%.3d/%.3d ...done    (%s) (time: %.2d:%.2ds)'
+                   % (self.current_count,
+                      self.total_count,
+                      prev_msg,
+                      diff_time.seconds / 60,
+                      diff_time.seconds % 60))
+            self._write(u'\r' + msg.ljust(len(self.drawn)), new_line=True)
+            self.drawn = ''
+            if self.total_count > self.current_count:
+                self._draw_running()
+
+    def set_running(self, rule_ids):
+        """
+        Function sets the rules which are evaluated at the moment
+
+        Without them the running module is guessed from the count of the
+        finished ones, which is right only when one module runs at a time.
+        """
+        with self.lock:
+            self.running = list(rule_ids)
+            if self.interactive and self.drawn:
+                self._draw_running()
 
     def set_names(self, names):
         """
@@ -142,15 +284,312 @@ class ScanProgress(object):
         """Function gets an output data from oscap"""
         return self.output_data
 
+    def add_result(self, rule_id, result):
+        """Function stores result of rule reported by oscap"""
+        record = RuleResult(rule_id, self.names.get(rule_id, rule_id), result)
+        self.output_data.append(record)
+        self.results[rule_id] = record
+
+    def set_result(self, rule_id, result):
+        """Function changes result of already processed rule"""
+        try:
+            self.results[rule_id].result = result
+        except KeyError:
+            logger_report.debug("Rule '%s' was not processed", rule_id)
+
     def update_data(self, changed_fields):
-        """Function updates a data"""
-        for index, row in enumerate(self.output_data):
-            try:
-                title, rule_id, dummy_result = row.split(':')
-                logger_report.debug(row)
-            except ValueError:
+        """
+        Function updates a data
+
+        changed_fields is a list of (rule_id, result) tuples
+        """
+        for rule_id, result in changed_fields:
+            self.set_result(rule_id, result)
+
+
+# results of rules counted by the XCCDF scoring models and those of them
+# which pass
+SCORED_RESULTS = ("pass", "fail", "error", "unknown", "fixed")
+PASSED_RESULTS = ("pass", "fixed")
+
+
+class ParallelScan(object):
+    """
+    The class runs the assessment in several OpenSCAP processes at once.
+
+    Selected rules are split into work units. Each unit is evaluated by its
+    own 'oscap xccdf eval' process against a copy of the module set content
+    with only the unit's rules selected. The per-unit results are merged
+    into one XCCDF result stored in the default result path afterwards.
+
+    Units run concurrently, so modules of different groups are not run in
+    order of the content and share $VALUE_TMP_PREUPGRADE, the kickstart
+    and postupgrade.d files at the same time; --jobs is safe only with
+    modules which do not depend on side effects of modules of other groups.
+    """
+
+    def __init__(self, openscap_helper, report_parser, jobs):
+        self.openscap_helper = openscap_helper
+        self.report_parser = report_parser
+        self.jobs = jobs
+        self.lock = threading.Lock()
+        self.function = None
+        self.running = None
+        self.units = []
+        # index of running unit -> its rules which are not finished yet
+        self.pending = {}
+
+    def get_rule_groups(self):
+        """
+        Function returns dictionary rule id -> id of the group of modules
+        the rule belongs to, i.e. of the group containing the module's group
+        """
+        rule_groups = {}
+        tree = self.report_parser.target_tree
+        # groups are found in document order, parents first
+        for group in self.report_parser.get_nodes(tree, "Group", prefix=".//"):
+            for child in group.findall(XMLNS + "Group"):
+                for rule in child.findall(XMLNS + "Rule"):
+                    rule_groups[rule.get('id')] = group.get('id')
+            for rule in group.findall(XMLNS + "Rule"):
+                rule_groups.setdefault(rule.get('id'), group.get('id'))
+        return rule_groups
+
+    def split_rules(self):
+        """
+        Function splits the selected rules into work units
+
+        Modules of one group stay together in order of the content, they
+        may depend on each other's side effects. Groups are distributed
+        round-robin so long running modules placed next to each other in
+        the module set do not end up in one unit.
+        """
+        rule_groups = self.get_rule_groups()
+        groups = []
+        group_indexes = {}
+        for select in self.report_parser.get_allowed_selected_rules():
+            rule = select.get('idref')
+            group = rule_groups.get(rule, rule)
+            if group not in group_indexes:
+                group_indexes[group] = len(groups)
+                groups.append([])
+            groups[group_indexes[group]].append(rule)
+        count = min(len(groups), self.jobs * settings.scan_units_per_job)
+        return [sum(groups[index::count], []) for index in range(count)]
+
+    def write_unit_content(self, index, unit):
+        """
+        Function writes a copy of the content with just the unit's rules
+        selected next to the original one, so the relative paths to the
+        check scripts stay valid. The original selection is kept untouched.
+        """
+        unit = set(unit)
+        selects = self.report_parser.get_select_rules()
+        original = [select.get('selected') for select in selects]
+        for select in selects:
+            if select.get('idref') in unit:
+                select.set('selected', 'true')
+            else:
+                select.set('selected', 'false')
+        content = self.openscap_helper.content
+        name, ext = os.path.splitext(os.path.basename(content))
+        unit_path = os.path.join(os.path.dirname(content),
+                                 '%s-unit-%.3d%s' % (name, index, ext))
+        data = ElementTree.tostring(self.report_parser.target_tree, "utf-8")
+        FileHelper.write_to_file(unit_path, 'wb', data, False)
+        for select, selected in zip(selects, original):
+            select.set('selected', selected)
+        return unit_path
+
+    def _update_running(self):
+        """
+        Function reports the first unfinished rule of each running unit,
+        oscap evaluates the rules of a unit in order of the content
+        """
+        if self.running is not None:
+            self.running([rules[0] for dummy_index, rules
+                          in sorted(self.pending.items()) if rules])
+
+    def _show_progress(self, index, stdout_data):
+        # progress lines come from several processes at once
+        self.lock.acquire()
+        try:
+            rule_id = stdout_data.strip().split(':')[0]
+            pending = self.pending.get(index, [])
+            if rule_id in pending:
+                pending.remove(rule_id)
+            self._update_running()
+            self.function(stdout_data)
+        finally:
+            self.lock.release()
+
+    def _set_pending(self, index, rules):
+        self.lock.acquire()
+        try:
+            if rules is None:
+                self.pending.pop(index, None)
+            else:
+                self.pending[index] = list(rules)
+            self._update_running()
+        finally:
+            self.lock.release()
+
+    def run_unit(self, paths):
+        """Function runs the oscap process of one work unit"""
+        index, content, result_file = paths
+        cmd = self.openscap_helper.build_command(content=content,
+                                                 result_file=result_file)
+        logger_debug.debug('running_command: %s', cmd)
+        function = None
+        if self.function is not None:
+            function = lambda stdout_data: self._show_progress(index, stdout_data)
+        self._set_pending(index, self.units[index])
+        try:
+            return ProcessHelper.run_subprocess(cmd, print_output=False,
+                                                function=function)
+        finally:
+            self._set_pending(index, None)
+
+    @staticmethod
+    def merge_results(result_files, selected, output):
+        """
+        Function merges the results of the work units into one XCCDF result
+
+        The first unit's result is used as a base, its rule-results are
+        replaced by the evaluated ones from the other units and its scores
+        are computed again from all of them. The profile selection is
+        restored according to selected dictionary (idref -> value of the
+        'selected' attribute).
+        """
+        base = None
+        rule_results = {}
+        start_times = []
+        end_times = []
+        for result_file in result_files:
+            root = ElementTree.parse(result_file).getroot()
+            if base is None:
+                base = root
+            test_result = root.find(XMLNS + "TestResult")
+            if test_result is None:
                 continue
+            start_times.append(test_result.get('start-time'))
+            end_times.append(test_result.get('end-time'))
+            for rule_result in test_result.findall(XMLNS + "rule-result"):
+                if rule_result.findtext(XMLNS + "result") != "notselected":
+                    rule_results[rule_result.get('idref')] = rule_result
+
+        test_result = base.find(XMLNS + "TestResult")
+        if test_result is not None:
+            for index, child in enumerate(list(test_result)):
+                if child.tag != XMLNS + "rule-result":
+                    continue
+                if child.get('idref') in rule_results:
+                    test_result[index] = rule_results[child.get('idref')]
+            if None not in start_times:
+                test_result.set('start-time', min(start_times))
+            if None not in end_times:
+                test_result.set('end-time', max(end_times))
+            results = dict((x.get('idref'), x.findtext(XMLNS + "result"))
+                           for x in test_result.findall(XMLNS + "rule-result"))
+            ParallelScan.update_scores(base, test_result, results)
+        for select in base.findall('./%sProfile/%sselect' % (XMLNS, XMLNS)):
+            if select.get('idref') in selected:
+                select.set('selected', selected[select.get('idref')])
+        data = ElementTree.tostring(base, "utf-8")
+        FileHelper.write_to_file(output, 'wb', data, False)
+
+    @staticmethod
+    def update_scores(benchmark, test_result, results):
+        """
+        Function computes scores of test_result from results (rule id ->
+        result) by the default and the flat XCCDF scoring models; scores
+        of other models can't be computed, so they are removed
+        """
+        weights = {}
+
+        def get_weight(item):
+            return float(item.get('weight', 1))
+
+        def default_score(item):
+            """ return score of the item or None when it is not counted """
+            if item.tag == XMLNS + "Rule":
+                result = results.get(item.get('id'))
+                if result not in SCORED_RESULTS:
+                    return None
+                weights[item.get('id')] = get_weight(item)
+                return 100.0 if result in PASSED_RESULTS else 0.0
+            scores = []
+            for child in item:
+                if child.tag in (XMLNS + "Group", XMLNS + "Rule"):
+                    score = default_score(child)
+                    if score is not None:
+                        scores.append((score, get_weight(child)))
+            if not scores:
+                return None
+            weight_sum = sum(weight for dummy_score, weight in scores)
+            if not weight_sum:
+                return 0.0
+            return sum(score * weight for score, weight in scores) / weight_sum
+
+        default = default_score(benchmark) or 0.0
+        flat = sum(weight for rule_id, weight in weights.items()
+                   if results[rule_id] in PASSED_RESULTS)
+        for score in test_result.findall(XMLNS + "score"):
+            if score.get('system') == "urn:xccdf:scoring:default":
+                score.text = "%f" % default
+                score.set('maximum', "%f" % 100)
+            elif score.get('system') == "urn:xccdf:scoring:flat":
+                score.text = "%f" % flat
+                score.set('maximum', "%f" % sum(weights.values()))
             else:
-                result_list = [x for x in changed_fields if rule_id in x]
-                if result_list:
-                    self.output_data[index] = u"%s:%s:%s" % (title, rule_id, result_list[0].split(':')[1])
+                test_result.remove(score)
+
+    def run(self, function=None, running=None):
+        """
+        Function runs all the work units with at most self.jobs of them
+        at the same time and merges their results.
+
+        function is called with each progress line of oscap, running with
+        list of rules evaluated at the moment whenever it changes.
+
+        Return the return code of oscap: 1 when any unit ended with an error,
+        otherwise the highest return code of the units.
+        """
+        self.function = function
+        self.running = running
+        self.units = units = self.split_rules()
+        if len(units) < 2:
+            # nothing to split, run the content as it is
+            self.units = [sum(units, [])]
+            return self.run_unit(
+                (0, self.openscap_helper.content,
+                 self.openscap_helper.get_default_xml_result_path()))
+        selected = dict((select.get('idref'), select.get('selected'))
+                        for select in self.report_parser.get_select_rules())
+        work_dir = tempfile.mkdtemp(prefix='preupg-scan.')
+        contents = []
+        try:
+            paths = []
+            for index, unit in enumerate(units):
+                contents.append(self.write_unit_content(index, unit))
+                paths.append((index, contents[-1],
+                              os.path.join(work_dir, 'result-%.3d.xml' % index)))
+            logger_debug.debug('Running %d work units in %d jobs',
+                               len(units), self.jobs)
+            ret_vals = ParallelHelper.map_in_threads(self.run_unit, paths,
+                                                     self.jobs)
+            result_files = [result for dummy_index, dummy_content, result in paths
+                            if os.path.exists(result)]
+            if not result_files:
+                return 1
+            self.merge_results(
+                result_files, selected,
+                self.openscap_helper.get_default_xml_result_path())
+        finally:
+            for content in contents:
+                if os.path.exists(content):
+                    os.unlink(content)
+            shutil.rmtree(work_dir, ignore_errors=True)
+        if 1 in ret_vals or len(result_files) != len(paths):
+            return 1
+        return max(ret_vals)
@@ -31,7 +31,7 @@ except ImportError:
     import ConfigParser as configparser
 
 from preupg import settings
-from preupg.utils import FileHelper, ProcessHelper
+from preupg.utils import FileHelper, ProcessHelper, RpmIndex, ChangedFilesIndex
 
 __all__ = (
     'log_debug',
@@ -61,6 +61,8 @@ __all__ = (
     'is_dist_native',
     'get_dist_native_list',
     'is_pkg_installed',
+    'config_file_changed',
+    'get_config_file_flags',
     'add_pkg_to_kickstart',
     'deploy_hook',
 
@@ -75,6 +77,7 @@ __all__ = (
     'VALUE_ALLMYFILES',
     'VALUE_EXECUTABLES',
     'VALUE_RPM_RHSIGNED',
+    'VALUE_RPM_INDEX',
     'VALUE_TMP_PREUPGRADE',
     'MODULE_PATH',
     'COMMON_DIR',
@@ -161,6 +164,12 @@ VALUE_EXECUTABLES = os.path.join(PREUPGRADE_CACHE, "executable.log")
 #
 VALUE_RPM_RHSIGNED = os.path.join(PREUPGRADE_CACHE, "rpm_rhsigned.log")
 
+#
+# Full path to directory with index of installed packages, it contains
+# a file per package name with 'signed key_id vendor' separated by tabs
+#
+VALUE_RPM_INDEX = os.path.join(PREUPGRADE_CACHE, "rpm_index")
+
 #
 # Variable which referes to temporary directory directory provided by module
 #
@@ -492,6 +501,21 @@ def switch_to_content():
     os.chdir(os.environ['CURRENT_DIRECTORY'])
 
 
+_rpm_index_cache = {}
+
+
+def get_rpm_index():
+    """
+    Return index of installed packages built from VALUE_RPM_QA
+    and VALUE_RPM_RHSIGNED. The index is built once per process.
+    """
+    key = (VALUE_RPM_QA, VALUE_RPM_RHSIGNED)
+    if key not in _rpm_index_cache:
+        _rpm_index_cache.clear()
+        _rpm_index_cache[key] = RpmIndex(VALUE_RPM_QA, VALUE_RPM_RHSIGNED)
+    return _rpm_index_cache[key]
+
+
 def is_pkg_installed(pkg_name):
     """
     Function checks if package is installed.
@@ -500,12 +524,7 @@ def is_pkg_installed(pkg_name):
     :return: 0 - package is installed
              1 - package is NOT installed
     """
-    lines = FileHelper.get_file_content(VALUE_RPM_QA, "rb", True)
-    found = [x for x in lines if x.split()[0] == pkg_name]
-    if found:
-        return True
-    else:
-        return False
+    return get_rpm_index().is_installed(pkg_name)
 
 
 def check_applies_to(check_applies=""):
@@ -542,10 +561,9 @@ def check_rpm_to(check_rpm="", check_bin=""):
 
     if check_rpm != "":
         rpms = check_rpm.split(',')
-        lines = FileHelper.get_file_content(VALUE_RPM_QA, "rb", True)
+        rpm_index = get_rpm_index()
         for rpm in rpms:
-            lst = [x for x in lines if rpm == x.split('\t')[0]]
-            if not lst:
+            if not rpm_index.is_installed(rpm):
                 log_high_risk("Package %s is not installed." % rpm)
                 not_applicable = 1
 
@@ -591,6 +609,20 @@ def service_is_enabled(service_name):
     return return_value
 
 
+_changed_configs_cache = {}
+
+
+def get_changed_configs():
+    """
+    Return index of changed config files built from VALUE_CONFIGCHANGED.
+    The index is built once per process.
+    """
+    if VALUE_CONFIGCHANGED not in _changed_configs_cache:
+        _changed_configs_cache.clear()
+        _changed_configs_cache[VALUE_CONFIGCHANGED] = ChangedFilesIndex(VALUE_CONFIGCHANGED)
+    return _changed_configs_cache[VALUE_CONFIGCHANGED]
+
+
 def config_file_changed(config_file_name):
     """
     Searches cached data in VALUE_CONFIGCHANGED
@@ -599,16 +631,15 @@ def config_file_changed(config_file_name):
     True if given config file has been changed
     False if given config file hasn't been changed
     """
-    config_changed = False
-    try:
-        lines = FileHelper.get_file_content(VALUE_CONFIGCHANGED, "rb", True)
-        for line in lines:
-            if line.find(config_file_name) != -1:
-                config_changed = True
-                break
-    except:
-        pass
-    return config_changed
+    return get_changed_configs().is_changed(config_file_name)
+
+
+def get_config_file_flags(config_file_name):
+    """
+    Returns verify flags of changed config file from VALUE_CONFIGCHANGED
+    (e.g. 'S.5....T.' or 'missing') or None if it hasn't been changed
+    """
+    return get_changed_configs().get_flags(config_file_name)
 
 
 def backup_config_file(config_file_name):
@@ -649,14 +680,12 @@ def is_dist_native(pkg):
     DIST_NATIVE = path_to_file: return True if package is in file else return False
     """
 
-    rpm_qa = FileHelper.get_file_content(VALUE_RPM_QA, "rb", True)
-    found = [x for x in rpm_qa if x.split()[0] == pkg]
-    if not found:
-        log_warning("Package %s is not installed on Red Hat Enterprise Linux system.")
+    rpm_index = get_rpm_index()
+    if not rpm_index.is_installed(pkg):
+        log_warning("Package %s is not installed on Red Hat Enterprise Linux system." % pkg)
         return False
 
-    rpm_signed = FileHelper.get_file_content(VALUE_RPM_RHSIGNED, "rb", True)
-    found = [x for x in rpm_signed if x.split()[0] == pkg]
+    found = rpm_index.is_signed(pkg)
 
     if int(DEVEL_MODE) == 0:
         if found:
@@ -687,9 +716,7 @@ def get_dist_native_list():
     """
 
     native_pkgs = []
-    tmp = FileHelper.get_file_content(VALUE_RPM_QA, "rb", True)
-    pkgs = [i.split("\t")[0] for i in tmp]
-    for pkg in pkgs:
+    for pkg in get_rpm_index().names:
         if is_dist_native(pkg) is True:
             native_pkgs.append(pkg)
     return native_pkgs
@@ -79,12 +79,72 @@ common_name = "common"
 # path to file with definitions of common scripts
 common_scripts = os.path.join(data_dir, "preassessment", "scripts.txt")
 
+# number of common scripts run at the same time
+common_jobs = 4
+
+# RPM database directory, its state decides whether cached common logs
+# generated from the RPM database can be reused
+rpm_db_dir = "/var/lib/rpm"
+# files of the RPM database changed only when packages are (un)installed,
+# Berkeley DB environment files (__db.00N) change with every rpm query
+rpm_db_files = ["Packages", "Name"]
+
+# rpm binary used to verify the installed packages
+rpm_binary = "rpm"
+# number of packages verified at the same time ('rpm -Va' log),
+# 0 means number of CPUs
+rpm_verify_jobs = 0
+# cache of file digests used to verify the installed packages
+rpm_verify_cache = "rpm_verify_cache.json"
+
+# manifest with fingerprints of the cached common logs
+common_manifest = "manifest.json"
+
+# index of the installed packages in the common directory (one file per
+# package) generated from these common logs
+rpm_index_dir = "rpm_index"
+rpm_qa_log = "rpm_qa.log"
+rpm_signed_log = "rpm_rhsigned.log"
+
+# inputs of the common logs which can be reused from previous runs:
+#   rpmdb       ... state of the RPM database
+#   files:<log> ... state of the files listed in the given common log
+# logs the command reads (e.g. grep of another log) are added automatically,
+# logs not listed here are generated on every run
+common_log_inputs = {
+    'rpm_qa.log': ['rpmdb'],
+    'rpmtrackedfiles.log': ['rpmdb'],
+    'rpm_Va.log': ['rpmdb', 'files:rpmtrackedfiles.log'],
+    'rpm_etc_Va.log': [],
+    'rpm_rhsigned.log': [],
+}
+
 # Default module set descriptor file
 all_xccdf_xml_filename = "all-xccdf.xml"
 
 # prefix of tag in xccdf files
 xccdf_tag = "xccdf_preupg_rule_"
 
+# number of modules run at the same time (see --jobs option)
+jobs = 1
+
+# compression of the tarball with results (see --compression option)
+tarball_compression = "gzip"
+tarball_compress_level = 6
+
+# number of work units per job the selected modules are split into
+# during parallel assessment; smaller units balance the load better
+scan_units_per_job = 2
+
+# how many times per second the progress of the assessment is redrawn
+progress_frame_rate = 10
+
+# directory in cache_dir with composed module sets
+compose_cache_dir = "compose"
+
+# number of composed module sets kept in the cache
+compose_cache_sets = 2
+
 # name of the hash file
 base_hashed_file = "hashed_file"
 
@@ -177,6 +237,12 @@ text_converters = {'w3m': '{0} -T text/html -dump {1} > {2}',
                    }
 
 ui_command = "preupg -u http://example.com:8099/submit/ -r {0}"
+# results are uploaded to UI in chunks of this size (in bytes)
+upload_chunk_size = 1024 * 1024
+# how many times the upload of a chunk is retried
+upload_retries = 3
+# seconds to wait before the first retry, doubled by every next one
+upload_retry_delay = 2
 openssl_command = "openssl x509 -text -in {0} | grep -A1 1.3.6.1.4.1.2312.9.1"
 
 UPGRADE_PATH = ""
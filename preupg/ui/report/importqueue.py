@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+Filesystem queue of uploaded reports waiting for import
+
+Every job is a file named by ID of its HostRun containing path to the
+uploaded tarball. A job moves between directories of the queue:
+
+ * pending -- waiting for a worker
+ * running -- claimed by a worker (rename is atomic, so only one worker
+              gets the job); the file contains also PID of the worker
+              process and ID of the boot, so the job can be moved back
+              to pending when the worker was killed or the system rebooted
+ * failed  -- import failed, the file contains also the error message;
+              the job can be moved back to pending by retry()
+
+Job file has lines: path to the tarball, count of failed attempts, time
+of the next attempt, owner (the worker which claimed it) and error
+message of the last attempt. Import failed on a database error (e.g.
+locked database) is moved back to pending up to settings.IMPORT_RETRIES
+times, the next attempt is delayed by settings.IMPORT_RETRY_DELAY seconds
+doubled by every failed attempt. Finished jobs are removed, HostRun is
+marked as finished by the import.
+
+Jobs are imported by worker threads of a long running process started
+outside of the web server (management command import_worker, installed
+as systemd service preupgrade-assistant-ui-import), the workers poll the
+pending directory every settings.IMPORT_POLL_INTERVAL seconds. The main
+thread moves jobs of dead workers back to pending, the queue is locked,
+so there is just one such process.
+
+SQLite allows one writer at a time, so just one worker imports jobs
+there whatever settings.IMPORT_WORKERS says.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import threading
+import time
+import traceback
+
+from django.conf import settings
+from django.db import connection, DatabaseError
+
+from .models import HostRun
+from .service import import_report
+
+
+logger = logging.getLogger('preup_ui')
+
+PENDING = 'pending'
+RUNNING = 'running'
+FAILED = 'failed'
+FINISHED = 'finished'
+
+
+def _boot_id():
+    """ return ID of the current boot, PIDs are reused after reboot """
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as boot_id:
+            return boot_id.read().strip()
+    except IOError:
+        return ''
+
+
+def _owner():
+    """ return owner of jobs claimed by this process """
+    return '%d %s' % (os.getpid(), _boot_id())
+
+
+def _is_alive(owner):
+    """ is the process which claimed a job still running? """
+    pid, dummy_sep, boot_id = owner.partition(' ')
+    if not pid.isdigit() or boot_id != _boot_id():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except OSError as e:
+        # EPERM: process of another user
+        return e.errno == errno.EPERM
+    return True
+
+
+class ImportQueue(object):
+
+    def __init__(self, queue_dir=None, workers=None):
+        self.queue_dir = queue_dir or settings.IMPORT_QUEUE_DIR
+        if workers is None:
+            workers = settings.IMPORT_WORKERS
+        if workers > 1 and connection.vendor == 'sqlite':
+            # other workers would fail with "database is locked"
+            workers = 1
+        self.workers = workers
+        for subdir in (PENDING, RUNNING, FAILED):
+            path = self._path(subdir)
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path, mode=0o0755)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+
+    def _path(self, subdir, hostrun_id=None):
+        if hostrun_id is None:
+            return os.path.join(self.queue_dir, subdir)
+        return os.path.join(self.queue_dir, subdir, str(hostrun_id))
+
+    @staticmethod
+    def _write_job(path, tb_path, attempts=0, message='', retry_at=0, owner=''):
+        with open(path + '.new', 'w') as job:
+            job.write('%s\n%d\n%d\n%s\n%s' % (tb_path, attempts, retry_at, owner, message))
+        os.rename(path + '.new', path)
+
+    @staticmethod
+    def _read_job(path):
+        """ return (tb_path, attempts, retry_at, owner, message) of job """
+        with open(path) as job:
+            lines = job.read().split('\n', 4)
+        lines.extend([''] * (5 - len(lines)))
+        return lines[0], int(lines[1] or 0), int(lines[2] or 0), lines[3], lines[4]
+
+    def enqueue(self, tb_path, hostrun_id):
+        """ add uploaded tarball to the queue """
+        self._write_job(self._path(PENDING, hostrun_id), tb_path)
+
+    def pending(self):
+        """ return IDs of HostRuns waiting for import, oldest first """
+        jobs = [int(name) for name in os.listdir(self._path(PENDING))
+                if name.isdigit()]
+        return sorted(jobs)
+
+    def claim(self):
+        """
+        move the oldest pending job which is not delayed to running, return
+        (hostrun_id, tb_path)
+        """
+        now = time.time()
+        for hostrun_id in self.pending():
+            try:
+                if self._read_job(self._path(PENDING, hostrun_id))[2] > now:
+                    continue
+                # PID in the name tells recover() who claimed the job
+                # until the owner is written
+                claimed = self._path(RUNNING, '%d.%d' % (hostrun_id, os.getpid()))
+                os.rename(self._path(PENDING, hostrun_id), claimed)
+            except (IOError, OSError):
+                # claimed by another worker
+                continue
+            tb_path, attempts, dummy_retry_at, dummy_owner, message = self._read_job(claimed)
+            self._write_job(self._path(RUNNING, hostrun_id), tb_path, attempts, message,
+                            owner=_owner())
+            os.unlink(claimed)
+            return hostrun_id, tb_path
+        return None
+
+    def _orphaned(self):
+        """ return (hostrun_id, path) of running jobs whose worker is dead """
+        jobs = []
+        for name in os.listdir(self._path(RUNNING)):
+            hostrun_id, dummy_sep, pid = name.partition('.')
+            if not hostrun_id.isdigit():
+                continue
+            if pid.isdigit():
+                # owner is not written yet
+                owner = '%s %s' % (pid, _boot_id())
+            elif pid:
+                continue
+            else:
+                try:
+                    owner = self._read_job(self._path(RUNNING, name))[3]
+                except IOError:
+                    continue
+            if not _is_alive(owner):
+                jobs.append((int(hostrun_id), self._path(RUNNING, name)))
+        return jobs
+
+    def recover(self):
+        """
+        move running jobs of workers which were killed or did not survive
+        reboot back to pending
+        """
+        for hostrun_id, path in self._orphaned():
+            logger.warning("Import of HostRun %s was interrupted, it will be tried again.",
+                           hostrun_id)
+            try:
+                os.rename(path, self._path(PENDING, hostrun_id))
+            except OSError:
+                pass
+
+    def process(self, hostrun_id, tb_path):
+        """
+        import claimed job, failure is stored to the queue; the job is
+        tried again later when it failed on a database error
+        """
+        try:
+            import_report(tb_path, hostrun_id)
+        except Exception as e:
+            logger.error("Import of HostRun %s failed:\n%s", hostrun_id, traceback.format_exc())
+            message = traceback.format_exc().strip().splitlines()[-1]
+            attempts = self._read_job(self._path(RUNNING, hostrun_id))[1] + 1
+            state = FAILED
+            retry_at = 0
+            if isinstance(e, DatabaseError) and attempts <= settings.IMPORT_RETRIES:
+                state = PENDING
+                # give the database (e.g. another writer) time to recover
+                retry_at = time.time() + settings.IMPORT_RETRY_DELAY * 2 ** (attempts - 1)
+                # the connection may be broken
+                connection.close()
+            self._write_job(self._path(RUNNING, hostrun_id), tb_path, attempts, message,
+                            retry_at)
+            os.rename(self._path(RUNNING, hostrun_id), self._path(state, hostrun_id))
+        else:
+            os.unlink(self._path(RUNNING, hostrun_id))
+
+    def retry(self, hostrun_id):
+        """ move failed job back to pending, return False if it didn't fail """
+        try:
+            tb_path = self._read_job(self._path(FAILED, hostrun_id))[0]
+        except IOError:
+            return False
+        self._write_job(self._path(FAILED, hostrun_id), tb_path)
+        os.rename(self._path(FAILED, hostrun_id), self._path(PENDING, hostrun_id))
+        return True
+
+    def process_jobs(self):
+        """ import jobs until the queue is empty """
+        job = self.claim()
+        while job is not None:
+            self.process(*job)
+            job = self.claim()
+
+    def status(self, hostrun_id):
+        """ return (state, error message) of import of HostRun """
+        if os.path.exists(self._path(PENDING, hostrun_id)):
+            return PENDING, None
+        try:
+            owner = self._read_job(self._path(RUNNING, hostrun_id))[3]
+        except IOError:
+            pass
+        else:
+            # job of dead worker is moved back to pending by recover()
+            return (RUNNING if _is_alive(owner) else PENDING), None
+        try:
+            return FAILED, self._read_job(self._path(FAILED, hostrun_id))[4]
+        except IOError:
+            pass
+        hostrun = HostRun.objects.get(id=hostrun_id)
+        if hostrun.finished:
+            return FINISHED, None
+        # uploaded by some other way, e.g. upload_results
+        return RUNNING, None
+
+    def _work(self, poll_interval):
+        """ main loop of worker thread """
+        while True:
+            try:
+                job = self.claim()
+                if job is not None:
+                    self.process(*job)
+                    continue
+            except Exception:
+                logger.error("Import worker failed:\n%s", traceback.format_exc())
+            # do not keep connection to database open while idle
+            connection.close()
+            time.sleep(poll_interval)
+
+    def serve(self, poll_interval=None):
+        """
+        run self.workers worker threads importing jobs and recover jobs
+        of dead workers, never returns
+        """
+        if poll_interval is None:
+            poll_interval = settings.IMPORT_POLL_INTERVAL
+        lock = open(os.path.join(self.queue_dir, 'lock'), 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            raise Exception('Another import worker is running on %s.' % self.queue_dir)
+        for dummy_i in range(max(self.workers, 1)):
+            thread = threading.Thread(target=self._work, args=(poll_interval, ))
+            thread.daemon = True
+            thread.start()
+        while True:
+            try:
+                self.recover()
+            except OSError:
+                logger.error("Recovery of interrupted imports failed:\n%s", traceback.format_exc())
+            time.sleep(poll_interval)
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""
+Import uploaded reports waiting in the import queue, see report/importqueue.py
+
+The command runs until it is killed, it is started by systemd service
+preupgrade-assistant-ui-import.
+"""
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from preupg.ui.report.importqueue import ImportQueue
+
+
+class Command(NoArgsCommand):
+    help = 'Import uploaded reports waiting in the import queue.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=None,
+                    help='Count of worker threads, IMPORT_WORKERS by default.'),
+    )
+
+    def handle_noargs(self, **options):
+        ImportQueue(workers=options['workers']).serve()
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""
+Index imported results for full-text search, see report/search.py
+
+Results are indexed during import, this command indexes the ones
+imported before the index was created (run after migration 0003).
+"""
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from preupg.ui.report import search
+
+
+class Command(NoArgsCommand):
+    help = 'Index titles, logs and risks of imported results for search.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--all', action='store_true', dest='all', default=False,
+                    help='Index again also results which are indexed already.'),
+    )
+
+    def handle_noargs(self, **options):
+        search.create_index()
+        result_ids = search.unindexed_results(options['all'])
+        for result_id in result_ids:
+            search.index_result(result_id)
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write('Indexed %d results.' % len(result_ids))
@@ -5,14 +5,21 @@ from django.db.models import Q
 from django.db.models.aggregates import Count
 from django.http.response import Http404
 import os
+import sys
+import json
 import datetime
 
 from django.db import models
+from django.db.models.signals import post_syncdb
 from django.conf import settings
+from django.core.urlresolvers import reverse
 from preupg.ui.config.models import AppSettings
 from preupg.ui.utils.enum import Enum
 from shutil import rmtree
 
+from . import rendercache
+from . import search as search_index
+
 
 class OS(models.Model):
     RHEL5 = 5
@@ -96,11 +103,16 @@ class TestGroup(models.Model):
     title = models.CharField(max_length=255, db_index=True)
     xccdf_id = models.CharField(max_length=128)
     parent = models.ForeignKey('self', blank=True, null=True)
+    # groups are shared by results of the same set of modules, see
+    # ReportImporter._add_to_db
+    module_set = models.CharField(max_length=40, blank=True, null=True)
+    content_hash = models.CharField(max_length=40, blank=True, null=True)
 
     objects = TestGroupManager()
 
     class Meta:
         ordering = ('title', )
+        unique_together = ('module_set', 'xccdf_id', 'content_hash')
 
     def __unicode__(self):
         if self.parent:
@@ -124,7 +136,8 @@ class TestGroupResultMixin(object):
         return self.filter(result=result)
 
     def search_in_title(self, query_string):
-        return self.filter(group__title__icontains=query_string)
+        condition, params = search_index.matching_titles(query_string, search_index.GROUP)
+        return self.extra(where=[condition], params=params)
 
     def root(self):
         return self.filter(parent__isnull=True)
@@ -194,7 +207,7 @@ class RunMixin(object):
     def create_for_host(self, host):
         run = Run()
         run.save()
-        HostRun.objects.create(host=host, run=run)
+        HostRun.objects.create(host=host, run=run, dt_submitted=run.dt_submitted)
         return run
 
     def bulk_create_for_run(self, hosts):
@@ -205,7 +218,7 @@ class RunMixin(object):
         run.save()
         hostrun_list = []
         for host in hosts:
-            hostrun_list.append(HostRun(host=host, run=run))
+            hostrun_list.append(HostRun(host=host, run=run, dt_submitted=run.dt_submitted))
 
         HostRun.objects.bulk_create(hostrun_list)
         return run
@@ -308,6 +321,22 @@ class HostRunMixin(object):
     def by_hosts_processed(self, hosts):
         return self.filter(result__hostname__in=hosts)
 
+    def search(self, text):
+        """ hostruns which results contain text in titles, logs or risks """
+        condition, params = search_index.matching_hostruns(text)
+        return self.extra(where=[condition], params=params)
+
+    def after(self, dt_submitted, hostrun_id):
+        """ hostruns following provided key in the default ordering """
+        return self.filter(Q(dt_submitted__lt=dt_submitted) |
+                           Q(dt_submitted=dt_submitted, id__lt=hostrun_id))
+
+    def before(self, dt_submitted, hostrun_id):
+        """ hostruns preceding provided key, the nearest first """
+        return self.filter(Q(dt_submitted__gt=dt_submitted) |
+                           Q(dt_submitted=dt_submitted, id__gt=hostrun_id)
+                           ).order_by('dt_submitted', 'id')
+
 
 class HostRunQuerySet(models.query.QuerySet, HostRunMixin):
     pass
@@ -329,6 +358,9 @@ class HostRun(models.Model):
         (RUNNING, 'running', 'Scan is active.'),
         (FINISHED, 'finished', 'Scan has finished.'),
     ])
+    CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+    # copy of run.dt_submitted, so hostruns are listed without join
+    dt_submitted = models.DateTimeField(default=datetime.datetime.now)
     dt_finished = models.DateTimeField(blank=True, null=True)
     host = models.ForeignKey(Host)
     run = models.ForeignKey(Run)
@@ -341,12 +373,24 @@ class HostRun(models.Model):
         return u"%s %s %s" % (self.get_state_display(), self.host, self.run)
 
     class Meta:
-        ordering = ('-run__dt_submitted', )
+        ordering = ('-dt_submitted', '-id')
+        index_together = [('dt_submitted', 'id')]
 
     @property
     def running(self):
         return self.state == self.RUNNING
 
+    @property
+    def cursor(self):
+        """ position of hostrun in the list of runs, see RunsView """
+        return "%s_%d" % (self.dt_submitted.strftime(self.CURSOR_FORMAT), self.id)
+
+    @classmethod
+    def parse_cursor(cls, cursor):
+        """ return (dt_submitted, id) from cursor, raise ValueError if invalid """
+        dt_submitted, hostrun_id = cursor.split('_')
+        return datetime.datetime.strptime(dt_submitted, cls.CURSOR_FORMAT), int(hostrun_id)
+
     @property
     def finished(self):
         return self.state == self.FINISHED
@@ -390,10 +434,15 @@ class Result(models.Model):
     failed_test_count = models.SmallIntegerField(blank=True, null=True)
     ni_test_count = models.SmallIntegerField(blank=True, null=True)
     na_test_count = models.SmallIntegerField(blank=True, null=True)
+    # JSON {state: count} of test results, stored during import
+    state_counts = models.TextField(blank=True, null=True)
 
     def delete(self):
         result_dir = self.get_result_dir()
+        result_id = self.id
         super(Result, self).delete()
+        rendercache.invalidate(result_id)
+        search_index.remove_result(result_id)
         rmtree(result_dir)
 
     def __unicode__(self):
@@ -413,13 +462,19 @@ class Result(models.Model):
     def results(self):
         return self.testresult_set.all()
 
+    def get_state_counts(self):
+        """ return {state: count} of test results """
+        if self.state_counts:
+            return json.loads(self.state_counts)
+        counts = TestResult.objects.for_result(self).count_states()
+        return dict((r['state'], r['count']) for r in counts)
+
     def status_text(self):
         result = []
-        results_dict = TestResult.objects.for_result(self).count_states()
-        for test in results_dict:
+        for state, count in sorted(self.get_state_counts().items()):
             test_print = "%s (%d)" % (
-                TestResult.TEST_STATES.display(test['state']),
-                test['count'],
+                TestResult.TEST_STATES.display(state),
+                count,
             )
             result.append(test_print)
         return ', '.join(result)
@@ -436,10 +491,10 @@ class Result(models.Model):
 
         result = {}
 
-        for r in TestResult.objects.for_result(self).count_states():
-            printable_state = TestResult.TEST_STATES.display(r['state'])
-            print_text = "%s (%d)" % (printable_state, r['count'])
-            result[TestResult.TEST_STATES[r['state']]] = print_text
+        for state, count in self.get_state_counts().items():
+            printable_state = TestResult.TEST_STATES.display(state)
+            print_text = "%s (%d)" % (printable_state, count)
+            result[TestResult.TEST_STATES[state]] = print_text
             # e.g. {'fixed': 'Fixed (8)'}
         return result
 
@@ -486,10 +541,18 @@ class Test(models.Model):
     # script for fixing
     fix = models.TextField(null=True, blank=True)
     fix_type = models.CharField(max_length=32, null=True, blank=True)
+    # links to files of result are stored as __INSERT_URL__, see TestResult.fixtext
     fixtext = models.TextField(null=True, blank=True)
     group = models.ForeignKey(TestGroup, blank=True, null=True)
+    # tests are shared by results of the same set of modules, see
+    # ReportImporter._add_to_db
+    module_set = models.CharField(max_length=40, blank=True, null=True)
+    content_hash = models.CharField(max_length=40, blank=True, null=True)
     objects = TestManager()
 
+    class Meta:
+        unique_together = ('module_set', 'id_ref', 'content_hash')
+
     def __unicode__(self):
         return u"%s %s" % (self.id_ref, self.title)
 
@@ -518,7 +581,8 @@ class TestResultMixin(object):
         return self.filter(group=group)
 
     def search_in_title(self, search_string):
-        return self.filter(test__title__icontains=search_string)
+        condition, params = search_index.matching_titles(search_string, search_index.TEST)
+        return self.extra(where=[condition], params=params)
 
     def for_result(self, result):
         return self.filter(group__result=result)
@@ -527,6 +591,10 @@ class TestResultMixin(object):
         """ return states with counts for current query """
         return self.values('state').annotate(count=Count('state'))
 
+    def count_group_states(self):
+        """ return (group, state) pairs with counts for current query """
+        return self.values('group', 'state').annotate(count=Count('state')).order_by()
+
 
 class TestResultQuerySet(models.query.QuerySet, TestResultMixin):
     pass
@@ -601,11 +669,18 @@ class TestResult(models.Model):
     def should_display_solution(self):
         return self.get_state() not in ['pass', 'notapplicable']
 
+    def fixtext(self):
+        """ solution text of test with links to files of this result """
+        if not self.test.fixtext:
+            return self.test.fixtext
+        return self.test.fixtext.replace('__INSERT_URL__',
+                                         reverse('show-file', args=(self.result_id,)))
+
 
 class TestLogMixin(object):
-    def bulk_create_logs(self, testlogs, result):
+    def build_logs(self, testlogs, result):
         """
-        create hostruns for list of hosts specified as Query in variable hosts
+        return unsaved TestLog objects for list of dicts in variable testlogs
         """
         testlog_list = []
         keys = ['date', 'level', 'message']
@@ -615,7 +690,13 @@ class TestLogMixin(object):
             tl = TestLog(**testlog_dict)
             tl.result = result
             testlog_list.append(tl)
-        TestLog.objects.bulk_create(testlog_list)
+        return testlog_list
+
+    def bulk_create_logs(self, testlogs, result):
+        """
+        create testlogs in bulk: testlogs is a list of dicts
+        """
+        TestLog.objects.bulk_create(self.build_logs(testlogs, result))
 
 
 class TestLogQuerySet(models.query.QuerySet, TestLogMixin):
@@ -647,9 +728,9 @@ class RiskMixin(object):
             risks_or |= Q(level=r)
         return self.filter(result__group__result__hostrun=hostrun).filter(risks_or)
 
-    def bulk_create_logs(self, risks, result):
+    def build_logs(self, risks, result):
         """
-        create risk objects in bulk: risks is a list of dicts
+        return unsaved Risk objects for list of dicts in variable risks
         """
         risks_list = []
 
@@ -657,7 +738,13 @@ class RiskMixin(object):
             tl = Risk(message=risk['message'], level=risk['level'].lower())
             tl.result = result
             risks_list.append(tl)
-        Risk.objects.bulk_create(risks_list)
+        return risks_list
+
+    def bulk_create_logs(self, risks, result):
+        """
+        create risk objects in bulk: risks is a list of dicts
+        """
+        Risk.objects.bulk_create(self.build_logs(risks, result))
 
 
 class RiskQuerySet(models.query.QuerySet, RiskMixin):
@@ -685,3 +772,9 @@ class Risk(models.Model):
 
     def __unicode__(self):
         return u"%s %s" % (self.level, self.message)
+
+
+def create_search_index(sender, **kwargs):
+    search_index.create_index()
+
+post_syncdb.connect(create_search_index, sender=sys.modules[__name__])
@@ -86,8 +86,8 @@ class XMLReportParser(object):
         self.path = report_path
         # data structure with every information
         self.run = {'groups': [], }
-        # 'symlink' to rules
-        self.rules = []
+        # index of rules: id_ref -> test
+        self.rules = {}
         # everyone loves XML
         self.element_prefix = "{http://checklists.nist.gov/xccdf/1.2}"
 
@@ -120,65 +120,21 @@ class XMLReportParser(object):
         return ''
 
     def get_test(self, key):
-        """ this may throw IndexError if test is not in self.run """
-        #try:
-        return filter(lambda x: x['id_ref'] == key, self.rules)[0]
-        #except IndexError:
-        #    return ''
-
-    def parse_rules(self, root):
-        if root is None:
-            return []
-        rules = []
-        for rule in self.filter_grandchildren(root, 'Group', 'Rule'):
-            test = {}
-            test['id_ref'] = rule.attrib['id']
-            set_if_true(test, 'title', self.get_nodes_text(rule, 'title'))
-            set_if_true(test, 'description',
-                        stringify_children(self.get_child(rule, 'description')))
-            set_if_true(test, 'fix', self.get_nodes_text(rule, 'fix'))
-            set_if_true(test, 'fixtext', stringify_children(self.get_child(rule, 'fixtext')))
-            set_if_true(test, 'fix_type',
-                        self.get_nodes_atrib(rule, 'fix', 'system'))
-            rules.append(test)
-            self.rules.append(test)
-        return rules
-
-    def parse_groups(self, root, parent=None):
-        """
-        parse groups (sets of tests)
-
-        This method is probably most tricky. It iterates over all groups recursively.
-        If there is grandchild <Rule> it will extract rules.
-        If there is grandchild <Group> it will recursively process it.
-        """
-        def has_grandchild(root_elem, parent_tag, tag):
-            g = self.filter_grandchildren(root_elem, parent_tag, tag)
-            return len(g) > 0
-
-        groups = self.filter_children(root, 'Group')
-
-        # top level groups
-        for group in groups:
-            if parent and not self.has_children(group, 'Group'):
-                # ^this is tricky, we are facing situation where this group is not root group;
-                # the problem is, that every rule has its own group so we need
-                # to filter only groups which have new unprocessed tests
-                continue
-            group_dict = {}
-            group_dict['xccdf_id'] = group.attrib['id']
-            group_dict['title'] = self.get_nodes_text(group, 'title')
-            set_if_true(group_dict, 'parent', parent)
-            group_dict.setdefault('rules', [])
-
-            if has_grandchild(group, 'Group', 'Rule'):
-                group_dict['rules'] = self.parse_rules(group)
-
-            self.run['groups'].append(group_dict)
-            # THIS HAS TO BE AFTER ADDITION OF CURRENT GROUP (chicken-egg problem)
-            if has_grandchild(group, 'Group', 'Group'):
-                self.parse_groups(group, group_dict['xccdf_id'])
-
+        """ this may throw KeyError if test is not in self.run """
+        return self.rules[key]
+
+    def parse_rule(self, rule):
+        """ extract test from <Rule> element """
+        test = {}
+        test['id_ref'] = rule.attrib['id']
+        set_if_true(test, 'title', self.get_nodes_text(rule, 'title'))
+        set_if_true(test, 'description',
+                    stringify_children(self.get_child(rule, 'description')))
+        set_if_true(test, 'fix', self.get_nodes_text(rule, 'fix'))
+        set_if_true(test, 'fixtext', stringify_children(self.get_child(rule, 'fixtext')))
+        set_if_true(test, 'fix_type',
+                    self.get_nodes_atrib(rule, 'fix', 'system'))
+        return test
 
     def parse_test_result_logs(self, text):
         """
@@ -237,38 +193,35 @@ class XMLReportParser(object):
         parsed_logs, parsed_risks = self.parse_test_result_logs(text)
         return parsed_logs, parsed_risks
 
-    def parse_rule_results(self, root):
-        """ parse info about each test result """
-        # element.iter is not on python-2.6
-        #for result in root.iter(self.element_prefix + 'rule-result'):
-        for result in root.findall('.//' + self.element_prefix + 'rule-result'):
-            result_state = self.get_nodes_text(result, 'result')
-            idref = result.attrib['idref']
-            if result_state in ['error', 'notchecked']:
-                logger.error("Test %s crashed.", idref)
-            if result_state not in ['notselected']:
-                try:
-                    test = self.get_test(idref)
-                except IndexError:
-                    logger.error("Test %s not found", idref)
-                else:
-                    set_if_true(test, 'result', result_state)
-                    set_if_true(test, 'time', result.attrib['time'])
-
-                    # test logs are in element check/check-import[@import-name=stdout]
-                    check_elem = self.get_child(result, 'check')
-                    if check_elem is not None:
-                        parsed_logs, parsed_risks = self.get_test_result_logs(check_elem)
-                        set_if_true(test, 'logs', parsed_logs)
-                        set_if_true(test, 'risks', parsed_risks)
-
-    def process_run_info(self, root):
-        """ get information about run and info about host """
-        tr = self.get_child(root, 'TestResult')
+    def parse_rule_result(self, result):
+        """ parse info about test result from <rule-result> element """
+        result_state = self.get_nodes_text(result, 'result')
+        idref = result.attrib['idref']
+        if result_state in ['error', 'notchecked']:
+            logger.error("Test %s crashed.", idref)
+        if result_state in ['notselected']:
+            return
+        try:
+            test = self.get_test(idref)
+        except KeyError:
+            logger.error("Test %s not found", idref)
+            return
+        set_if_true(test, 'result', result_state)
+        set_if_true(test, 'time', result.attrib['time'])
+
+        # test logs are in element check/check-import[@import-name=stdout]
+        check_elem = self.get_child(result, 'check')
+        if check_elem is not None:
+            parsed_logs, parsed_risks = self.get_test_result_logs(check_elem)
+            set_if_true(test, 'logs', parsed_logs)
+            set_if_true(test, 'risks', parsed_risks)
+
+    def process_run_info(self, tr):
+        """ get information about run and info about host from <TestResult> """
         self.run['host'] = self.get_nodes_text(tr, 'target')
         self.run['identity'] = self.get_nodes_text(tr, 'identity')
         self.run['addresses'] = []
-        if tr:
+        if tr is not None and len(tr):
             for address in get_nodes(tr, 'target-address', self.element_prefix):
                 self.run['addresses'].append(address.text)
             self.run['started'] = tr.attrib['start-time']
@@ -277,12 +230,68 @@ class XMLReportParser(object):
         logger.debug("Host: %s, Identity: %s", self.run['host'], self.run['identity'])
 
     def parse_report(self):
-        """ parse XML report """
-        root = ElementTree.parse(self.path).getroot()
-        # rules & groups first
-        self.parse_groups(root)
-        self.parse_rule_results(root)
-        self.process_run_info(root)
+        """
+        parse XML report
+
+        The report is read by iterparse and each <Rule> and <rule-result>
+        is processed and cleared as soon as it is read, so memory does not
+        grow with size of the logs stored in the report.
+
+        Every module is a group with just one rule. Such groups are not
+        stored; their rules belong to the parent group. Groups are stored
+        in document order with 'parent' set to xccdf_id of their parent group.
+        """
+        group_tag = self.element_prefix + 'Group'
+        rule_tag = self.element_prefix + 'Rule'
+        rule_result_tag = self.element_prefix + 'rule-result'
+        test_result_tag = self.element_prefix + 'TestResult'
+
+        # stack of group frames: [group_dict, has_subgroup]
+        stack = []
+        # all groups in document order, the ones without subgroups
+        # are filtered out at the end
+        frames = []
+        depth = 0
+        test_result_found = False
+        for event, elem in ElementTree.iterparse(self.path, events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                if elem.tag == group_tag:
+                    if stack:
+                        stack[-1][1] = True
+                    group_dict = {'xccdf_id': elem.attrib['id'], 'rules': []}
+                    if stack:
+                        group_dict['parent'] = stack[-1][0]['xccdf_id']
+                    frame = [group_dict, False, len(stack) == 0]
+                    stack.append(frame)
+                    frames.append(frame)
+                continue
+
+            depth -= 1
+            if elem.tag == group_tag:
+                frame = stack.pop()
+                frame[0]['title'] = self.get_nodes_text(elem, 'title')
+                elem.clear()
+            elif elem.tag == rule_tag:
+                test = self.parse_rule(elem)
+                # rules are collected by the group above the module group
+                if len(stack) >= 2:
+                    stack[-2][0]['rules'].append(test)
+                    self.rules[test['id_ref']] = test
+                elem.clear()
+            elif elem.tag == rule_result_tag:
+                self.parse_rule_result(elem)
+                elem.clear()
+            elif elem.tag == test_result_tag and depth == 1 and not test_result_found:
+                test_result_found = True
+                self.process_run_info(elem)
+                elem.clear()
+
+        if not test_result_found:
+            self.process_run_info(None)
+        # top level groups and groups with subgroups
+        self.run['groups'] = [frame[0] for frame in frames
+                              if frame[2] or frame[1]]
         return self.run
 
 
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of rendered results for ResultViewAjax
+
+Imported result doesn't change, so the rendered tree is stored in cache
+settings.RESULT_CACHE under key made of result ID, displayed states and
+parameters of the request (searched string, states chosen in the form).
+Every key contains also a version of the result which is dropped by
+invalidate(), e.g. when the result is deleted or imported again; entries
+of old versions are never read and expire or are culled by the cache
+backend (see MAX_ENTRIES of the cache).
+
+The cache has to be shared by all processes of the web server, so it is
+stored in files by LRUFileBasedCache. Django's FileBasedCache culls a
+random part of entries when MAX_ENTRIES is reached, this one culls the
+least recently read ones.
+"""
+
+import hashlib
+import os
+import uuid
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.cache.backends.filebased import FileBasedCache
+
+
+class LRUFileBasedCache(FileBasedCache):
+    """
+    FileBasedCache which culls least recently used entries; modification
+    time of entry's file is its last access
+    """
+
+    def get(self, key, default=None, version=None):
+        value = super(LRUFileBasedCache, self).get(key, default, version)
+        if value is not default:
+            try:
+                os.utime(self._key_to_file(self.make_key(key, version=version)), None)
+            except OSError:
+                pass
+        return value
+
+    def _cull(self):
+        entries = []
+        for root, dummy_dirs, files in os.walk(self._dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    entries.append((os.path.getmtime(path), path))
+                except OSError:
+                    pass
+        if len(entries) < self._max_entries:
+            return
+        if self._cull_frequency == 0:
+            count = len(entries)
+        else:
+            count = max(len(entries) // self._cull_frequency,
+                        len(entries) - self._max_entries + 1)
+        for dummy_mtime, path in sorted(entries)[:count]:
+            try:
+                self._delete(path)
+            except OSError:
+                pass
+
+
+def get_result_cache():
+    return get_cache(settings.RESULT_CACHE)
+
+
+def _version_key(result_id):
+    return 'result-version-%s' % result_id
+
+
+def get_version(result_id):
+    """ return current version of cached renders of result """
+    cache = get_result_cache()
+    version = cache.get(_version_key(result_id))
+    if version is None:
+        # add() keeps the version set by concurrent request
+        cache.add(_version_key(result_id), uuid.uuid4().hex)
+        version = cache.get(_version_key(result_id))
+    return version
+
+
+def make_key(result_id, states, query):
+    """
+    states -- list of displayed states; query -- GET parameters of the
+    request (they contain searched string and states chosen in the form)
+    """
+    data = '%s|%s|%s' % (result_id, ','.join(sorted(states)),
+                         '&'.join('%s=%s' % item for item in sorted(query.items())))
+    return 'result-%s-%s-%s' % (result_id, get_version(result_id),
+                                hashlib.sha1(data.encode('utf-8')).hexdigest())
+
+
+def get_rendered(key):
+    return get_result_cache().get(key)
+
+
+def set_rendered(key, content):
+    """ content bigger than settings.RESULT_CACHE_MAX_SIZE is not cached """
+    if len(content) <= settings.RESULT_CACHE_MAX_SIZE:
+        get_result_cache().set(key, content)
+
+
+def invalidate(result_id):
+    """ drop all cached renders of result """
+    get_result_cache().delete(_version_key(result_id))
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Full-text index of titles, logs and risk messages of all results
+
+The index is table report_search with rows (text, kind, result_id,
+item_id), filled by ReportImporter for each imported result; item_id is
+ID of test result (or of group result for titles of groups). On
+SQLite it is an FTS5 (or FTS4) virtual table and searched words are
+matched as a phrase. Other databases get a plain table searched by LIKE
+like icontains lookup does; on PostgreSQL it has a trigram index when
+pg_trgm extension is installed.
+"""
+
+import logging
+
+from django.db import connection, transaction, DatabaseError
+
+
+logger = logging.getLogger('preup_ui')
+
+TABLE = 'report_search'
+
+TEST = 'test'
+GROUP = 'group'
+LOG = 'log'
+RISK = 'risk'
+
+# rows of the index for one result: (text, kind, result_id, item_id)
+INDEX_QUERIES = [
+    # titles of tests
+    "SELECT t.title, '" + TEST + "', g.result_id, tr.id FROM report_testresult tr"
+    " JOIN report_test t ON t.id = tr.test_id"
+    " JOIN report_testgroupresult g ON g.id = tr.group_id WHERE g.result_id = %s",
+    # titles of groups
+    "SELECT tg.title, '" + GROUP + "', g.result_id, g.id FROM report_testgroupresult g"
+    " JOIN report_testgroup tg ON tg.id = g.group_id WHERE g.result_id = %s",
+    # logs of tests
+    "SELECT l.message, '" + LOG + "', g.result_id, tr.id FROM report_testlog l"
+    " JOIN report_testresult tr ON tr.id = l.result_id"
+    " JOIN report_testgroupresult g ON g.id = tr.group_id WHERE g.result_id = %s",
+    # risks of tests
+    "SELECT r.message, '" + RISK + "', g.result_id, tr.id FROM report_risk r"
+    " JOIN report_testresult tr ON tr.id = r.result_id"
+    " JOIN report_testgroupresult g ON g.id = tr.group_id WHERE g.result_id = %s",
+]
+
+
+def _commit():
+    # raw queries are not committed by Django < 1.6 on its own
+    if hasattr(transaction, 'commit_unless_managed'):
+        transaction.commit_unless_managed()
+
+
+# is the index a full-text table? by name of the database
+_full_text = {}
+
+
+def _is_full_text():
+    name = connection.settings_dict['NAME']
+    if name not in _full_text:
+        full_text = False
+        if connection.vendor == 'sqlite':
+            cursor = connection.cursor()
+            cursor.execute("SELECT sql FROM sqlite_master WHERE name = %s", [TABLE])
+            row = cursor.fetchone()
+            full_text = bool(row) and 'VIRTUAL' in row[0].upper()
+        _full_text[name] = full_text
+    return _full_text[name]
+
+
+def create_index(commit=True):
+    """
+    create the table of the index, if it doesn't exist; commit=False
+    leaves the transaction open (e.g. in migration)
+    """
+    _full_text.pop(connection.settings_dict['NAME'], None)
+    cursor = connection.cursor()
+    if connection.vendor == 'sqlite':
+        statements = [
+            "CREATE VIRTUAL TABLE IF NOT EXISTS " + TABLE + " USING fts5"
+            "(text, kind UNINDEXED, result_id UNINDEXED, item_id UNINDEXED)",
+            "CREATE VIRTUAL TABLE IF NOT EXISTS " + TABLE + " USING fts4"
+            "(text, kind, result_id, item_id,"
+            " notindexed=kind, notindexed=result_id, notindexed=item_id)",
+        ]
+        for statement in statements:
+            try:
+                cursor.execute(statement)
+            except DatabaseError:
+                # the module is not compiled in SQLite
+                continue
+            if commit:
+                _commit()
+            return
+    if TABLE in connection.introspection.table_names():
+        return
+    cursor.execute("CREATE TABLE " + TABLE + " (text TEXT, kind VARCHAR(8),"
+                   " result_id INTEGER, item_id INTEGER)")
+    cursor.execute("CREATE INDEX " + TABLE + "_result ON " + TABLE + " (result_id)")
+    if connection.vendor == 'postgresql':
+        cursor.execute("SELECT COUNT(*) FROM pg_extension WHERE extname = 'pg_trgm'")
+        if cursor.fetchone()[0]:
+            # the same expression as in condition of icontains, see _match
+            cursor.execute("CREATE INDEX " + TABLE + "_text ON " + TABLE +
+                           " USING gin (UPPER(text) gin_trgm_ops)")
+        else:
+            logger.warning("Extension pg_trgm is not installed, search is not indexed.")
+    if commit:
+        _commit()
+
+
+def remove_result(result_id):
+    """ drop result from the index """
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM " + TABLE + " WHERE result_id = %s", [result_id])
+    _commit()
+
+
+def index_result(result_id):
+    """ (re)index titles, logs and risks of result """
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM " + TABLE + " WHERE result_id = %s", [result_id])
+    for query in INDEX_QUERIES:
+        cursor.execute("INSERT INTO " + TABLE + " (text, kind, result_id, item_id) "
+                       + query, [result_id])
+    _commit()
+
+
+def unindexed_results(reindex=False):
+    """ return IDs of results without rows in the index (or of all results) """
+    query = "SELECT id FROM report_result"
+    if not reindex:
+        query += " WHERE id NOT IN (SELECT result_id FROM " + TABLE + ")"
+    cursor = connection.cursor()
+    cursor.execute(query + " ORDER BY id")
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _match(text):
+    """ return SQL condition and its params matching text """
+    if _is_full_text():
+        return TABLE + " MATCH %s", ['"%s"' % text.replace('"', '""')]
+    # % and _ in text are escaped
+    column = connection.ops.lookup_cast('icontains') % (TABLE + '.text')
+    return (column + ' ' + connection.operators['icontains'],
+            ['%' + connection.ops.prep_for_like_query(text) + '%'])
+
+
+def search(text, kinds=None):
+    """
+    return list of (kind, result_id, item_id, text) matching text,
+    kinds limits kinds of indexed texts
+    """
+    condition, params = _match(text)
+    query = ("SELECT kind, result_id, item_id, text FROM " + TABLE +
+             " WHERE " + condition)
+    if kinds:
+        query += " AND kind IN (%s)" % ', '.join(['%s'] * len(kinds))
+        params.extend(kinds)
+    cursor = connection.cursor()
+    cursor.execute(query + " ORDER BY result_id, item_id", params)
+    return cursor.fetchall()
+
+
+def matching_hostruns(text):
+    """
+    return SQL condition and params matching ID of hostrun which result
+    contains text, see HostRunMixin.search
+    """
+    condition, params = _match(text)
+    return ("report_hostrun.id IN (SELECT hostrun_id FROM report_result WHERE id IN"
+            " (SELECT result_id FROM " + TABLE + " WHERE " + condition + "))"), params
+
+
+def matching_titles(text, kind):
+    """
+    return SQL condition and params matching ID of test results (kind
+    TEST) or group results (kind GROUP) which title contains text, see
+    search_in_title of TestResultMixin and TestGroupResultMixin
+    """
+    condition, params = _match(text)
+    column = {TEST: 'report_testresult.id', GROUP: 'report_testgroupresult.id'}[kind]
+    return (column + " IN (SELECT item_id FROM " + TABLE + " WHERE kind = %s AND " +
+            condition + ")"), [kind] + params
+
+
+def hosts_logged(text):
+    """
+    return list of (hostname, result_id, count of matching messages) of
+    results which logged text in logs or risks of tests, across all hosts
+    """
+    condition, params = _match(text)
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT report_result.hostname, report_result.id, COUNT(*) FROM " + TABLE +
+        " JOIN report_result ON report_result.id = " + TABLE + ".result_id"
+        " WHERE " + condition + " AND " + TABLE + ".kind IN (%s, %s)"
+        " GROUP BY report_result.id, report_result.hostname"
+        " ORDER BY report_result.hostname, report_result.id", params + [LOG, RISK])
+    return cursor.fetchall()
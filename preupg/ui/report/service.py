@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
+import json
 import logging
 import os
 import datetime
@@ -8,20 +10,34 @@ import shutil
 
 from .models import Test, TestResult, HostRun, Result, Address, TestLog, TestGroup, TestGroupResult
 from .models import Risk
+from . import rendercache
+from . import search
 
 from processing import parse_xml_report, update_html_report
 
-from django.db import transaction
+from django.db import connection, transaction, IntegrityError
+from django.db.models import F, AutoField
 from django.conf import settings
 from django.shortcuts import get_object_or_404
-from django.core.urlresolvers import reverse
 
 
 DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
 
+# counters of groups and results: (field, state of test result)
+STATS_STATES = [
+    ('failed_test_count', TestResult.FAILURE),
+    ('ni_test_count', TestResult.NEEDS_INSPECTION),
+    ('na_test_count', TestResult.NEEDS_ACTION),
+]
+
 logger = logging.getLogger('preup_ui')
 
 
+def content_hash(*values):
+    """ return SHA1 digest of JSON serializable values """
+    return hashlib.sha1(json.dumps(values, sort_keys=True).encode('utf-8')).hexdigest()
+
+
 def filter_files_by_ext(tar_content, ext, error_msg):
     try:
         return filter(lambda x: x.name.endswith(ext) and x.name.count('/') <= 1, tar_content)[0]
@@ -88,9 +104,8 @@ class ReportImporter(object):
         self.html_path = None
 
     def _create_result(self):
-        result = Result()
-        result.hostrun = self.hostrun
-        result.save()
+        # result of queued import is created during upload
+        result, dummy_created = Result.objects.get_or_create(hostrun=self.hostrun)
         return result
 
     def _update_result(self):
@@ -111,49 +126,204 @@ class ReportImporter(object):
     def _process_tarball(self):
         xml_path, html_path = extract_tarball(self.tb_path, self.result.get_result_dir())
         self.html_path = html_path
-        remove_upload(self.tb_path)
         update_html_report(self.html_path)
         return parse_xml_report(xml_path)
 
+    @staticmethod
+    def _bulk_create(objects, queryset, key_fields):
+        """
+        insert objects with one bulk_create and assign their primary keys
+
+        bulk_create does not set primary keys on most backends, so they are
+        read back from queryset by key_fields -- values of the fields have
+        to identify each inserted object among the rows of queryset; keys
+        are never guessed from order of the rows, other imports may insert
+        to the same tables at the same time
+        """
+        if not objects:
+            return objects
+        model = objects[0].__class__
+        model.objects.bulk_create(objects)
+        if objects[0].pk is None:
+            attnames = [model._meta.get_field(field).attname for field in key_fields]
+            pks = {}
+            for row in queryset.values_list('pk', *key_fields):
+                pks.setdefault(row[1:], []).append(row[0])
+            for obj in objects:
+                key = tuple(getattr(obj, attname) for attname in attnames)
+                found = pks.get(key, [])
+                if len(found) != 1:
+                    raise Exception('Unable to read back key of inserted %s object %s.'
+                                    % (model.__name__, key))
+                obj.pk = found[0]
+        return objects
+
+    @staticmethod
+    def _get_or_create(obj, queryset, key_fields):
+        """ insert obj unless its natural key exists, then take its primary key """
+        lookup = dict((field, getattr(obj, field)) for field in key_fields)
+        existing = list(queryset.filter(**lookup).values_list('pk', flat=True))
+        if existing:
+            obj.pk = existing[0]
+            return
+        sid = transaction.savepoint()
+        try:
+            obj.save(force_insert=True)
+        except IntegrityError:
+            # inserted by another import meanwhile
+            transaction.savepoint_rollback(sid)
+            obj.pk = queryset.get(**lookup).pk
+        else:
+            transaction.savepoint_commit(sid)
+
+    @classmethod
+    def _create_definitions(cls, objects, queryset, key_fields):
+        """
+        insert shared definitions of groups or tests, key_fields are their
+        natural key (unique together with module set, the last one is
+        content hash)
+
+        another import of the same modules may insert some of them after
+        they were looked up, so the objects are inserted in batches of one
+        INSERT statement each and rows existing right before the batch are
+        reused; when the batch still violates the unique constraint, its
+        objects are inserted one by one with get-or-create by the natural
+        key -- savepoints do nothing on SQLite, but there a failed statement
+        does not leave any of its rows
+        """
+        if not objects:
+            return objects
+        model = objects[0].__class__
+        fields = [field for field in model._meta.local_fields
+                  if not isinstance(field, AutoField)]
+        batch_size = max(connection.ops.bulk_batch_size(fields, objects), 1)
+        for start in range(0, len(objects), batch_size):
+            batch = objects[start:start + batch_size]
+            existing = {}
+            rows = queryset.filter(**{key_fields[-1] + '__in': [getattr(obj, key_fields[-1])
+                                                                for obj in batch]})
+            for row in rows.values_list('pk', *key_fields):
+                existing[row[1:]] = row[0]
+            new = []
+            for obj in batch:
+                key = tuple(getattr(obj, field) for field in key_fields)
+                if key in existing:
+                    obj.pk = existing[key]
+                else:
+                    new.append(obj)
+            sid = transaction.savepoint()
+            try:
+                cls._bulk_create(new, queryset, key_fields)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                for obj in new:
+                    obj.pk = None
+                    cls._get_or_create(obj, queryset, key_fields)
+            else:
+                transaction.savepoint_commit(sid)
+        return objects
+
+    def _get_module_set(self):
+        """
+        return identity of the set of modules which generated the report --
+        digest of ids of its groups and rules in document order
+        """
+        return content_hash([(group['xccdf_id'], group.get('parent'),
+                              [rule['id_ref'] for rule in group['rules']])
+                             for group in self.parsed_data['groups']])
+
     @transaction.commit_on_success
     def _add_to_db(self):
-        """ add data to dabase """
-        for address in self.parsed_data['addresses']:
-            Address(address=address, result=self.result).save()
+        """
+        add data to database
+
+        parents and roots of groups are resolved in memory from the parsed
+        group tree, then every model is inserted with bulk_create in
+        dependency order: groups (level by level), tests, test results and
+        finally their logs and risks
+
+        definitions of groups and tests (titles, descriptions, solutions)
+        are the same for every host checked by the same set of modules, so
+        they are stored once per (module set, id, content hash) and reused
+        by later imports; content hash of a test covers its group and
+        content hash of a group covers its parent
+        """
+        # failed import may be tried again, see importqueue.ImportQueue.process
+        Address.objects.filter(result=self.result).delete()
+        TestGroupResult.objects.for_result(self.result).delete()
+
+        Address.objects.bulk_create([Address(address=address, result=self.result)
+                                     for address in self.parsed_data['addresses']])
 
         test_keys = ['id_ref', 'title', 'description', 'fix', 'fix_type', 'fixtext']
         group_keys = ['xccdf_id', 'title', ]
-        # cache of processed groups -- efficient way of assigning parents
+
+        module_set = self._get_module_set()
+        known_groups = dict(((tg.xccdf_id, tg.content_hash), tg) for tg in
+                            TestGroup.objects.filter(module_set=module_set)
+                            .only('xccdf_id', 'content_hash').order_by())
+        known_tests = dict(((t.id_ref, t.content_hash), t) for t in
+                           Test.objects.filter(module_set=module_set)
+                           .only('id_ref', 'content_hash'))
+
+        # groups are parsed in document order, parent always precedes its children
+        levels = []
+        depths = {}
+        # xccdf_id -> (group, its content hash, group result)
         groups = {}
         for group in self.parsed_data['groups']:
-            group_dict = dict((key, group[key]) for key in group_keys if key in group)
-            if 'parent' in group:
-                group_dict['parent'] = groups[group['parent']][0]
-            tg = TestGroup.objects.create(**group_dict)
-
-            trg = TestGroupResult()
-            trg.group = tg
-            trg.result = self.result
-            if 'parent' in group:
-                trg.parent = groups[group['parent']][1]
-            trg.save()
-            trg.root = trg.get_root()
-
-            # save group and group result
-            groups[group_dict['xccdf_id']] = (tg, trg)
-
+            depth = depths[group['parent']] + 1 if 'parent' in group else 0
+            depths[group['xccdf_id']] = depth
+            if depth == len(levels):
+                levels.append([])
+            levels[depth].append(group)
+
+        for depth, level in enumerate(levels):
+            tgs = []
+            new_tgs = []
+            for group in level:
+                group_dict = dict((key, group[key]) for key in group_keys if key in group)
+                parent_tg, parent_hash = groups[group['parent']][:2] if depth else (None, None)
+                digest = content_hash(sorted(group_dict.items()), parent_hash)
+                tg = known_groups.get((group['xccdf_id'], digest))
+                if tg is None:
+                    tg = TestGroup(parent=parent_tg, module_set=module_set,
+                                   content_hash=digest, **group_dict)
+                    new_tgs.append(tg)
+                tgs.append((tg, digest))
+            self._create_definitions(new_tgs, TestGroup.objects.filter(module_set=module_set),
+                                     ('xccdf_id', 'content_hash'))
+
+            trgs = []
+            for group, (tg, dummy_digest) in zip(level, tgs):
+                trg = TestGroupResult(group=tg, result=self.result)
+                if depth:
+                    trg.parent = groups[group['parent']][2]
+                    trg.root = trg.parent.root
+                trgs.append(trg)
+            self._bulk_create(trgs, TestGroupResult.objects.for_result(self.result), ('group', ))
+            if not depth:
+                # root group is root of itself
+                for trg in trgs:
+                    trg.root = trg
+                TestGroupResult.objects.for_result(self.result).root().update(root=F('pk'))
+
+            for group, (tg, digest), trg in zip(level, tgs, trgs):
+                groups[group['xccdf_id']] = (tg, digest, trg)
+
+        new_tests = []
+        test_results = []
+        for group in self.parsed_data['groups']:
+            tg, group_hash, trg = groups[group['xccdf_id']]
             for rule in group['rules']:
+                # links in fixtext miss id of result, they are completed when
+                # displayed, see report/processing.py stringify_children
                 test_dict = dict((key, rule[key]) for key in test_keys if key in rule)
-                test_dict['group'] = tg
-                try:
-                    # links in fixtext miss id of result, see report/processing.py stringify_children
-                    test_dict['fixtext'] = test_dict['fixtext'].replace(
-                        '__INSERT_URL__',
-                        reverse('show-file', args=(self.result.id,))
-                    )
-                except KeyError:
-                    pass
-                t = Test.objects.create(**test_dict)
+                digest = content_hash(sorted(test_dict.items()), group_hash)
+                t = known_tests.get((rule['id_ref'], digest))
+                if t is None:
+                    t = Test(group=tg, module_set=module_set, content_hash=digest, **test_dict)
+                    new_tests.append(t)
 
                 tr = TestResult()
                 try:
@@ -162,47 +332,74 @@ class ReportImporter(object):
                     # rule wasn't selected probably
                     continue
                 tr.date = datetime.datetime.strptime(rule['time'], DATE_FORMAT)
-                tr.test = t
                 tr.group = trg
                 tr.result = self.result
-                tr.root_group = trg.get_root()
-                tr.save()
-
-                # add logs to DB
-                if 'logs' in rule:
-                    TestLog.objects.bulk_create_logs(rule['logs'], tr)
-                if 'risks' in rule:
-                    Risk.objects.bulk_create_logs(rule['risks'], tr)
-
-    def _calculate_group_stats(self):
-        groups = []
-        def recurs(parent, child):
-            for gch in child.children():
-                recurs(child, gch)
-            child.failed_test_count += TestResult.objects.for_tgr(child).failed().count()
-            child.ni_test_count += TestResult.objects.for_tgr(child).ni().count()
-            child.na_test_count += TestResult.objects.for_tgr(child).na().count()
-            child.test_count += TestResult.objects.for_tgr(child).count()
-            if parent:
-                parent.failed_test_count += child.failed_test_count
-                parent.ni_test_count += child.ni_test_count
-                parent.na_test_count += child.na_test_count
-                parent.test_count += child.test_count
-            groups.append(child)
-
-        for group in self.result.groups:
-            if group in groups:
-                continue
-            recurs(None, group)
-
-        for group in groups:
-            group.save()
-
-    def _calculate_result_stats(self):
-        self.result.test_count = TestResult.objects.for_result(self.result).count()
-        self.result.failed_test_count = TestResult.objects.for_result(self.result).failed().count()
-        self.result.na_test_count = TestResult.objects.for_result(self.result).na().count()
-        self.result.ni_test_count = TestResult.objects.for_result(self.result).ni().count()
+                tr.root_group = trg.root
+                test_results.append((tr, t, rule))
+
+        self._create_definitions(new_tests, Test.objects.filter(module_set=module_set),
+                                 ('id_ref', 'content_hash'))
+        for tr, t, dummy_rule in test_results:
+            # key of the test was not known when the test result was created
+            tr.test = t
+        self._bulk_create([tr for tr, dummy_t, dummy_rule in test_results],
+                          TestResult.objects.filter(result=self.result), ('test', ))
+
+        # add logs to DB
+        logs = []
+        risks = []
+        for tr, dummy_t, rule in test_results:
+            logs.extend(TestLog.objects.build_logs(rule.get('logs', []), tr))
+            risks.extend(Risk.objects.build_logs(rule.get('risks', []), tr))
+        TestLog.objects.bulk_create(logs)
+        Risk.objects.bulk_create(risks)
+
+    def _count_states(self):
+        """
+        return {group result id: {state: count}} of all test results of
+        this result, gathered with one grouped query
+        """
+        counts = {}
+        for row in TestResult.objects.for_result(self.result).count_group_states():
+            counts.setdefault(row['group'], {})[row['state']] = row['count']
+        return counts
+
+    @staticmethod
+    def _set_stats(obj, states):
+        obj.test_count = sum(states.values())
+        for field, state in STATS_STATES:
+            setattr(obj, field, states.get(state, 0))
+
+    def _calculate_group_stats(self, counts):
+        """ sum counts of test states up the tree of group results """
+        groups = dict((group.id, group) for group in self.result.groups)
+        depths = {}
+
+        def depth(group):
+            if group.id not in depths:
+                depths[group.id] = depth(groups[group.parent_id]) + 1 if group.parent_id else 0
+            return depths[group.id]
+
+        totals = dict((group_id, dict(counts.get(group_id, {}))) for group_id in groups)
+        # children go before their parents
+        for group in sorted(groups.values(), key=depth, reverse=True):
+            if group.parent_id:
+                parent_totals = totals[group.parent_id]
+                for state, count in totals[group.id].items():
+                    parent_totals[state] = parent_totals.get(state, 0) + count
+
+        for group in groups.values():
+            self._set_stats(group, totals[group.id])
+            group.save(update_fields=['test_count'] + [field for field, dummy_state in STATS_STATES])
+
+    def _calculate_result_stats(self, counts):
+        states = {}
+        for group_states in counts.values():
+            for state, count in group_states.items():
+                states[state] = states.get(state, 0) + count
+        self._set_stats(self.result, states)
+        # list of runs and state filter don't have to count test results
+        self.result.state_counts = json.dumps(states)
         self.result.save()
 
     def _calculate_stats(self):
@@ -210,14 +407,18 @@ class ReportImporter(object):
         calculate helpful stats functions, like sums
          -- this is best to be done, when everything's in DB
         """
-        self._calculate_group_stats()
-        self._calculate_result_stats()
+        counts = self._count_states()
+        self._calculate_group_stats(counts)
+        self._calculate_result_stats(counts)
 
     def execute_import(self):
         """ execute import itself, this is the main call """
         self.parsed_data = self._process_tarball()
         self._update_result()
         self._add_to_db()
+        # indexed once the import is committed, the index is not part of
+        # its transaction
+        search.index_result(self.result.id)
 
         self.hostrun.set_finished()
         self.hostrun.set_risk()
@@ -225,6 +426,10 @@ class ReportImporter(object):
             self.run.finish()
 
         self._calculate_stats()
+        # the result could be displayed during the import
+        rendercache.invalidate(self.result.id)
+        # kept until the import succeeds, so it can be tried again
+        remove_upload(self.tb_path)
 
 
 def import_report(tb_path, hostrun_id):
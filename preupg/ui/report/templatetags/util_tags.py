@@ -8,3 +8,13 @@ def url_replace(request, field, value):
     dict_ = request.GET.copy()
     dict_[field] = value
     return dict_.urlencode()
+
+
+@register.simple_tag
+def url_page(request, field, value):
+    """ query string of page of keyset pagination, see RunsView """
+    dict_ = request.GET.copy()
+    for key in ('after', 'before'):
+        dict_.pop(key, None)
+    dict_[field] = value
+    return dict_.urlencode()
@@ -1,17 +1,38 @@
 # -*- coding: utf-8 -*-
 
+import os
+import json
+import hashlib
 import shutil
+import tarfile
+import subprocess
 import unittest
 import tempfile
+import xmlrpclib
 import preupg
 
 from xml.etree import ElementTree
 from preupg.application import Application
 from preupg.conf import DummyConf, Conf
 from preupg.ui.report.processing import xml_to_html, stringify_children, parse_xml_report
-from preupg.ui.report.service import extract_tarball
+from preupg.ui.report.models import Host, HostRun, Run, Result, Test, TestGroup, TestGroupResult, TestResult, \
+    TestLog, Risk
+from preupg.ui.report.service import extract_tarball, ReportImporter
+from preupg.ui.report import importqueue
+from preupg.ui.report.importqueue import ImportQueue
+from preupg.ui.xmlrpc import submission
+from preupg.ui.utils.tree import render_result
+from preupg.ui.report.views import ResultViewAjax, RunsView, HostsLoggedView
+from preupg.ui.report import rendercache, search
 
+from django.contrib.auth.models import AnonymousUser
+from django.db import connection, DatabaseError
+from django.http import Http404
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
 
 
 class TestXML(TestCase):
@@ -58,6 +79,512 @@ Text outside tag <html:div>Text <html:em>inside</html:em> tag</html:div> x <b>y<
         self.assertEqual(r3, 'a <y>t<y2>a</y2>y</y>y')
 
 
+NESTED_REPORT = """\
+<?xml version='1.0' encoding='UTF-8'?>
+<Benchmark xmlns="http://checklists.nist.gov/xccdf/1.2" id="b">
+  <Group id="g_a"><title>A</title>
+    <Group id="g_a_b"><title>B</title>
+      <Group id="g_m1"><title>M1</title>
+        <Rule id="r_m1"><title>Rule 1</title></Rule>
+      </Group>
+    </Group>
+    <Group id="g_m2"><title>M2</title>
+      <Rule id="r_m2"><title>Rule 2</title><fix system="urn:x">fixit</fix></Rule>
+    </Group>
+  </Group>
+  <Group id="g_c"><title>C</title>
+    <Group id="g_m3"><title>M3</title><Rule id="r_m3"><title>Rule 3</title></Rule></Group>
+  </Group>
+  <TestResult id="tr" start-time="2016-01-01T10:00:00" end-time="2016-01-01T10:05:00">
+    <target>host1</target><identity>root</identity>
+    <rule-result idref="r_m1" time="2016-01-01T10:01:00"><result>fail</result>
+      <check system="x"><check-import import-name="stderr">preupg.risk.HIGH: danger</check-import></check>
+    </rule-result>
+    <rule-result idref="r_m2" time="2016-01-01T10:02:00"><result>pass</result></rule-result>
+    <rule-result idref="r_m3" time="2016-01-01T10:02:00"><result>notselected</result></rule-result>
+  </TestResult>
+</Benchmark>
+"""
+
+
+class TestXMLReportParser(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.report_path = os.path.join(self.temp_dir, 'result.xml')
+        with open(self.report_path, 'w') as report:
+            report.write(NESTED_REPORT)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_parse_report(self):
+        run = parse_xml_report(self.report_path)
+        self.assertEqual(run['host'], 'host1')
+        self.assertEqual(run['started'], '2016-01-01T10:00:00')
+        groups = [(g['xccdf_id'], g.get('parent'), [r['id_ref'] for r in g['rules']])
+                  for g in run['groups']]
+        self.assertEqual(groups, [('g_a', None, ['r_m2']),
+                                  ('g_a_b', 'g_a', ['r_m1']),
+                                  ('g_c', None, ['r_m3'])])
+        rule_m1 = run['groups'][1]['rules'][0]
+        self.assertEqual(rule_m1['result'], 'fail')
+        self.assertEqual(rule_m1['risks'], [{'level': 'HIGH', 'message': 'danger'}])
+        self.assertEqual(run['groups'][0]['rules'][0]['fix_type'], 'urn:x')
+        self.assertFalse('result' in run['groups'][2]['rules'][0])
+
+
+def create_importer(temp_dir):
+    """ return ReportImporter with parsed NESTED_REPORT """
+    report_path = os.path.join(temp_dir, 'result.xml')
+    with open(report_path, 'w') as report:
+        report.write(NESTED_REPORT)
+    host = Host.objects.create(hostname='host1')
+    run = Run.objects.create_for_host(host)
+    importer = ReportImporter(None, run.first_hostrun().id)
+    importer.parsed_data = parse_xml_report(report_path)
+    return importer
+
+
+class TestReportImporter(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.importer = create_importer(self.temp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_add_to_db(self):
+        self.importer._add_to_db()
+        result = self.importer.result
+        tgrs = dict((tgr.group.xccdf_id, tgr)
+                    for tgr in TestGroupResult.objects.for_result(result))
+        self.assertEqual(sorted(tgrs.keys()), ['g_a', 'g_a_b', 'g_c'])
+        self.assertEqual(tgrs['g_a'].parent, None)
+        self.assertEqual(tgrs['g_a'].root, tgrs['g_a'])
+        self.assertEqual(tgrs['g_a_b'].parent, tgrs['g_a'])
+        self.assertEqual(tgrs['g_a_b'].root, tgrs['g_a'])
+        self.assertEqual(tgrs['g_a_b'].group.parent, tgrs['g_a'].group)
+        test_results = dict((tr.test.id_ref, tr)
+                            for tr in TestResult.objects.for_result(result))
+        self.assertEqual(sorted(test_results.keys()), ['r_m1', 'r_m2'])
+        self.assertEqual(test_results['r_m1'].get_state(), 'fail')
+        self.assertEqual(test_results['r_m1'].group, tgrs['g_a_b'])
+        self.assertEqual(test_results['r_m1'].root_group, tgrs['g_a'])
+        self.assertEqual(test_results['r_m2'].test.fix_type, 'urn:x')
+        self.assertEqual(list(Risk.objects.values_list('result', 'level')),
+                         [(test_results['r_m1'].id, 'high')])
+        self.assertEqual(TestLog.objects.filter(result=test_results['r_m2']).count(), 0)
+
+    def test_concurrent_insert(self):
+        manager = Test.objects
+        bulk_create = manager.bulk_create
+
+        def concurrent_bulk_create(objs):
+            bulk_create(objs)
+            # another import of the same modules inserts right after this one
+            Test.objects.create(id_ref='r_other', title='Other', description='',
+                                module_set=objs[0].module_set, content_hash='x')
+        manager.bulk_create = concurrent_bulk_create
+        try:
+            self.importer._add_to_db()
+        finally:
+            del manager.bulk_create
+        self.assertEqual(sorted(TestResult.objects.for_result(self.importer.result)
+                                .values_list('test__id_ref', flat=True)),
+                         ['r_m1', 'r_m2'])
+
+    def _import_concurrent_definition(self, collide_at):
+        """ another import inserts the test of collide_at-th bulk_create first """
+        manager = Test.objects
+        bulk_create = manager.bulk_create
+        calls = []
+        inserted = []
+
+        def concurrent_bulk_create(objs):
+            calls.append(objs)
+            if len(calls) == collide_at:
+                # inserted after this import looked up the known tests
+                t = objs[0]
+                inserted.append(Test.objects.create(
+                    id_ref=t.id_ref, title=t.title, description=t.description, group=t.group,
+                    module_set=t.module_set, content_hash=t.content_hash))
+            bulk_create(objs)
+        manager.bulk_create = concurrent_bulk_create
+        try:
+            self.importer._add_to_db()
+        finally:
+            del manager.bulk_create
+        self.assertEqual(Test.objects.count(), 3)
+        tests = dict(TestResult.objects.for_result(self.importer.result)
+                     .values_list('test__id_ref', 'test'))
+        self.assertEqual(sorted(tests), ['r_m1', 'r_m2'])
+        if inserted[0].id_ref in tests:
+            self.assertEqual(tests[inserted[0].id_ref], inserted[0].id)
+
+    def test_concurrent_definition(self):
+        self._import_concurrent_definition(1)
+
+    def test_concurrent_definition_batch(self):
+        # SQLite inserts many rows in several statements, the collision is
+        # in the second one
+        ops = connection.ops
+        ops.bulk_batch_size = lambda fields, objs: 1
+        try:
+            self._import_concurrent_definition(2)
+        finally:
+            del ops.bulk_batch_size
+
+    def test_shared_definitions(self):
+        self.importer._add_to_db()
+        other = create_importer(self.temp_dir)
+        other._add_to_db()
+        self.assertEqual((Test.objects.count(), TestGroup.objects.count()), (3, 3))
+        tests = [sorted(TestResult.objects.for_result(importer.result).values_list('test', flat=True))
+                 for importer in (self.importer, other)]
+        self.assertEqual(tests[0], tests[1])
+
+        changed = create_importer(self.temp_dir)
+        rule_m1 = changed.parsed_data['groups'][1]['rules'][0]
+        rule_m1['fixtext'] = 'See <a href="__INSERT_URL__?path=x">x</a>'
+        changed._add_to_db()
+        self.assertEqual((Test.objects.count(), TestGroup.objects.count()), (4, 3))
+        tr = TestResult.objects.for_result(changed.result).get(test__id_ref='r_m1')
+        self.assertEqual(tr.test.fixtext, rule_m1['fixtext'])
+        self.assertEqual(tr.fixtext(), 'See <a href="%s?path=x">x</a>'
+                         % reverse('show-file', args=(changed.result.id,)))
+
+    def test_calculate_stats(self):
+        self.importer._add_to_db()
+        self.importer._calculate_stats()
+        result = self.importer.result
+        stats = dict((tgr.group.xccdf_id, (tgr.test_count, tgr.failed_test_count))
+                     for tgr in TestGroupResult.objects.for_result(result))
+        self.assertEqual(stats, {'g_a': (2, 1), 'g_a_b': (1, 1), 'g_c': (0, 0)})
+        self.assertEqual((result.test_count, result.failed_test_count,
+                          result.ni_test_count, result.na_test_count), (2, 1, 0, 0))
+        result = Result.objects.get(id=result.id)
+        self.assertEqual(result.get_state_counts(), {TestResult.FAILURE: 1, TestResult.PASSED: 1})
+        self.assertEqual(result.status_text(), 'Failed (1), Passed (1)')
+
+    def _render(self, search_string=None, get=None):
+        result_list = render_result(self.importer.result, search_string, get)
+        rendered = []
+        for kind, item in result_list:
+            if kind == 'TAG':
+                continue
+            rendered.append((kind, item.group.xccdf_id,
+                             [x.test.id_ref for x in item.filtered_tests]))
+        return rendered
+
+    def test_render_result(self):
+        self.importer._add_to_db()
+        self.assertEqual(self._render(),
+                         [('GROUP', 'g_a', ['r_m2']),
+                          ('GROUP_WITH_TESTS', 'g_a_b', ['r_m1']),
+                          ('TESTS', 'g_a', ['r_m2']),
+                          ('GROUP_WITH_TESTS', 'g_c', [])])
+        get = {'fail%d' % self.importer.result.id: 'on'}
+        self.assertEqual(self._render(get=get),
+                         [('GROUP', 'g_a', []),
+                          ('GROUP_WITH_TESTS', 'g_a_b', ['r_m1'])])
+
+
+class TestSearchIndex(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.importer = create_importer(self.temp_dir)
+        self.importer._add_to_db()
+        search.index_result(self.importer.result.id)
+        Result.objects.filter(id=self.importer.result.id).update(hostname='host1')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_search(self):
+        result_id = self.importer.result.id
+        self.assertEqual([(kind, text) for kind, dummy_result, dummy_tr, text
+                          in search.search('Rule 1')],
+                         [(search.TEST, 'Rule 1')])
+        self.assertEqual([row[0] for row in search.search('B')], [search.GROUP])
+        self.assertEqual(search.hosts_logged('danger'), [('host1', result_id, 1)])
+        self.assertEqual(search.hosts_logged('Rule 1'), [])
+        hostruns = HostRun.objects.search('danger')
+        self.assertEqual([hr.result.id for hr in hostruns], [result_id])
+        self.assertEqual(list(HostRun.objects.search('nothing like this')), [])
+
+    def test_search_in_title(self):
+        result = self.importer.result
+        tests = TestResult.objects.for_result(result).search_in_title('Rule 1')
+        self.assertEqual([tr.test.title for tr in tests], ['Rule 1'])
+        groups = TestGroupResult.objects.for_result(result).search_in_title('B')
+        self.assertEqual([tgr.group.title for tgr in groups], ['B'])
+        self.assertEqual(list(TestResult.objects.for_result(result).search_in_title('danger')), [])
+
+    def test_hosts_logged_view(self):
+        request = RequestFactory().get(reverse('hosts-logged'), {'message': 'danger'})
+        request.user = AnonymousUser()
+        response = HostsLoggedView.as_view()(request)
+        response.render()
+        self.assertEqual(response.context_data['hosts'],
+                         [{'hostname': 'host1', 'result_id': self.importer.result.id, 'count': 1}])
+        self.assertIn(reverse('result-detail', args=(self.importer.result.id,)), response.content)
+
+    def test_like_search(self):
+        name = connection.settings_dict['NAME']
+        full_text = search._is_full_text()
+        search._full_text[name] = False
+        try:
+            self.assertEqual([row[3] for row in search.search('rule 1')], ['Rule 1'])
+            self.assertEqual(search.search('Rule_1'), [])
+            self.assertEqual(search.search('Rule%1'), [])
+        finally:
+            search._full_text[name] = full_text
+
+    def test_index_results(self):
+        search.remove_result(self.importer.result.id)
+        self.assertEqual(search.unindexed_results(), [self.importer.result.id])
+        call_command('index_results', verbosity=0)
+        self.assertEqual(search.unindexed_results(), [])
+        self.assertEqual(len(search.search('danger')), 1)
+
+    def test_remove_result(self):
+        with override_settings(RESULTS_DIR=self.temp_dir):
+            Result.objects.get(id=self.importer.result.id).delete()
+        self.assertEqual(search.search('danger'), [])
+
+
+class TestRunsView(TestCase):
+
+    def setUp(self):
+        host = Host.objects.create(hostname='host1')
+        for dummy_i in range(30):
+            Run.objects.create_for_host(host)
+        # several runs submitted at the same time
+        HostRun.objects.filter(id__lte=10).update(dt_submitted=HostRun.objects.get(id=1).dt_submitted)
+
+    def _get_page(self, **get):
+        request = RequestFactory().get('/', get)
+        request.user = AnonymousUser()
+        response = RunsView.as_view()(request)
+        response.render()
+        return response.context_data['page_obj'], [x.id for x in response.context_data['hostruns']]
+
+    def test_keyset_pagination(self):
+        expected = list(HostRun.objects.values_list('id', flat=True))
+        self.assertEqual(len(expected), 30)
+        page, hostruns = self._get_page()
+        self.assertEqual(hostruns, expected[:25])
+        self.assertFalse(page.has_previous)
+        self.assertTrue(page.has_next)
+        page, hostruns = self._get_page(after=page.next_cursor())
+        self.assertEqual(hostruns, expected[25:])
+        self.assertTrue(page.has_previous)
+        self.assertFalse(page.has_next)
+        page, hostruns = self._get_page(before=page.previous_cursor())
+        self.assertEqual(hostruns, expected[:25])
+        self.assertFalse(page.has_previous)
+        self.assertRaises(Http404, self._get_page, after='x')
+
+
+RESULT_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'results': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                'LOCATION': 'test-results'},
+}
+
+
+class TestLRUFileBasedCache(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache = rendercache.LRUFileBasedCache(
+            self.temp_dir, {'OPTIONS': {'MAX_ENTRIES': 3, 'CULL_FREQUENCY': 3}})
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_cull(self):
+        for mtime, key in enumerate(['a', 'b', 'c']):
+            self.cache.set(key, key)
+            os.utime(self.cache._key_to_file(self.cache.make_key(key)), (mtime, mtime))
+        self.assertEqual(self.cache.get('a'), 'a')
+        self.cache.set('d', 'd')
+        self.assertEqual([self.cache.get(key) for key in ['a', 'b', 'c', 'd']],
+                         ['a', None, 'c', 'd'])
+
+
+@override_settings(CACHES=RESULT_CACHES)
+class TestRenderCache(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.importer = create_importer(self.temp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _get_content(self, **get):
+        request = RequestFactory().get('/', get)
+        response = ResultViewAjax.as_view()(request, result_id=self.importer.result.id)
+        return json.loads(response.content)['content']
+
+    def test_cached_render(self):
+        self.importer._add_to_db()
+        self.importer._calculate_stats()
+        result = self.importer.result
+        content = self._get_content()
+        self.assertTrue('Rule 1' in content)
+        failed = self._get_content(**{'fail%d' % result.id: 'on'})
+        self.assertFalse('Rule 2' in failed)
+        TestResult.objects.filter(test__id_ref='r_m1').update(state=TestResult.PASSED)
+        # imported result doesn't change, so it is not rendered again
+        self.assertEqual(self._get_content(), content)
+        rendercache.invalidate(result.id)
+        self.assertNotEqual(self._get_content(), content)
+        self.assertFalse('Rule 1' in self._get_content(**{'fail%d' % result.id: 'on'}))
+
+
+class TestImportQueue(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.upload_dir = os.path.join(self.temp_dir, 'upload')
+        self.settings = override_settings(MEDIA_ROOT=self.upload_dir,
+                                          RESULTS_DIR=os.path.join(self.temp_dir, 'results'))
+        self.settings.enable()
+        self.queue = ImportQueue(os.path.join(self.temp_dir, 'queue'), workers=0)
+        host = Host.objects.create(hostname='host1')
+        self.hostrun = Run.objects.create_for_host(host).first_hostrun()
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.temp_dir)
+
+    def _create_tarball(self):
+        report_dir = os.path.join(self.temp_dir, 'preupgrade')
+        os.makedirs(report_dir)
+        with open(os.path.join(report_dir, 'result.xml'), 'w') as report:
+            report.write(NESTED_REPORT)
+        with open(os.path.join(report_dir, 'result.html'), 'w') as report:
+            report.write('<html></html>')
+        tb_path = os.path.join(self.upload_dir, 'job', 'result.tar.gz')
+        os.makedirs(os.path.dirname(tb_path))
+        tar = tarfile.open(tb_path, 'w:gz')
+        tar.add(report_dir, 'preupgrade')
+        tar.close()
+        return tb_path
+
+    def test_import(self):
+        self.queue.enqueue(self._create_tarball(), self.hostrun.id)
+        self.assertEqual(self.queue.pending(), [self.hostrun.id])
+        self.assertEqual(self.queue.status(self.hostrun.id), ('pending', None))
+        self.queue.process_jobs()
+        self.assertEqual(self.queue.pending(), [])
+        self.assertEqual(self.queue.status(self.hostrun.id), ('finished', None))
+        self.assertEqual(Result.objects.get(hostrun=self.hostrun).test_count, 2)
+        # SQLite allows just one writer
+        self.assertEqual(ImportQueue(self.queue.queue_dir, workers=2).workers, 1)
+
+    def test_chunked_submission(self):
+        with open(self._create_tarball(), 'rb') as tarball:
+            data = tarball.read()
+        request = RequestFactory().get('/')
+        response = submission.begin(request, {'host': 'host2', 'size': str(len(data)),
+                                              'checksum': hashlib.sha1(data).hexdigest()})
+        upload_id = response['upload_id']
+        self.assertEqual(response['offset'], '0')
+
+        def send_chunk(offset, chunk, checksum=None):
+            return submission.chunk(request, upload_id, str(offset), xmlrpclib.Binary(chunk),
+                                    checksum or hashlib.sha1(chunk).hexdigest())
+        self.assertEqual(send_chunk(0, data[:100]), {'status': 'OK', 'offset': '100'})
+        self.assertEqual(send_chunk(0, data[:100])['offset'], '100')
+        self.assertEqual(send_chunk(100, data[100:], 'x')['status'], 'ERROR')
+        self.assertEqual(submission.begin(request, {'upload_id': upload_id})['offset'], '100')
+        self.assertEqual(send_chunk(100, data[100:])['offset'], str(len(data)))
+        # XML-RPC integers have 32 bits, sizes are sent as strings
+        large = submission.begin(request, {'host': 'host2', 'size': str(3 * 2 ** 30), 'checksum': 'x'})
+        self.assertEqual(large['offset'], '0')
+        with override_settings(IMPORT_WORKERS=0):
+            response = submission.commit(request, upload_id)
+        self.assertEqual(response['status'], 'OK')
+        self.assertEqual(Result.objects.get(hostrun=response['hostrun_id']).hostname, 'host1')
+
+    def test_stale_uploads(self):
+        request = RequestFactory().get('/')
+        opts = {'host': 'host2', 'size': 10, 'checksum': 'x'}
+        stale_id = submission.begin(request, opts)['upload_id']
+        active_id = submission.begin(request, opts)['upload_id']
+        stale_dir = os.path.join(self.upload_dir, stale_id)
+        with open(os.path.join(stale_dir, 'upload.json'), 'w') as info:
+            json.dump(dict(opts, started=0), info)
+        os.utime(os.path.join(stale_dir, 'result.tar.gz'), (0, 0))
+        new_id = submission.begin(request, opts)['upload_id']
+        self.assertEqual(sorted(os.listdir(self.upload_dir)), sorted([active_id, new_id]))
+        self.assertEqual(submission.begin(request, {'upload_id': stale_id})['status'], 'ERROR')
+
+    def test_failed_import(self):
+        self.queue.enqueue(os.path.join(self.upload_dir, 'missing.tar.gz'), self.hostrun.id)
+        self.assertEqual(self.queue.claim()[0], self.hostrun.id)
+        self.assertEqual(self.queue.claim(), None)
+        self.assertEqual(self.queue.status(self.hostrun.id), ('running', None))
+        self.queue.process(self.hostrun.id, os.path.join(self.upload_dir, 'missing.tar.gz'))
+        state, message = self.queue.status(self.hostrun.id)
+        self.assertEqual(state, 'failed')
+        self.assertTrue('missing.tar.gz' in message)
+        # failed job is imported once the tarball is there
+        self.assertTrue(self.queue.retry(self.hostrun.id))
+        self.assertFalse(self.queue.retry(self.hostrun.id))
+        self.assertEqual(self.queue.claim()[1], os.path.join(self.upload_dir, 'missing.tar.gz'))
+        os.rename(self._create_tarball(), os.path.join(self.upload_dir, 'missing.tar.gz'))
+        self.queue.process(self.hostrun.id, os.path.join(self.upload_dir, 'missing.tar.gz'))
+        self.assertEqual(self.queue.status(self.hostrun.id), ('finished', None))
+
+    def test_database_error(self):
+        def locked_import(tb_path, hostrun_id):
+            importqueue.import_report = import_report
+            raise DatabaseError('database is locked')
+        import_report = importqueue.import_report
+        importqueue.import_report = locked_import
+        try:
+            self.queue.enqueue(self._create_tarball(), self.hostrun.id)
+            self.queue.process(*self.queue.claim())
+            self.assertEqual(self.queue.status(self.hostrun.id), ('pending', None))
+            # next attempt is delayed
+            self.assertEqual(self.queue.claim(), None)
+        finally:
+            importqueue.import_report = import_report
+        path = os.path.join(self.queue.queue_dir, 'pending', str(self.hostrun.id))
+        tb_path, attempts, retry_at, owner, message = ImportQueue._read_job(path)
+        self.assertEqual(attempts, 1)
+        ImportQueue._write_job(path, tb_path, attempts, message, retry_at - 3600)
+        self.queue.process_jobs()
+        self.assertEqual(self.queue.status(self.hostrun.id), ('finished', None))
+        self.assertEqual(TestResult.objects.for_result(self.hostrun.result).count(), 2)
+
+    def test_orphaned_job(self):
+        self.queue.enqueue(self._create_tarball(), self.hostrun.id)
+        hostrun_id, tb_path = self.queue.claim()
+        self.queue.recover()
+        self.assertEqual(self.queue.status(hostrun_id), ('running', None))
+        # worker was killed
+        dead = subprocess.Popen(['true'])
+        dead.wait()
+        path = os.path.join(self.queue.queue_dir, 'running', str(hostrun_id))
+        ImportQueue._write_job(path, tb_path, owner='%d %s' % (dead.pid, importqueue._boot_id()))
+        self.assertEqual(self.queue.status(hostrun_id), ('pending', None))
+        self.queue.recover()
+        self.assertEqual(self.queue.pending(), [hostrun_id])
+        # system was rebooted
+        self.queue.claim()
+        ImportQueue._write_job(path, tb_path, owner='%d other-boot' % os.getpid())
+        self.queue.recover()
+        self.assertEqual(self.queue.claim(), (hostrun_id, tb_path))
+
+
 # class TestImport(TestCase):
 #     def setUp(self):
 #         self.temp_dir = tempfile.mkdtemp()
@@ -4,13 +4,15 @@ from django.conf.urls import patterns, url
 from django.contrib.auth.decorators import login_required as lr
 
 from .views import RunsView, ReportView, NewRunView, NewHostView, DeleteOlderView, \
-    NewLocalRunView, ReportFilesView, RunView, DeleteRunView, ResultViewAjax
+    NewLocalRunView, ReportFilesView, RunView, DeleteRunView, ResultViewAjax, \
+    HostsLoggedView
 
 urlpatterns = patterns(
     '',
     url(r'^$', lr(RunsView.as_view()), name='index'),
     url(r'^$', lr(RunsView.as_view()), name='results-list'),
     url(r'^delete-older/$', lr(DeleteOlderView.as_view()), name='delete-older'),
+    url(r'^logged/$', lr(HostsLoggedView.as_view()), name='hosts-logged'),
     url(r'^(?P<result_id>\d+)/detail/$', lr(RunView.as_view()), name='result-detail'),
     #url(r'^run/(?P<run_id>\d+)/$', lr(RunView.as_view()), name='run'),
     # TODO: creating runs from UI is not done and ready for production
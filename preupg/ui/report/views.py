@@ -8,6 +8,8 @@ import os
 from preupg.ui.config.models import AppSettings
 
 from .models import Run, Result
+from . import rendercache
+from . import search as search_index
 from .forms import *
 
 from django.views.generic import TemplateView, DeleteView, FormView, View
@@ -25,11 +27,50 @@ from django.template import loader
 logger = logging.getLogger('preup_ui')
 
 
+class KeysetPage(object):
+    """
+    page of hostruns; neighbouring pages are referred by cursors of the
+    first and the last hostrun of the page
+    """
+
+    def __init__(self, object_list, has_previous, has_next):
+        self.object_list = object_list
+        self.has_previous = has_previous and bool(object_list)
+        self.has_next = has_next and bool(object_list)
+
+    def previous_cursor(self):
+        return self.object_list[0].cursor
+
+    def next_cursor(self):
+        return self.object_list[-1].cursor
+
+
 class RunsView(ListView):
     template_name = "report/runs.html"
     paginate_by = 25
     context_object_name = 'hostruns'
 
+    def paginate_queryset(self, queryset, page_size):
+        """
+        keyset pagination: GET 'after' ('before') is cursor of hostrun the
+        page follows (precedes), so there is neither OFFSET nor COUNT query
+        """
+        try:
+            if 'before' in self.request.GET:
+                key = HostRun.parse_cursor(self.request.GET['before'])
+                hostruns = list(queryset.before(*key)[:page_size + 1])
+                page = KeysetPage(hostruns[:page_size][::-1], len(hostruns) > page_size, True)
+            elif 'after' in self.request.GET:
+                key = HostRun.parse_cursor(self.request.GET['after'])
+                hostruns = list(queryset.after(*key)[:page_size + 1])
+                page = KeysetPage(hostruns[:page_size], True, len(hostruns) > page_size)
+            else:
+                hostruns = list(queryset[:page_size + 1])
+                page = KeysetPage(hostruns[:page_size], False, len(hostruns) > page_size)
+        except ValueError:
+            raise Http404('Invalid page.')
+        return (None, page, page.object_list, page.has_previous or page.has_next)
+
     def get_queryset(self):
         try:
             query = HostRun.objects.for_result(self.kwargs['result_id'])
@@ -45,15 +86,21 @@ class RunsView(ListView):
                     query = query.by_hosts_processed(filter_form.cleaned_data['hosts'])
                 if filter_form.cleaned_data['risk']:
                     query = query.by_risk(filter_form.cleaned_data['risk'])
+                if filter_form.cleaned_data['search']:
+                    query = query.search(filter_form.cleaned_data['search'])
         query = query.select_related('result', 'run', 'host')
         return query
 
     def get_action_form(self):
         if self.request.method == 'POST':
             form = ListActionForm(data=self.request.POST)
+            # just the selected runs are valid choices, listing all would
+            # load the whole table
+            runs = self.get_queryset().filter(id__in=[
+                run for run in self.request.POST.getlist('runs') if run.isdigit()])
+            form.fields['runs'].choices = [(r, r) for r in runs.values_list('id', flat=True)]
         else:
             form = ListActionForm()
-        form.fields['runs'].choices = [(r.id, r.id) for r in self.get_queryset()]
         return form
 
     def get_context_data(self, **kwargs):
@@ -110,7 +157,7 @@ class DeleteOlderView(FormView):
         if hostname:
             hostruns = hostruns.filter(host__hostname=hostname)
         previous_host_id = None
-        for hostrun in hostruns.order_by('host', '-run__dt_submitted'):
+        for hostrun in hostruns.order_by('host', '-dt_submitted', '-id'):
             if hostrun.host_id == previous_host_id:
                 yield hostrun
             previous_host_id = hostrun.host_id
@@ -142,6 +189,22 @@ class RunView(RunsView):
         return context
 
 
+class HostsLoggedView(TemplateView):
+    """ list hosts which logged the searched message in logs or risks """
+    template_name = "report/hosts_logged.html"
+
+    def get_context_data(self, **kwargs):
+        context = super(HostsLoggedView, self).get_context_data(**kwargs)
+        message = self.request.GET.get('message', '').strip()
+        context['message'] = message
+        if message:
+            context['hosts'] = [
+                {'hostname': hostname, 'result_id': result_id, 'count': count}
+                for hostname, result_id, count in search_index.hosts_logged(message)
+            ]
+        return context
+
+
 class DeleteRunView(DeleteView):
     model = HostRun
     success_url = reverse_lazy('results-list')
@@ -185,14 +248,20 @@ class ResultViewAjax(View):
         except KeyError:
             search_string = ''
 
-        context = RequestContext(request, {
-            'flat_tree': render_result(result, search_string, request.GET),
-            'result': result,
-            'state_filter_form': form,
-        })
-        template_name = "report/result.html"
-        template = loader.get_template(template_name)
-        response['content'] = template.render(context)
+        cache_key = rendercache.make_key(
+            result.id, states or AppSettings.get_initial_state_filter(), request.GET)
+        content = rendercache.get_rendered(cache_key)
+        if content is None:
+            context = RequestContext(request, {
+                'flat_tree': render_result(result, search_string, request.GET),
+                'result': result,
+                'state_filter_form': form,
+            })
+            template_name = "report/result.html"
+            template = loader.get_template(template_name)
+            content = template.render(context)
+            rendercache.set_rendered(cache_key, content)
+        response['content'] = content
         response['status'] = 'OK'
         return HttpResponse(
             json.dumps(response),
@@ -109,6 +109,46 @@ MEDIA_ROOT = os.path.join(DATA_DIR, 'upload')
 
 RESULTS_DIR = os.path.join(DATA_DIR, 'results')
 
+# chunked uploads which were not committed and got no chunk for this many
+# seconds are removed when another upload begins
+UPLOAD_EXPIRATION = 24 * 60 * 60
+
+# uploaded reports are imported in background by IMPORT_WORKERS threads of
+# "preupg-ui-manage import_worker" (service preupgrade-assistant-ui-import),
+# which look for new reports every IMPORT_POLL_INTERVAL seconds;
+# set IMPORT_WORKERS to 0 to import them during the upload request.
+# SQLite allows one writer at a time, so more workers are used just with
+# other databases (PostgreSQL, MySQL) -- each of them imports one report
+# in one transaction at a time
+IMPORT_QUEUE_DIR = os.path.join(DATA_DIR, 'queue')
+IMPORT_WORKERS = 1 if DATABASES['default']['ENGINE'].endswith('sqlite3') else 2
+IMPORT_POLL_INTERVAL = 2
+# import failed on a database error (e.g. locked database) is tried again
+# at most IMPORT_RETRIES times, after IMPORT_RETRY_DELAY seconds doubled by
+# every failed attempt
+IMPORT_RETRIES = 3
+IMPORT_RETRY_DELAY = 30
+
+# rendered results are cached in RESULT_CACHE; it has to be shared by all
+# processes of the web server, so the cache is stored in files; least
+# recently used entries are culled when there are MAX_ENTRIES of them
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'results': {
+        'BACKEND': 'preupg.ui.report.rendercache.LRUFileBasedCache',
+        'LOCATION': os.path.join(DATA_DIR, 'cache'),
+        'TIMEOUT': 7 * 24 * 60 * 60,
+        'OPTIONS': {
+            'MAX_ENTRIES': 500,
+        },
+    },
+}
+RESULT_CACHE = 'results'
+# bigger rendered results (in characters) are not cached
+RESULT_CACHE_MAX_SIZE = 4 * 1024 * 1024
+
 
 from django.conf.global_settings import TEMPLATE_CONTEXT_PROCESSORS
 TEMPLATE_CONTEXT_PROCESSORS += (
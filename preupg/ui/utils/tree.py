@@ -6,18 +6,26 @@ from preupg.ui.report.models import TestResult, TestGroupResult
 from .views import get_states_to_filter
 
 
-def get_groups_children(group, groups):
+def index_by(items, attr):
     """
+    return dict: value of items' attr -> list of items with it
+
     we want to operate on the same set of elements, so we can use caching
     """
-    return [x for x in groups if x.parent and x.parent.id == group.id]
+    index = {}
+    for item in items:
+        index.setdefault(getattr(item, attr), []).append(item)
+    return index
 
 
-def get_groups_tests(group, tests):
-    """
-    we want to operate on the same set of elements, so we can use caching
-    """
-    return [x for x in tests if x.group.id == group.id]
+def get_groups_children(group, children_index):
+    """ children_index is index of groups by parent_id """
+    return children_index.get(group.id, [])
+
+
+def get_groups_tests(group, tests_index):
+    """ tests_index is index of tests by group_id """
+    return tests_index.get(group.id, [])
 
 
 class RecursiveFilter(object):
@@ -28,22 +36,19 @@ class RecursiveFilter(object):
      \ allfiltered_tests -- tests in this category and its children
     """
     def __init__(self, groups, tests):
-        """ groups, tests are queries """
+        """ groups, tests are queries, both are evaluated just once """
         self.groups = groups
         self.tests = tests
-        self.test_ids = tests.values_list('id', flat=True)
+        self.children_index = index_by(groups, 'parent_id')
+        self.tests_index = index_by(tests, 'group_id')
+        self.test_ids = set(test.id for test in tests)
 
     def testresults_filter(self, group):
         """ self.tests is already performed filter, lets grep tests matching provided group """
         if hasattr(group, 'filtered_tests'):
             return group.filtered_tests[:]
-        groups_tests = get_groups_tests(group, self.tests)
-        group.filtered_tests = []
-        for groups_test in groups_tests:
-            # django's lazy queries won't evaluate self.test_ids first time
-            # if groups_test.id in self.test_ids:
-            if groups_test.id in iter(self.test_ids):
-                group.filtered_tests.append(groups_test)
+        groups_tests = get_groups_tests(group, self.tests_index)
+        group.filtered_tests = [x for x in groups_tests if x.id in self.test_ids]
         return group.filtered_tests[:]
 
     def subelements_filter(self, group):
@@ -55,7 +60,7 @@ class RecursiveFilter(object):
 
         allfiltered_tests = self.testresults_filter(group)
 
-        for child in get_groups_children(group, self.groups):
+        for child in get_groups_children(group, self.children_index):
             # and do the same for children
             allfiltered_tests += self.subelements_filter(child)
         group.allfiltered_tests = allfiltered_tests
@@ -183,7 +188,7 @@ def render_result(result, search_string=None, get=None):
             is_child_requested = is_requested(child, level == -1 and not filtering_active)
 
             if is_child_requested:
-                groups_gchildren = get_groups_children(child, groups)
+                groups_gchildren = get_groups_children(child, rf.children_index)
                 if len(groups_gchildren) > 0:
                     ch_dict[child] = filter_children(groups_gchildren, level + 1)
                 else:
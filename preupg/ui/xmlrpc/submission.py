@@ -1,10 +1,18 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import re
+import shutil
+import time
 import uuid
 from django.core.urlresolvers import reverse
+from django.core.exceptions import ObjectDoesNotExist
 import os
 
-from preupg.ui.report.models import Run, Host
+from preupg.ui.report.models import Run, Host, HostRun, Result
 from preupg.ui.report.service import import_report
+from preupg.ui.report.importqueue import ImportQueue
 
 from django.conf import settings
 
@@ -12,9 +20,21 @@ from django.conf import settings
 __all__ = (
     'upload_results',
     'submit_new',
+    'begin',
+    'chunk',
+    'commit',
+    'status',
+    'retry',
     "ping",
 )
 
+logger = logging.getLogger('preup_ui')
+
+UPLOAD_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+# block size used for checksum of committed upload
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
 def ping(request):
     """ server verification """
     return {'status': "OK"}
@@ -57,11 +77,199 @@ def submit_new(request, opts):
     report_path = os.path.join(tmp_dir, 'result.tar.gz')
     with open(report_path, 'wb+') as destination:
         destination.write(opts['data'].data)
+    return _submit_report(request, report_path, opts['host'])
 
-    host, created = Host.objects.get_or_create(hostname=opts['host'])
+def _submit_report(request, report_path, hostname):
+    """ create run for uploaded tarball and import it """
+    host, created = Host.objects.get_or_create(hostname=hostname)
     run_object = Run.objects.create_for_host(host)
     hostrun = run_object.first_hostrun()
 
-    import_report(report_path, hostrun.id)
+    if not settings.IMPORT_WORKERS:
+        import_report(report_path, hostrun.id)
+    else:
+        # result is created now, so its URL can be returned before import
+        Result.objects.create(hostrun=hostrun)
+        # imported by import_worker, see report/importqueue.py
+        ImportQueue().enqueue(report_path, hostrun.id)
     rel_url = reverse('result-detail', args=(hostrun.result.id, ))
-    return {'status': 'OK', 'url': request.build_absolute_uri(rel_url)}
+    return {
+        'status': 'OK',
+        'url': request.build_absolute_uri(rel_url),
+        'hostrun_id': hostrun.id,
+    }
+
+def _get_upload(upload_id):
+    """ return (upload directory, its metadata) or None for unknown upload """
+    if not UPLOAD_ID_RE.match(upload_id):
+        return None
+    upload_dir = os.path.join(settings.MEDIA_ROOT, upload_id)
+    try:
+        with open(os.path.join(upload_dir, 'upload.json')) as info:
+            return upload_dir, json.load(info)
+    except IOError:
+        return None
+
+def _last_activity(upload_dir, info):
+    """ return time of the last chunk of upload (or of its start) """
+    try:
+        return max(info.get('started', 0),
+                   os.path.getmtime(os.path.join(upload_dir, 'result.tar.gz')))
+    except OSError:
+        return info.get('started', 0)
+
+def purge_stale_uploads():
+    """
+    remove uploads which were not committed and got no chunk for
+    settings.UPLOAD_EXPIRATION seconds
+    """
+    if not os.path.isdir(settings.MEDIA_ROOT):
+        return
+    expired = time.time() - settings.UPLOAD_EXPIRATION
+    for upload_id in os.listdir(settings.MEDIA_ROOT):
+        upload = _get_upload(upload_id)
+        if upload is not None and _last_activity(*upload) < expired:
+            logger.info("Removing stale upload %s", upload_id)
+            shutil.rmtree(upload[0], ignore_errors=True)
+
+def _unknown_upload(upload_id):
+    return {'status': 'ERROR', 'message': 'There is no such upload: %s' % upload_id}
+
+def begin(request, opts):
+    """
+    begin(opts)
+
+    start (or resume) chunked upload of a result tarball
+
+    opts is dictionary, it has to contain these entries:
+     * host: string with hostname of a host where scan was done
+     * size: size of the tarball in bytes
+     * checksum: SHA-1 hex digest of the tarball
+     * upload_id: ID of interrupted upload which should be resumed (optional)
+
+    returns upload_id and offset where the next chunk has to start
+
+    sizes and offsets are strings, XML-RPC integers have just 32 bits
+    """
+    if opts.get('upload_id'):
+        upload = _get_upload(opts['upload_id'])
+        if upload is None:
+            return _unknown_upload(opts['upload_id'])
+        upload_dir = upload[0]
+        upload_id = opts['upload_id']
+    else:
+        # interrupted uploads which were not resumed
+        try:
+            purge_stale_uploads()
+        except OSError as e:
+            logger.error("Failed to remove stale uploads: %s", e)
+        try:
+            size = int(opts['size'])
+        except (KeyError, ValueError):
+            return {'status': 'ERROR', 'message': 'Size of the tarball is missing.'}
+        upload_id = uuid.uuid4().hex
+        upload_dir = os.path.join(settings.MEDIA_ROOT, upload_id)
+        try:
+            os.makedirs(upload_dir, mode=0o0744)
+        except OSError as e:
+            return {
+                'status': 'ERROR',
+                'message': 'Failed to create temporary directory: %s' % e,
+            }
+        info = dict((key, opts[key]) for key in ('host', 'checksum'))
+        info['size'] = size
+        info['started'] = time.time()
+        with open(os.path.join(upload_dir, 'upload.json'), 'w') as info_file:
+            json.dump(info, info_file)
+        open(os.path.join(upload_dir, 'result.tar.gz'), 'wb').close()
+    offset = os.path.getsize(os.path.join(upload_dir, 'result.tar.gz'))
+    return {'status': 'OK', 'upload_id': upload_id, 'offset': str(offset)}
+
+def chunk(request, upload_id, offset, data, checksum):
+    """
+    chunk(upload_id, offset, data, checksum)
+
+    append data (with SHA-1 hex digest checksum) to upload started by begin;
+    offset has to match the size uploaded so far, otherwise the chunk is
+    refused and the client should continue from returned offset
+    """
+    upload = _get_upload(upload_id)
+    if upload is None:
+        return _unknown_upload(upload_id)
+    report_path = os.path.join(upload[0], 'result.tar.gz')
+    current_offset = os.path.getsize(report_path)
+    try:
+        offset = int(offset)
+    except ValueError:
+        offset = None
+    if offset != current_offset:
+        return {
+            'status': 'ERROR',
+            'message': 'Chunk starts at %s, expected %d.' % (offset, current_offset),
+            'offset': str(current_offset),
+        }
+    if hashlib.sha1(data.data).hexdigest() != checksum:
+        return {
+            'status': 'ERROR',
+            'message': 'Checksum of the chunk at %d does not match.' % offset,
+            'offset': str(current_offset),
+        }
+    with open(report_path, 'ab') as destination:
+        destination.write(data.data)
+    return {'status': 'OK', 'offset': str(current_offset + len(data.data))}
+
+def commit(request, upload_id):
+    """
+    commit(upload_id)
+
+    finish upload started by begin: verify size and checksum of the tarball
+    and submit it as a new result (see submit_new)
+    """
+    upload = _get_upload(upload_id)
+    if upload is None:
+        return _unknown_upload(upload_id)
+    upload_dir, info = upload
+    report_path = os.path.join(upload_dir, 'result.tar.gz')
+    hasher = hashlib.sha1()
+    with open(report_path, 'rb') as report:
+        for block in iter(lambda: report.read(HASH_BLOCK_SIZE), b''):
+            hasher.update(block)
+    size = os.path.getsize(report_path)
+    if size != info['size'] or hasher.hexdigest() != info['checksum']:
+        return {
+            'status': 'ERROR',
+            'message': 'Uploaded tarball does not match: %d of %d bytes.' % (size, info['size']),
+            'offset': str(size),
+        }
+    os.unlink(os.path.join(upload_dir, 'upload.json'))
+    return _submit_report(request, report_path, info['host'])
+
+def status(request, hostrun_id):
+    """
+    status(hostrun_id)
+
+    return state of import of report submitted by submit_new:
+    pending, running, finished or failed (with message)
+    """
+    try:
+        hostrun = HostRun.objects.get(id=hostrun_id)
+    except ObjectDoesNotExist:
+        return {'status': 'ERROR', 'message': 'There is no such run.'}
+    state, message = ImportQueue().status(hostrun.id)
+    response = {'status': 'OK', 'state': state}
+    if message is not None:
+        response['message'] = message
+    return response
+
+def retry(request, hostrun_id):
+    """
+    retry(hostrun_id)
+
+    import report of failed import again, see status
+    """
+    import_queue = ImportQueue()
+    if not import_queue.retry(hostrun_id):
+        return {'status': 'ERROR', 'message': 'Import of the run did not fail.'}
+    if not settings.IMPORT_WORKERS:
+        import_queue.process_jobs()
+    return {'status': 'OK'}
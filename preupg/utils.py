@@ -11,6 +11,12 @@ import tempfile
 import mimetypes
 import platform
 import codecs
+import threading
+import struct
+import tarfile
+import ctypes
+import ctypes.util
+import distutils.spawn
 
 try:
     import configparser
@@ -28,6 +34,10 @@ except ImportError:
     from sha import sha as sha1
 
 
+# C library used for reading of extended attributes, loaded on demand
+_libc = None
+
+
 def get_current_time():
     return datetime.datetime.now().strftime("%y%m%d%H%M%S")
 
@@ -334,37 +344,152 @@ class DirHelper(object):
 
 class ProcessHelper(object):
 
+    @staticmethod
+    def _get_writer(output):
+        """
+        Function returns (write function, file to close) for the output
+        of run_subprocess
+        """
+        if output is None:
+            return None, None
+        if isinstance(output, list):
+            return output.append, None
+        if hasattr(output, 'write'):
+            return output.write, None
+        out_file = open(output, 'wb')
+        return out_file.write, out_file
+
     @staticmethod
     def run_subprocess(cmd, output=None, print_output=False, shell=False, function=None):
-        """wrapper for Popen"""
-        sp = subprocess.Popen(cmd,
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.STDOUT,
-                              shell=shell,
-                              bufsize=1)
-        stdout = str() # FIXME should't be this bytes()?
-        for stdout_data in iter(sp.stdout.readline, b''):
-            # communicate() method buffers everything in memory, we will read stdout directly
-            stdout += stdout_data
-            if function is None:
-                if print_output:
-                    print (stdout_data, end="")
+        """
+        wrapper for Popen
+
+        The output of the command (stderr included) is never kept in memory
+        as a whole, it is passed on line by line as it comes. output is
+        either a path of a file, an object with write() method or a list
+        the raw lines are appended to. function is called for each line.
+        """
+        write, out_file = ProcessHelper._get_writer(output)
+        try:
+            if function is None and not print_output and (out_file or output is None):
+                # nobody needs the lines, let the command write the file itself
+                target = out_file or open(os.devnull, 'wb')
+                try:
+                    sp = subprocess.Popen(cmd, stdout=target,
+                                          stderr=subprocess.STDOUT, shell=shell)
+                    sp.wait()
+                finally:
+                    if target is not out_file:
+                        target.close()
+                return sp.returncode
+            sp = subprocess.Popen(cmd,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT,
+                                  shell=shell,
+                                  bufsize=1)
+            for stdout_data in iter(sp.stdout.readline, b''):
+                # communicate() method buffers everything in memory, we will read stdout directly
+                if write is not None:
+                    # raw data, so without encoding
+                    write(stdout_data)
+                if function is None:
+                    if print_output:
+                        print (stdout_data, end="")
                 else:
-                    pass
-            else:
-                # I don't know what functions can come here, however
-                # it's not common so put only unicode data here again.
-                # Should be always raw data so we don't need test stdout_data
-                # on type
-                function(stdout_data.decode(settings.defenc))
-        sp.communicate()
-
-        if output is not None:
-            # raw data, so without encoding
-            FileHelper.write_to_file(output, "wb", stdout, False)
+                    # I don't know what functions can come here, however
+                    # it's not common so put only unicode data here again.
+                    # Should be always raw data so we don't need test stdout_data
+                    # on type
+                    function(stdout_data.decode(settings.defenc))
+            sp.communicate()
+        finally:
+            if out_file is not None:
+                out_file.close()
         return sp.returncode
 
 
+class ParallelHelper(object):
+
+    @staticmethod
+    def map_in_threads(function, items, jobs, dependencies=None):
+        """
+        Call function for each item using at most `jobs` worker threads.
+
+        dependencies is an optional dictionary mapping index of an item to
+        a list of indexes of items which have to be finished before the item
+        is started.
+
+        Return list of the values returned by function in the same order
+        as the items. When function raises an exception, no further items
+        are started and the first exception is re-raised once the running
+        ones are finished. ValueError is raised when the dependencies
+        can't be satisfied.
+        """
+        items = list(items)
+        if dependencies is None:
+            dependencies = {}
+        if not dependencies and (jobs <= 1 or len(items) <= 1):
+            return [function(item) for item in items]
+        results = [None] * len(items)
+        errors = []
+        pending = list(range(len(items)))
+        done = set()
+        running = [0]
+        condition = threading.Condition()
+
+        def get_ready():
+            for index in pending:
+                if done.issuperset(dependencies.get(index, ())):
+                    pending.remove(index)
+                    running[0] += 1
+                    return index
+            if pending and not running[0]:
+                errors.append(ValueError("Unsatisfiable dependencies of"
+                                         " items %s" % pending))
+                condition.notify_all()
+            return None
+
+        def worker():
+            while True:
+                condition.acquire()
+                try:
+                    index = None
+                    while not errors and pending:
+                        index = get_ready()
+                        if index is not None:
+                            break
+                        condition.wait()
+                    if index is None:
+                        return
+                finally:
+                    condition.release()
+                try:
+                    results[index] = function(items[index])
+                except Exception as ex:
+                    errors.append(ex)
+                condition.acquire()
+                try:
+                    running[0] -= 1
+                    done.add(index)
+                    condition.notify_all()
+                finally:
+                    condition.release()
+
+        threads = []
+        for dummy_thread in range(max(1, min(jobs, len(items)))):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            # join with timeout keeps the main thread responsive to Ctrl+C
+            while thread.is_alive():
+                thread.join(0.1)
+        if errors:
+            raise errors[0]
+        return results
+
+
 class SystemIdentification(object):
 
     @staticmethod
@@ -392,6 +517,18 @@ class SystemIdentification(object):
 
 class TarballHelper(object):
 
+    # compressors which are run as a separate process:
+    # (binary, file extension, option for all cores)
+    compressors = {
+        'gzip': ('pigz', '.tar.gz', None),
+        'xz': ('xz', '.tar.xz', '-T0'),
+        'zstd': ('zstd', '.tar.zst', '-T0'),
+    }
+
+    # tags of POSIX ACL entries stored in system.posix_acl_* xattrs
+    acl_tags = {0x01: 'user', 0x02: 'user', 0x04: 'group', 0x08: 'group',
+                0x10: 'mask', 0x20: 'other'}
+
     @staticmethod
     def _get_tarball_name(result_file, time):
         return result_file.format(time)
@@ -401,52 +538,171 @@ class TarballHelper(object):
         return os.path.join(root_dir, filename)
 
     @staticmethod
-    def tarball_result_dir(result_file, verbose):
+    def get_xattr(file_path, name):
+        """Return value of extended attribute of file (not following symlinks) or None"""
+        global _libc
+        if hasattr(os, 'getxattr'):
+            try:
+                return os.getxattr(file_path, name, follow_symlinks=False)
+            except OSError:
+                return None
+        if _libc is None:
+            _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        # byte strings are passed as they are, non-ASCII ones can't be encoded
+        if isinstance(file_path, unicode):
+            file_path = file_path.encode(settings.defenc)
+        if isinstance(name, unicode):
+            name = name.encode(settings.defenc)
+        size = _libc.lgetxattr(file_path, name, None, 0)
+        if size <= 0:
+            return None
+        value = ctypes.create_string_buffer(size)
+        size = _libc.lgetxattr(file_path, name, value, size)
+        if size < 0:
+            return None
+        return value.raw[:size]
+
+    @staticmethod
+    def acl_to_text(value):
+        """
+        Convert system.posix_acl_* xattr value to short text form with numeric
+        IDs (e.g. user::rw-,user:1000:r--,group::r--,mask::r--,other::r--)
+        """
+        entries = []
+        # header (version) and entries (tag, permissions, ID)
+        for offset in range(4, len(value) - 7, 8):
+            tag, perm, entry_id = struct.unpack(str('<HHI'), value[offset:offset + 8])
+            qualifier = str(entry_id) if tag in (0x02, 0x08) else ''
+            perms = ''.join(char if perm & bit else '-'
+                            for char, bit in (('r', 4), ('w', 2), ('x', 1)))
+            entries.append('%s:%s:%s' % (TarballHelper.acl_tags.get(tag, 'unknown'),
+                                         qualifier, perms))
+        return ','.join(entries)
+
+    @staticmethod
+    def add_to_tarball(tar, path, arcname, tarinfo_filter, recursive=True):
+        """
+        Add file or directory tree to tar like TarFile.add() with filter
+        argument does -- it is not available on Python 2.6. Every TarInfo
+        is passed through tarinfo_filter, None returned by it skips the file.
+        """
+        stack = [(path, arcname)]
+        while stack:
+            path, arcname = stack.pop()
+            tarinfo = tarinfo_filter(tar.gettarinfo(path, arcname))
+            if tarinfo is None:
+                continue
+            if tarinfo.isreg():
+                with open(path, 'rb') as file_obj:
+                    tar.addfile(tarinfo, file_obj)
+            else:
+                tar.addfile(tarinfo)
+            if recursive and tarinfo.isdir():
+                # directory content is added in sorted order
+                stack.extend((os.path.join(path, name), os.path.join(arcname, name))
+                             for name in sorted(os.listdir(path), reverse=True))
+
+    @staticmethod
+    def get_tarinfo_filter(src_dir, arc_dir, verbose):
+        """
+        Return filter for TarballHelper.add_to_tarball() which stores numeric owner only,
+        ACLs and SELinux context of files like tar --numeric-owner --acls
+        --selinux does
+        """
+        def tarinfo_filter(tarinfo):
+            file_path = os.path.join(src_dir, os.path.relpath(tarinfo.name, arc_dir))
+            tarinfo.uname = tarinfo.gname = ''
+            for key, xattr in (('SCHILY.acl.access', 'system.posix_acl_access'),
+                               ('SCHILY.acl.default', 'system.posix_acl_default')):
+                value = TarballHelper.get_xattr(file_path, xattr)
+                if value:
+                    tarinfo.pax_headers[key] = TarballHelper.acl_to_text(value)
+            context = TarballHelper.get_xattr(file_path, 'security.selinux')
+            if context:
+                tarinfo.pax_headers['RHT.security.selinux'] = \
+                    context.rstrip(b'\0').decode(settings.defenc)
+            if verbose:
+                print(tarinfo.name)
+            return tarinfo
+        return tarinfo_filter
+
+    @staticmethod
+    def open_tarball(tarball, compression, level, parallel):
+        """
+        Open tarball for streamed writing, return (TarFile, compressor process)
+
+        gzip is done in process unless parallel pigz is requested and
+        available, other compressors are run as a separate process
+        """
+        binary, dummy_ext, all_cores = TarballHelper.compressors[compression]
+        if compression == 'gzip' and not parallel:
+            binary = None
+        binary = binary and distutils.spawn.find_executable(binary)
+        if binary is None:
+            return tarfile.open(tarball, 'w:gz', compresslevel=level,
+                                format=tarfile.PAX_FORMAT), None
+        cmd = [binary, '-c', '-%d' % level]
+        if parallel and all_cores:
+            cmd.append(all_cores)
+        output = open(tarball, 'wb')
+        try:
+            sp = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=output)
+        finally:
+            output.close()
+        return tarfile.open(fileobj=sp.stdin, mode='w|',
+                            format=tarfile.PAX_FORMAT), sp
+
+    @staticmethod
+    def get_tarball_ext(compression):
+        """Return extension of tarball, gzip is used when compressor is not available"""
+        binary, ext, dummy_all_cores = TarballHelper.compressors[compression]
+        if compression != 'gzip' and distutils.spawn.find_executable(binary) is None:
+            log_message("'%s' is not available, results are compressed by gzip."
+                        % binary)
+            return TarballHelper.compressors['gzip'][1]
+        return ext
+
+    @staticmethod
+    def tarball_result_dir(result_file, verbose, compression='gzip', level=6,
+                           parallel=False):
         """
         pack results to tarball
+
+        Files are read directly from assessment_results_dir and streamed to
+        the compressor, the tarball is written to tarball_result_dir only.
         """
-        current_dir = os.getcwd()
-        tar_binary = "/bin/tar"
         current_time = get_current_time()
-        cmd_pack = "-czvf"
-        cmd = [tar_binary]
-        # numeric UIDs and GIDs are used, ACLs are enabled, SELinux is enabled
-        tar_options = ["--numeric-owner", "--acls", "--selinux"]
-
-        # used for packing directories into tarball
-        os.chdir('/root')
         tarball_dir = TarballHelper._get_tarball_name(result_file, current_time)
-        tarball_name = tarball_dir + '.tar.gz'
-        bkp_tar_dir = os.path.join('/root', tarball_dir)
-
-        if not os.path.exists(bkp_tar_dir):
-            os.makedirs(bkp_tar_dir)
-        for dir_to_pack in settings.preupgrade_dirs:
-            shutil.copytree(os.path.join(settings.assessment_results_dir,
-                                         dir_to_pack),
-                            os.path.join(bkp_tar_dir, dir_to_pack),
-                            symlinks=True)
-        files_to_copy = [settings.PREUPG_README]
-        for _, _, files in os.walk(settings.assessment_results_dir):
-            for f in files:
-                if f.startswith("result"):
-                    files_to_copy.append(f)
-        for f in files_to_copy:
-            shutil.copyfile(os.path.join(settings.assessment_results_dir, f),
-                            os.path.join(bkp_tar_dir, f))
+        ext = TarballHelper.get_tarball_ext(compression)
+        if ext != TarballHelper.compressors[compression][1]:
+            compression = 'gzip'
         tarball = TarballHelper._get_tarball_result_path(
-            settings.assessment_results_dir, tarball_name)
-        cmd.append(cmd_pack)
-        cmd.append(tarball)
-        cmd.append(tarball_dir)
+            settings.tarball_result_dir, tarball_dir + ext)
 
-        cmd.extend(tar_options)
-        ProcessHelper.run_subprocess(cmd, print_output=verbose)
-        shutil.rmtree(bkp_tar_dir)
-        shutil.copy(tarball, settings.tarball_result_dir + "/")
-        os.chdir(current_dir)
+        files_to_pack = list(settings.preupgrade_dirs)
+        files_to_pack.append(settings.PREUPG_README)
+        files_to_pack.extend(sorted(f for f in os.listdir(settings.assessment_results_dir)
+                                    if f.startswith("result") and
+                                    os.path.isfile(os.path.join(settings.assessment_results_dir, f))))
+
+        tar, sp = TarballHelper.open_tarball(tarball, compression, level, parallel)
+        try:
+            tarinfo_filter = TarballHelper.get_tarinfo_filter(
+                settings.assessment_results_dir, tarball_dir, verbose)
+            TarballHelper.add_to_tarball(tar, settings.assessment_results_dir,
+                                         tarball_dir, tarinfo_filter, recursive=False)
+            for name in files_to_pack:
+                TarballHelper.add_to_tarball(tar,
+                                             os.path.join(settings.assessment_results_dir, name),
+                                             os.path.join(tarball_dir, name), tarinfo_filter)
+        finally:
+            tar.close()
+            if sp is not None:
+                sp.stdin.close()
+                if sp.wait() != 0:
+                    raise OSError("Compression of '%s' failed." % tarball)
 
-        return os.path.join(settings.tarball_result_dir, tarball_name)
+        return tarball
 
     @staticmethod
     def get_latest_tarball(result_dir):
@@ -461,6 +717,105 @@ class TarballHelper(object):
             return None
 
 
+class RpmIndex(object):
+
+    """
+    Index of the installed packages built from the rpm_qa.log
+    and rpm_rhsigned.log common logs
+    """
+
+    key_id_re = re.compile(r'Key ID ([0-9a-fA-F]+)')
+
+    def __init__(self, rpm_qa_path, rpm_signed_path):
+        # package names in order of rpm_qa.log
+        self.names = []
+        # package name -> (vendor, signature key ID)
+        self.packages = {}
+        self.signed = set()
+        for line in FileHelper.get_file_content(rpm_qa_path, "rb", True):
+            fields = line.rstrip('\n').split('\t')
+            if not fields[0].strip():
+                continue
+            name = fields[0].split()[0]
+            if name in self.packages:
+                continue
+            vendor = fields[1].strip() if len(fields) > 1 else ''
+            key_id = ''
+            if len(fields) > 2:
+                match = self.key_id_re.search(fields[2])
+                if match:
+                    key_id = match.group(1)
+            self.names.append(name)
+            self.packages[name] = (vendor, key_id)
+        try:
+            lines = FileHelper.get_file_content(rpm_signed_path, "rb", True)
+        except IOError:
+            lines = []
+        for line in lines:
+            if line.strip():
+                self.signed.add(line.split()[0])
+
+    def is_installed(self, name):
+        return name in self.packages
+
+    def is_signed(self, name):
+        return name in self.signed
+
+    def get_vendor(self, name):
+        return self.packages[name][0]
+
+    def get_key_id(self, name):
+        return self.packages[name][1]
+
+    def write_index_dir(self, index_dir):
+        """
+        Function writes the index as a directory with one file per package
+        name, so bash modules can look up a package without reading
+        the whole log. The file contains 'signed key_id vendor' separated
+        by tabs where signed is 1 or 0.
+        """
+        new_dir = index_dir + ".new"
+        if os.path.exists(new_dir):
+            shutil.rmtree(new_dir)
+        os.mkdir(new_dir)
+        for name in self.names:
+            vendor, key_id = self.packages[name]
+            FileHelper.write_to_file(os.path.join(new_dir, name), "wb",
+                                     "%d\t%s\t%s\n" % (self.is_signed(name),
+                                                       key_id, vendor))
+        if os.path.exists(index_dir):
+            shutil.rmtree(index_dir)
+        os.rename(new_dir, index_dir)
+
+
+class ChangedFilesIndex(object):
+
+    """
+    Index of the changed files (path -> verify flags like 'S.5....T.' or
+    'missing') built from an 'rpm -V' log like rpm_etc_Va.log
+    """
+
+    def __init__(self, log_path):
+        self.flags = {}
+        try:
+            lines = FileHelper.get_file_content(log_path, "rb", True)
+        except IOError:
+            return
+        for line in lines:
+            line = line.rstrip("\n")
+            # e.g. 'S.5....T.  c /etc/foo.conf', attribute marker is optional
+            index = line.find(" /")
+            if index == -1:
+                continue
+            self.flags[line[index + 1:]] = line.split(None, 1)[0]
+
+    def is_changed(self, path):
+        return path in self.flags
+
+    def get_flags(self, path):
+        return self.flags.get(path)
+
+
 class ConfigHelper(object):
     @staticmethod
     def get_preupg_config_file(full_path, key, section="preupgrade-assistant"):
@@ -765,17 +1120,25 @@ class OpenSCAPHelper(object):
         command.append(FileHelper.check_xml(xml_file))
         return command
 
-    def build_command(self):
-        """create command from configuration"""
+    def build_command(self, content=None, result_file=None):
+        """
+        create command from configuration
+
+        content and result_file override the configured module set content
+        and the default XML result path
+        """
         command_eval = ['xccdf', 'eval']
-        result_file = self.get_default_xml_result_path()
+        if result_file is None:
+            result_file = self.get_default_xml_result_path()
+        if content is None:
+            content = self.content
         command = [settings.openscap_binary]
         command.extend(command_eval)
         command.append('--progress')
         command.extend(('--profile', settings.profile))
 
         command.extend(("--results", result_file))
-        command.append(FileHelper.check_xml(self.content))
+        command.append(FileHelper.check_xml(content))
         return command
 
     def get_default_xml_result_path(self):
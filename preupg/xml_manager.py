@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import unicode_literals, print_function
+import mmap
 import os
 import re
+import shutil
 try:
     import rpm
 except ImportError:
@@ -100,23 +102,60 @@ class XmlManager(object):
         self.copied_module_set_path = copied_module_set_path
         self.paths_to_all_modules = self.get_module_dirs()
         self.solution_texts = {}
+        self.solution_pattern = None
 
     def update_report(self, report_path):
-        """Update XML or HTML report with relevant solution texts."""
+        """
+        Update XML or HTML report with relevant solution texts.
+
+        All placeholders are found in one pass over the memory mapped
+        report and the updated report is written out as it goes.
+        """
         if not self.solution_texts:
             self.load_solution_texts()
+        if not self.solution_texts:
+            return
 
         orig_file = os.path.join(self.assessment_result_path, report_path)
-        report_content = FileHelper.get_file_content(orig_file, "rb")
-
-        for solution_placeholer, solution_text in self.solution_texts.items():
-            report_content = report_content.replace(solution_placeholer,
-                                                    solution_text)
-
-        FileHelper.write_to_file(orig_file, "wb", report_content)
+        if os.path.getsize(orig_file) == 0:
+            # empty file can't be mapped
+            return
+        solutions, pattern = self.get_solution_pattern()
+        new_file = orig_file + ".new"
+        with open(orig_file, "rb") as report:
+            content = mmap.mmap(report.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                with open(new_file, "wb") as output:
+                    position = 0
+                    for match in pattern.finditer(content):
+                        output.write(content[position:match.start()])
+                        output.write(solutions[match.group(0)])
+                        position = match.end()
+                    output.write(content[position:])
+            finally:
+                content.close()
+        shutil.copymode(orig_file, new_file)
+        os.rename(new_file, orig_file)
+
+    def get_solution_pattern(self):
+        """
+        Return solution texts encoded to bytes and the compiled pattern
+        matching any of their placeholders
+        """
+        if self.solution_pattern is None:
+            solutions = dict((placeholder.encode(settings.defenc),
+                              text.encode(settings.defenc))
+                             for placeholder, text in self.solution_texts.items())
+            # longer placeholders first, so a placeholder ending with
+            # another one is not replaced just partially
+            placeholders = sorted(solutions, key=len, reverse=True)
+            pattern = re.compile(b"|".join(re.escape(x) for x in placeholders))
+            self.solution_pattern = (solutions, pattern)
+        return self.solution_pattern
 
     def load_solution_texts(self):
         """Load solution texts into a dictionary."""
+        self.solution_pattern = None
         for dir_name in self.paths_to_all_modules:
             section = dir_name.replace(
                 self.copied_module_set_path, "").replace("/", "_")
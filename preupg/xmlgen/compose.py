@@ -4,16 +4,18 @@ import sys
 import re
 import datetime
 import shutil
+import json
 
 from distutils import dir_util
 
-from preupg.utils import FileHelper, ModuleSetUtils
+from preupg.utils import FileHelper, ModuleSetUtils, sha1
 from preupg.xmlgen.oscap_group_xml import OscapGroupXml
 from preupg import settings
 from preupg import xccdf
 from preupg.logger import logger_debug
 from preupg.settings import ReturnValues
 from preupg.logger import log_message, logging
+from preupg.version import VERSION
 
 try:
     from xml.etree import ElementTree
@@ -29,12 +31,204 @@ XCCDF_FRAGMENT = "{http://fedorahosted.org/sce-community-content/wiki/" \
 SCE = "http://open-scap.org/page/SCE"
 
 
+def _to_bytes(text):
+    if isinstance(text, bytes):
+        return text
+    return text.encode(settings.defenc)
+
+
+class ComposeCache(object):
+    """
+    Content addressed cache of composed module sets
+
+    Composed module sets are stored under 'sets' keyed by a hash of
+    the source module set. Files generated for a group (group.xml, updated
+    check script, ...) are stored under 'groups' keyed by a hash of the group
+    directory, so a partially changed module set recomposes only the changed
+    groups.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.used_groups = set()
+
+    @staticmethod
+    def hash_dir(dir_name, recursive=True, hasher=None):
+        """Function returns hash of paths and contents of files in dir_name"""
+        if hasher is None:
+            hasher = sha1()
+        for root, dirs, files in os.walk(dir_name):
+            dirs.sort()
+            for file_name in sorted(files):
+                full_path = os.path.join(root, file_name)
+                hasher.update(_to_bytes(os.path.relpath(full_path, dir_name)))
+                hasher.update(b'\0')
+                try:
+                    hasher.update(_to_bytes(sha1(FileHelper.get_file_content(
+                        full_path, 'rb', False, False)).hexdigest()))
+                except IOError:
+                    hasher.update(b'unreadable')
+                hasher.update(b'\n')
+            if not recursive:
+                break
+        return hasher.hexdigest()
+
+    def get_module_set_key(self, src_path):
+        """
+        Function returns key of the composed module set. Besides the module
+        set, it covers the XCCDF template, the version of Preupgrade
+        Assistant and the current date which is filled in the template.
+        """
+        hasher = sha1()
+        hasher.update(_to_bytes(VERSION))
+        hasher.update(_to_bytes(datetime.date.today().isoformat()))
+        hasher.update(FileHelper.get_file_content(
+            ComposeXML.get_template_file(), 'rb', False, False))
+        return ComposeCache.hash_dir(src_path, hasher=hasher)
+
+    def _get_entry(self, kind, key):
+        return os.path.join(self.cache_dir, kind, key)
+
+    def _store_entry(self, kind, key, fill_function):
+        """
+        Function creates cache entry in a temporary directory filled by
+        fill_function and moves it to its place at once
+        """
+        entry = self._get_entry(kind, key)
+        if os.path.exists(entry):
+            return
+        kind_dir = os.path.dirname(entry)
+        if not os.path.isdir(kind_dir):
+            os.makedirs(kind_dir)
+        tmp_entry = entry + ".tmp"
+        if os.path.exists(tmp_entry):
+            shutil.rmtree(tmp_entry)
+        try:
+            fill_function(tmp_entry)
+            os.rename(tmp_entry, entry)
+        except (IOError, OSError) as err:
+            logger_debug.debug("Unable to store compose cache entry %s: %s",
+                               entry, err)
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+    def restore_module_set(self, key, dst_path):
+        """Function copies the cached composed module set to dst_path"""
+        entry = self._get_entry("sets", key)
+        if not os.path.isdir(entry):
+            return False
+        shutil.copytree(entry, dst_path, symlinks=True)
+        return True
+
+    def store_module_set(self, key, dst_path):
+        self._store_entry(
+            "sets", key,
+            lambda tmp_entry: shutil.copytree(dst_path, tmp_entry,
+                                              symlinks=True))
+
+    @staticmethod
+    def _get_root_files(root_dir):
+        """
+        Function returns lines of files which are generated in the root of
+        the module set during the composition (e.g. lists of modules for
+        migrate and upgrade modes)
+        """
+        root_files = {}
+        for file_name in os.listdir(root_dir):
+            full_path = os.path.join(root_dir, file_name)
+            if (file_name == settings.file_list_rules
+                    or not os.path.isfile(full_path)):
+                continue
+            try:
+                root_files[file_name] = FileHelper.get_file_content(
+                    full_path, 'rb', method=True)
+            except (IOError, UnicodeDecodeError):
+                continue
+        return root_files
+
+    def write_group_xml(self, oscap_group):
+        """
+        Function generates group.xml and related files of a group,
+        the files are taken from the cache when the group is not changed
+        """
+        group_dir = oscap_group.dirname
+        root_dir = settings.UPGRADE_PATH
+        hasher = sha1()
+        hasher.update(_to_bytes(VERSION))
+        hasher.update(_to_bytes(os.path.relpath(group_dir, root_dir)))
+        key = ComposeCache.hash_dir(group_dir, recursive=False, hasher=hasher)
+        self.used_groups.add(key)
+        entry = self._get_entry("groups", key)
+        if os.path.isdir(entry):
+            files_dir = os.path.join(entry, "files")
+            for file_name in os.listdir(files_dir):
+                shutil.copy2(os.path.join(files_dir, file_name),
+                             os.path.join(group_dir, file_name))
+            root_lines = json.loads(FileHelper.get_file_content(
+                os.path.join(entry, "root_lines.json"), 'rb'))
+            # the lines are appended in the order the group wrote them,
+            # repeated ones included
+            for file_name, lines in iter(root_lines.items()):
+                full_path = os.path.join(root_dir, file_name)
+                old_lines = []
+                if os.path.exists(full_path):
+                    old_lines = FileHelper.get_file_content(full_path, 'rb',
+                                                            method=True)
+                FileHelper.write_to_file(full_path, 'wb', old_lines + lines)
+            oscap_group.write_list_rules()
+            return
+
+        before = ComposeCache._get_root_files(root_dir)
+        oscap_group.write_xml()
+        after = ComposeCache._get_root_files(root_dir)
+        root_lines = {}
+        for file_name, lines in iter(after.items()):
+            old_lines = before.get(file_name, [])
+            if lines[:len(old_lines)] != old_lines:
+                # the group did not just append to the file, its effect
+                # can't be replayed, so it is not cached
+                return
+            if len(lines) > len(old_lines):
+                root_lines[file_name] = lines[len(old_lines):]
+
+        def fill_group_entry(tmp_entry):
+            files_dir = os.path.join(tmp_entry, "files")
+            os.makedirs(files_dir)
+            for file_name in os.listdir(group_dir):
+                full_path = os.path.join(group_dir, file_name)
+                if os.path.isfile(full_path):
+                    shutil.copy2(full_path, os.path.join(files_dir, file_name))
+            FileHelper.write_to_file(os.path.join(tmp_entry, "root_lines.json"),
+                                     'wb', json.dumps(root_lines))
+
+        self._store_entry("groups", key, fill_group_entry)
+
+    def prune(self, module_set_key):
+        """
+        Function removes cache entries which were not used by the last
+        composition. Up to settings.compose_cache_sets composed module sets
+        are kept.
+        """
+        groups_dir = os.path.join(self.cache_dir, "groups")
+        if os.path.isdir(groups_dir):
+            for key in os.listdir(groups_dir):
+                if key not in self.used_groups:
+                    shutil.rmtree(os.path.join(groups_dir, key),
+                                  ignore_errors=True)
+        sets_dir = os.path.join(self.cache_dir, "sets")
+        if os.path.isdir(sets_dir):
+            entries = [x for x in os.listdir(sets_dir) if x != module_set_key]
+            entries.sort(key=lambda x: os.path.getmtime(os.path.join(sets_dir, x)),
+                         reverse=True)
+            for key in entries[max(settings.compose_cache_sets - 1, 0):]:
+                shutil.rmtree(os.path.join(sets_dir, key), ignore_errors=True)
+
+
 class XCCDFCompose(object):
     """
     Prepare result directory and take care of creating all-xccdf.xml file
     """
 
-    def __init__(self, src_path, dst_path=None):
+    def __init__(self, src_path, dst_path=None, cache_dir=None):
         """
         Create the XCCDFCompose object with specified src and dst path.
 
@@ -43,10 +237,14 @@ class XCCDFCompose(object):
         result directory will be created, in the same place the source directory
         exists, with the "-results" suffix using the original dirname.
 
+        When cache_dir is specified, composed module sets and groups are
+        cached there (see ComposeCache).
+
         src_path and dst_path has to be different, otherwise ValueError
         exception is raised.
         """
         self.src_path = src_path
+        self.cache_dir = cache_dir
         if not dst_path:
             self.dst_path = self.src_path + settings.results_postfix
             if self.src_path.endswith("/"):
@@ -77,11 +275,20 @@ class XCCDFCompose(object):
             sys.stderr.write("{0}\n".format(str(err)))
             return ReturnValues.SCENARIO
 
+        compose_cache = None
+        if self.cache_dir and generate_from_ini:
+            compose_cache = ComposeCache(self.cache_dir)
+            module_set_key = compose_cache.get_module_set_key(self.src_path)
+            if compose_cache.restore_module_set(module_set_key, self.dst_path):
+                logger_debug.debug('Using cached compose of %s' % self.src_path)
+                return 0
+
         # e.g. /root/preupgrade/RHEL6_7 -> /root/preupgrade/RHEL6_7-results
         dir_util.copy_tree(self.src_path, self.dst_path)
         # create content for all-xccdf.xml file as ElementTree object
         target_tree = ComposeXML.run_compose(
-            self.dst_path, generate_from_ini=generate_from_ini)
+            self.dst_path, generate_from_ini=generate_from_ini,
+            compose_cache=compose_cache)
         # path where all-xccdf.xml is going to be generated
         report_filename = os.path.join(self.dst_path,
                                        settings.all_xccdf_xml_filename)
@@ -95,6 +302,9 @@ class XCCDFCompose(object):
             except IOError:
                 raise IOError("Error: Problem with writing file %s"
                               % report_filename)
+        if compose_cache is not None:
+            compose_cache.store_module_set(module_set_key, self.dst_path)
+            compose_cache.prune(module_set_key)
         return 0
 
     def get_compose_dir_name(self):
@@ -104,7 +314,8 @@ class XCCDFCompose(object):
 class ComposeXML(object):
 
     @staticmethod
-    def collect_group_xmls(module_set_dir, source_dir, generate_from_ini=True):
+    def collect_group_xmls(module_set_dir, source_dir, generate_from_ini=True,
+                           compose_cache=None):
         """
         Find group.xml file recursively through all module directories
         and modules. Collect data from each of them into dictionary.
@@ -112,6 +323,7 @@ class ComposeXML(object):
         @param {str} module_set_dir - directory where all modules are stored
         @param {str} source_dir - directory path for processing
         @param {bool} generate_from_ini - True if xccdf-compose tool is used
+        @param {ComposeCache} compose_cache - cache of generated group files
 
         @return {dict} - structure is file based, keys are top level module
         directories, values are tuples which consist of 2 elements:
@@ -168,7 +380,10 @@ class ComposeXML(object):
                         level=logging.WARNING)
             if ini_files and generate_from_ini:
                 oscap_group = OscapGroupXml(module_set_dir, new_dir)
-                oscap_group.write_xml()
+                if compose_cache is None:
+                    oscap_group.write_xml()
+                else:
+                    compose_cache.write_group_xml(oscap_group)
                 return_list = oscap_group.collect_group_xmls()
                 ComposeXML.perform_autoqa(new_dir, return_list)
 
@@ -179,7 +394,7 @@ class ComposeXML(object):
                 ret[dirname] = (ElementTree.parse(group_file_path).getroot(),
                                 ComposeXML.collect_group_xmls(
                                     module_set_dir, new_dir,
-                                    generate_from_ini))
+                                    generate_from_ini, compose_cache))
             except ParseError as e:
                 log_message(
                     "Encountered a parse error in {0} file, details: {1}"
@@ -410,13 +625,14 @@ class ComposeXML(object):
         return target_tree
 
     @staticmethod
-    def run_compose(dir_name, generate_from_ini=True):
+    def run_compose(dir_name, generate_from_ini=True, compose_cache=None):
         target_tree = ComposeXML.get_xml_tree()
         settings.UPGRADE_PATH = dir_name
         if os.path.exists(os.path.join(dir_name, settings.file_list_rules)):
             os.unlink(os.path.join(dir_name, settings.file_list_rules))
         group_xmls = ComposeXML.collect_group_xmls(dir_name, dir_name,
-                                                   generate_from_ini)
+                                                   generate_from_ini,
+                                                   compose_cache)
         logger_debug.debug("Group xmls '%s'", group_xmls)
         if generate_from_ini:
             ComposeXML.perform_autoqa(dir_name, group_xmls)
@@ -84,6 +84,14 @@ class TestAPICheck(base.TestCase):
     def test_config_file_changed(self):
         self.assertTrue(script_api.config_file_changed("/etc/foo/test.conf"))
         self.assertFalse(script_api.config_file_changed("/etc/foobar/test.conf"))
+        # only exact paths are changed
+        self.assertFalse(script_api.config_file_changed("/etc/foo"))
+        self.assertFalse(script_api.config_file_changed("/etc/foo/test"))
+
+    def test_get_config_file_flags(self):
+        self.assertEqual(script_api.get_config_file_flags("/etc/preupgrade-assistant.conf"),
+                         "S.5....T.")
+        self.assertEqual(script_api.get_config_file_flags("/etc/foo/bar"), None)
 
     def test_is_dist_native(self):
         self.assertTrue(script_api.is_dist_native('foobar'))
@@ -0,0 +1,405 @@
+from __future__ import unicode_literals
+import unittest
+import os
+import sys
+import tempfile
+import shutil
+import subprocess
+from hashlib import md5
+
+from preupg.common import Common, RpmVerifier
+from preupg.conf import Conf, DummyConf
+from preupg.utils import FileHelper, ProcessHelper
+from preupg import settings
+
+try:
+    import base
+except ImportError:
+    import tests.base as base
+
+
+class TestCommonDependencies(base.TestCase):
+
+    def test_scripts_txt_dependencies(self):
+        conf = Conf(DummyConf(common_scripts=os.path.join(
+            os.getcwd(), "data", "preassessment", "scripts.txt")), settings)
+        commands = Common(conf).get_common_commands()
+        log_files = [log_file for dummy_cmd, log_file, dummy_name in commands]
+        dependencies = Common.get_dependencies(commands)
+        for index, log_file in enumerate(log_files):
+            deps = [log_files[x] for x in dependencies[index]]
+            if log_file == "rpm_etc_Va.log":
+                self.assertEqual(deps, ["rpm_Va.log"])
+            elif log_file == "rpm_rhsigned.log":
+                self.assertEqual(deps, ["rpm_qa.log"])
+            else:
+                self.assertEqual(deps, [])
+
+
+class TestCommonResults(base.TestCase):
+
+    temp_dir = None
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='preupg')
+        scripts = os.path.join(self.temp_dir, "scripts.txt")
+        lines = ["# comment",
+                 "grep foo first.log=second.log=SECOND=Second=NO",
+                 "sleep 1; echo foo; echo bar=first.log=FIRST=First=NO",
+                 "echo baz=third.log=THIRD=Third=NO"]
+        FileHelper.write_to_file(scripts, "wb", '\n'.join(lines) + '\n')
+        self.conf = Conf(DummyConf(common_scripts=scripts,
+                                   cache_dir=self.temp_dir,
+                                   common_jobs=3), settings)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_dependent_scripts_order(self):
+        self.assertEqual(Common(self.conf).common_results(), 1)
+        common_dir = os.path.join(self.temp_dir, settings.common_name)
+        content = FileHelper.get_file_content(
+            os.path.join(common_dir, "second.log"), "rb")
+        self.assertEqual(content.strip(), "foo")
+        content = FileHelper.get_file_content(
+            os.path.join(common_dir, "third.log"), "rb")
+        self.assertEqual(content.strip(), "baz")
+
+
+class TestCommonCache(base.TestCase):
+
+    temp_dir = None
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='preupg')
+        self.rpm_db_dir = os.path.join(self.temp_dir, "rpm")
+        os.mkdir(self.rpm_db_dir)
+        self._write_rpm_db("first")
+        scripts = os.path.join(self.temp_dir, "scripts.txt")
+        lines = ["echo run >> ../runs.log; echo foo=first.log=FIRST=First=NO",
+                 "grep foo first.log=second.log=SECOND=Second=NO",
+                 "echo run >> ../runs.log=third.log=THIRD=Third=NO"]
+        FileHelper.write_to_file(scripts, "wb", '\n'.join(lines) + '\n')
+        self.conf = Conf(DummyConf(common_scripts=scripts,
+                                   cache_dir=self.temp_dir,
+                                   rpm_db_dir=self.rpm_db_dir,
+                                   common_log_inputs={'first.log': ['rpmdb'],
+                                                      'second.log': []}),
+                         settings)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write_rpm_db(self, content):
+        FileHelper.write_to_file(os.path.join(self.rpm_db_dir, "Packages"),
+                                 "wb", content)
+
+    def _get_runs(self):
+        return len(FileHelper.get_file_content(
+            os.path.join(self.temp_dir, "runs.log"), "rb", True))
+
+    def test_reuse_logs(self):
+        Common(self.conf).common_results()
+        self.assertEqual(self._get_runs(), 2)
+        # RPM database is not changed, just the third log is generated again
+        Common(self.conf).common_results()
+        self.assertEqual(self._get_runs(), 3)
+        self._write_rpm_db("second run")
+        Common(self.conf).common_results()
+        self.assertEqual(self._get_runs(), 5)
+
+    def test_rpm_query(self):
+        Common(self.conf).common_results()
+        # every rpm query rewrites the Berkeley DB environment files
+        FileHelper.write_to_file(os.path.join(self.rpm_db_dir, "__db.001"),
+                                 "wb", "environment")
+        Common(self.conf).common_results()
+        self.assertEqual(self._get_runs(), 3)
+
+    def test_unknown_rpm_db(self):
+        # sqlite backend of the RPM database, state of Packages is not known
+        os.remove(os.path.join(self.rpm_db_dir, "Packages"))
+        FileHelper.write_to_file(os.path.join(self.rpm_db_dir, "rpmdb.sqlite"),
+                                 "wb", "packages")
+        Common(self.conf).common_results()
+        Common(self.conf).common_results()
+        self.assertEqual(self._get_runs(), 4)
+
+    def test_rpm_db_changed_while_running(self):
+        scripts = os.path.join(self.temp_dir, "scripts.txt")
+        FileHelper.write_to_file(scripts, "wb",
+                                 "echo run >> ../runs.log; echo x >> ../rpm/Packages; "
+                                 "echo foo=first.log=FIRST=First=NO\n")
+        Common(self.conf).common_results()
+        # the log may miss the change, it is generated again
+        Common(self.conf).common_results()
+        self.assertEqual(self._get_runs(), 2)
+
+    def test_missing_log(self):
+        Common(self.conf).common_results()
+        os.remove(os.path.join(self.temp_dir, settings.common_name,
+                               "first.log"))
+        Common(self.conf).common_results()
+        self.assertEqual(self._get_runs(), 4)
+
+
+class TestCommonInventory(base.TestCase):
+
+    temp_dir = None
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='preupg')
+        self.root = os.path.join(self.temp_dir, "root").encode(settings.defenc)
+        for dir_name in ["b", "b/x", "b-c", "b.d/e"]:
+            os.makedirs(os.path.join(self.root, dir_name))
+        for file_name, mode in [("a.sh", 0o755), ("b/x/y", 0o644),
+                                ("b/z.sh", 0o700), ("b-c/run", 0o744),
+                                ("b.d/e/f", 0o600)]:
+            full_path = os.path.join(self.root, file_name)
+            FileHelper.write_to_file(full_path, "wb", "data")
+            os.chmod(full_path, mode)
+        os.symlink("a.sh", os.path.join(self.root, "link"))
+        self.conf = Conf(DummyConf(cache_dir=self.temp_dir,
+                                   common_scripts=os.path.join(
+                                       os.getcwd(), "data", "preassessment",
+                                       "scripts.txt")),
+                         settings)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _run_sorted(self, cmd):
+        env = dict(os.environ, LC_ALL="C")
+        sp = subprocess.Popen(cmd + " | sort", shell=True, env=env,
+                              stdout=subprocess.PIPE)
+        return sp.communicate()[0]
+
+    def test_inventory_logs(self):
+        common = Common(self.conf)
+        common.switch_dir()
+        common.switch_back_dir()
+        common.create_inventory(["allmyfiles.log", "executable.log"],
+                                mounts=[self.root])
+        self.assertEqual(
+            FileHelper.get_file_content(
+                common.common_logfiles("allmyfiles.log"), "rb", False, False),
+            self._run_sorted("find %s -xdev -print" % self.root))
+        self.assertEqual(
+            FileHelper.get_file_content(
+                common.common_logfiles("executable.log"), "rb", False, False),
+            self._run_sorted("find %s -xdev -perm /111 -type f -print"
+                             % self.root))
+
+    def test_deep_tree(self):
+        deep = os.path.join(self.root, *(["d"] * 150))
+        os.makedirs(deep)
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(100)
+        try:
+            paths = [path for path, dummy_stat in Common.walk_sorted(self.root)]
+        finally:
+            sys.setrecursionlimit(limit)
+        self.assertTrue(deep in paths)
+        self.assertEqual(paths, sorted(paths))
+
+
+class TestCommonRpmIndex(base.TestCase):
+
+    temp_dir = None
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='preupg')
+        common_dir = os.path.join(self.temp_dir, settings.common_name)
+        os.mkdir(common_dir)
+        rpm_qa = ["bash\tRed Hat, Inc.\tRSA/8, Mon 16 Aug 2010 08:20:38 PM CEST,"
+                  " Key ID 199e2f91fd431d51",
+                  "gpg-pubkey\t(none)\t(none)",
+                  "gpg-pubkey\t(none)\t(none)",
+                  "foo\tFoo\t(none)"]
+        FileHelper.write_to_file(os.path.join(common_dir, settings.rpm_qa_log),
+                                 "wb", '\n'.join(rpm_qa) + '\n')
+        FileHelper.write_to_file(os.path.join(common_dir,
+                                              settings.rpm_signed_log),
+                                 "wb", rpm_qa[0] + '\n')
+        self.conf = Conf(DummyConf(cache_dir=self.temp_dir,
+                                   common_scripts=os.path.join(
+                                       os.getcwd(), "data", "preassessment",
+                                       "scripts.txt")),
+                         settings)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_rpm_index(self):
+        common = Common(self.conf)
+        common.create_rpm_index()
+        index_dir = common.common_logfiles(settings.rpm_index_dir)
+        self.assertEqual(sorted(os.listdir(index_dir)),
+                         ["bash", "foo", "gpg-pubkey"])
+        self.assertEqual(
+            FileHelper.get_file_content(os.path.join(index_dir, "bash"), "rb"),
+            "1\t199e2f91fd431d51\tRed Hat, Inc.\n")
+        self.assertEqual(
+            FileHelper.get_file_content(os.path.join(index_dir, "foo"), "rb"),
+            "0\t\tFoo\n")
+
+    def test_is_pkg_installed(self):
+        common = Common(self.conf)
+        common.create_rpm_index()
+        index_dir = common.common_logfiles(settings.rpm_index_dir)
+        script = ('. ./common.sh >/dev/null 2>&1; VALUE_RPM_INDEX="$1"; '
+                  'is_pkg_installed "$2"')
+
+        def is_installed(name):
+            return subprocess.call(["bash", "-c", script, "bash",
+                                    index_dir, name]) == 0
+        self.assertTrue(is_installed("bash"))
+        self.assertFalse(is_installed("missing"))
+        # the name must not lead out of the index
+        self.assertFalse(is_installed("../" + settings.rpm_qa_log))
+
+
+FAKE_RPM = """#!/bin/bash
+dir=$(dirname "$0")
+if [ "$1" = "-qa" ]; then
+    cat "$dir/query"
+    exit 0
+fi
+shift
+mode=full
+if [ "$1" = "--nofiledigest" ]; then
+    mode=nodigest
+    shift
+fi
+for pkg; do
+    echo "$pkg" >> "$dir/$mode.calls"
+    cat "$dir/$pkg.$mode" 2>/dev/null
+done
+"""
+
+
+class TestRpmVerifier(base.TestCase):
+
+    temp_dir = None
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='preupg')
+        self.rpm = os.path.join(self.temp_dir, "rpm")
+        FileHelper.write_to_file(self.rpm, "wb", FAKE_RPM)
+        os.chmod(self.rpm, 0o755)
+        self.rpm_binary = settings.rpm_binary
+        settings.rpm_binary = self.rpm
+        query = []
+        # a is not modified, b is modified, c is prelinked (rpm knows
+        # the digest of the file before prelink)
+        for package, content, digest in [("a", "a", "a"), ("b", "b", "x"),
+                                         ("c", "prelinked c", "c")]:
+            path = os.path.join(self.temp_dir, package + ".file")
+            FileHelper.write_to_file(path, "wb", content)
+            os.utime(path, (1000000000, 1000000000))
+            query.append("@%s-1-1.noarch\t1" % package)
+            query.append("0\t0\t-1\t33188\t%s\t%s" % (md5(digest.encode()).hexdigest(), path))
+            # ghost files are not verified
+            query.append("0\t64\t-1\t33188\tffff\t/ghost")
+        FileHelper.write_to_file(os.path.join(self.temp_dir, "query"), "wb",
+                                 "\n".join(query) + "\n")
+        for package, mode, output in [("a-1-1.noarch", "nodigest", ""),
+                                      ("b-1-1.noarch", "nodigest", ""),
+                                      ("b-1-1.noarch", "full", "S.5....T.  c %s\n"
+                                       % os.path.join(self.temp_dir, "b.file")),
+                                      ("c-1-1.noarch", "nodigest", ".M.......    /c.other\n"),
+                                      ("c-1-1.noarch", "full", ".M.......    /c.other\n")]:
+            FileHelper.write_to_file(os.path.join(self.temp_dir, package + "." + mode),
+                                     "wb", output)
+        self.verifier = RpmVerifier(os.path.join(self.temp_dir, "cache.json"), 2)
+        self.expected = ("S.5....T.  c %s\n.M.......    /c.other\n"
+                         % os.path.join(self.temp_dir, "b.file"))
+
+    def tearDown(self):
+        settings.rpm_binary = self.rpm_binary
+        shutil.rmtree(self.temp_dir)
+
+    def _get_calls(self, mode):
+        path = os.path.join(self.temp_dir, mode + ".calls")
+        try:
+            calls = FileHelper.get_file_content(path, "rb", True)
+        except IOError:
+            return []
+        os.remove(path)
+        return sorted(x.strip() for x in calls)
+
+    def _verify(self):
+        log_file = os.path.join(self.temp_dir, "rpm_Va.log")
+        self.verifier.verify(log_file)
+        return FileHelper.get_file_content(log_file, "rb")
+
+    def test_verify(self):
+        self.assertEqual(self._verify(), self.expected)
+        self.assertEqual(self._get_calls("full"), ["b-1-1.noarch", "c-1-1.noarch"])
+        self.assertEqual(self._get_calls("nodigest"), ["a-1-1.noarch"])
+
+    def test_incremental_verify(self):
+        self._verify()
+        self._get_calls("full")
+        self._get_calls("nodigest")
+        # content is changed, but size, mtime and inode are the same,
+        # so the cached digest is used
+        path = os.path.join(self.temp_dir, "a.file")
+        with open(path, "r+b") as file_obj:
+            file_obj.write(b"z")
+        os.utime(path, (1000000000, 1000000000))
+        self.assertEqual(self._verify(), self.expected)
+        self.assertEqual(self._get_calls("full"), ["b-1-1.noarch"])
+        self.assertEqual(self._get_calls("nodigest"), ["a-1-1.noarch", "c-1-1.noarch"])
+        self.assertEqual(self.verifier.new_cache[path][4], md5(b"a").hexdigest())
+
+
+class TestRunSubprocess(base.TestCase):
+
+    cmd = "seq 1 5; echo error >&2"
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_output_file(self):
+        output = os.path.join(self.temp_dir, 'output.log')
+        self.assertEqual(ProcessHelper.run_subprocess(self.cmd, output=output, shell=True), 0)
+        self.assertEqual(FileHelper.get_file_content(output, 'rb', decode_flag=False),
+                         b'1\n2\n3\n4\n5\nerror\n')
+
+    def test_output_chunks(self):
+        chunks = []
+        lines = []
+        ret = ProcessHelper.run_subprocess(self.cmd + "; exit 3", output=chunks,
+                                           shell=True, function=lines.append)
+        self.assertEqual(ret, 3)
+        self.assertEqual(chunks, [b'1\n', b'2\n', b'3\n', b'4\n', b'5\n', b'error\n'])
+        self.assertEqual(lines, ['1\n', '2\n', '3\n', '4\n', '5\n', 'error\n'])
+
+    def test_output_file_with_function(self):
+        output = os.path.join(self.temp_dir, 'output.log')
+        lines = []
+        ProcessHelper.run_subprocess(self.cmd, output=output, shell=True,
+                                     function=lines.append)
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(FileHelper.get_file_content(output, 'rb', decode_flag=False),
+                         b'1\n2\n3\n4\n5\nerror\n')
+
+
+def suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(TestCommonDependencies))
+    suite.addTest(loader.loadTestsFromTestCase(TestCommonResults))
+    suite.addTest(loader.loadTestsFromTestCase(TestCommonCache))
+    suite.addTest(loader.loadTestsFromTestCase(TestCommonInventory))
+    suite.addTest(loader.loadTestsFromTestCase(TestCommonRpmIndex))
+    suite.addTest(loader.loadTestsFromTestCase(TestRpmVerifier))
+    suite.addTest(loader.loadTestsFromTestCase(TestRunSubprocess))
+    return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=3).run(suite())
@@ -73,11 +73,67 @@ class TestGlobalContent(base.TestCase):
         dummy_lines = FileHelper.get_file_content(all_xccdf, 'rb')
 
 
+class TestComposeCache(base.TestCase):
+    temp_dir = None
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='preupgrade', dir='/tmp')
+        self.src_dir = os.path.join(self.temp_dir, FOO_DIR)
+        self.cache_dir = os.path.join(self.temp_dir, 'cache')
+        shutil.copytree(os.path.join(os.getcwd(), 'tests', FOO_DIR),
+                        self.src_dir)
+        self.data_dir_orig = settings.data_dir
+        self.upgrade_path_orig = settings.UPGRADE_PATH
+        settings.data_dir = os.path.join(os.getcwd(), "data")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+        settings.data_dir = self.data_dir_orig
+        settings.UPGRADE_PATH = self.upgrade_path_orig
+
+    def _compose(self, dst_name, cache_dir=None):
+        dst_dir = os.path.join(self.temp_dir, dst_name)
+        XCCDFCompose(self.src_dir, dst_dir, cache_dir=cache_dir).generate_xml()
+        return dst_dir
+
+    def _get_files(self, dir_name):
+        files = {}
+        for root, dummy_dirs, file_names in os.walk(dir_name):
+            for file_name in file_names:
+                full_path = os.path.join(root, file_name)
+                files[os.path.relpath(full_path, dir_name)] = \
+                    FileHelper.get_file_content(full_path, 'rb', False, False)
+        return files
+
+    def test_cached_compose(self):
+        expected = self._get_files(self._compose('nocache'))
+        self.assertEqual(self._get_files(self._compose('first', self.cache_dir)),
+                         expected)
+        # the composed module set is taken from the cache as it is
+        self.assertEqual(len(os.listdir(os.path.join(self.cache_dir, 'sets'))), 1)
+        self.assertEqual(self._get_files(self._compose('second', self.cache_dir)),
+                         expected)
+
+    def test_partially_changed_module_set(self):
+        self._compose('first', self.cache_dir)
+        groups = set(os.listdir(os.path.join(self.cache_dir, 'groups')))
+        FileHelper.write_to_file(os.path.join(self.src_dir, 'pass', 'solution.txt'),
+                                 'wb', 'Changed solution text.\n')
+        expected = self._get_files(self._compose('nocache'))
+        self.assertEqual(self._get_files(self._compose('second', self.cache_dir)),
+                         expected)
+        new_groups = set(os.listdir(os.path.join(self.cache_dir, 'groups')))
+        # just the changed group is composed again
+        self.assertEqual(len(new_groups - groups), 1)
+        self.assertEqual(len(groups - new_groups), 1)
+
+
 def suite():
     loader = unittest.TestLoader()
     suite = unittest.TestSuite()
     suite.addTest(loader.loadTestsFromTestCase(TestContentGenerate))
     suite.addTest(loader.loadTestsFromTestCase(TestGlobalContent))
+    suite.addTest(loader.loadTestsFromTestCase(TestComposeCache))
     return suite
 
 if __name__ == '__main__':
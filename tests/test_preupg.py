@@ -1,16 +1,28 @@
 from __future__ import unicode_literals
+import io
+import json
 import unittest
 import tempfile
 import shutil
 import os
+import socket
+import struct
+import subprocess
+import tarfile
 
 from preupg.application import Application
 from preupg.conf import Conf, DummyConf
 from preupg.cli import CLI
 from preupg import settings, xml_manager
 from preupg.utils import (PostupgradeHelper, FileHelper,
-                          OpenSCAPHelper, ModuleSetUtils)
+                          OpenSCAPHelper, ModuleSetUtils, TarballHelper)
 from preupg.report_parser import ReportParser
+from preupg.scanning import ParallelScan, ScanProgress, ScanningHelper
+from preupg.xccdf import XMLNS
+try:
+    from xml.etree import ElementTree
+except ImportError:
+    from elementtree import ElementTree
 
 try:
     import base
@@ -161,6 +173,458 @@ class TestXMLUpdates(base.TestCase):
         self.assertEquals(found_current, 1)
 
 
+class TestRuleIndex(base.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.report = os.path.join(self.temp_dir, "result.xml")
+        shutil.copyfile("tests/generated_results/inplace_combined_risk_test.xml",
+                        self.report)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_rule_index(self):
+        rp = ReportParser(self.report)
+        idrefs = [x.get('idref') for x in rp.get_select_rules()]
+        rule = rp.get_rule(idrefs[0])
+        self.assertEqual(rule.get('id'), idrefs[0])
+        self.assertEqual(rp.get_rule('xccdf_unknown_rule'), None)
+        self.assertEqual(rp.check_rules([idrefs[0], idrefs[1][:-2],
+                                         'xccdf_unknown_rule']),
+                         ['xccdf_unknown_rule'])
+        rp.select_rules([idrefs[0]])
+        self.assertEqual(rp.get_name_of_checks().keys(), [idrefs[0]])
+        # indexes are dropped with the tree
+        rp.reload_xml(self.report)
+        self.assertFalse(rule is rp.get_rule(idrefs[0]))
+
+
+def create_risk_report(temp_dir):
+    """Create result with two failed rules with slight and high risk"""
+    report = os.path.join(temp_dir, "result.xml")
+    content = FileHelper.get_file_content(
+        "tests/generated_results/inplace_combined_risk_test.xml", 'rb',
+        decode_flag=False)
+    for index, risk in ((b'1', b'SLIGHT'), (b'2', b'HIGH')):
+        content = content.replace(b'RESULT_VALUE' + index, b'fail')
+        content = content.replace(b'INPLACE_TAG' + index,
+                                  b'preupg.risk.%s: Test risk' % risk)
+    FileHelper.write_to_file(report, 'wb', content, False)
+    return report
+
+
+class TestScanProgress(base.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.report = create_risk_report(self.temp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_update_results(self):
+        rules = ['xccdf_preupg_rule_dummy_preupg_dummy1',
+                 'xccdf_preupg_rule_dummy_preupg_dummy2',
+                 'xccdf_preupg_rule_dummy_preupg_diff']
+        progress = ScanProgress(len(rules), False)
+        # titles may contain colons
+        progress.set_names(dict((x, 'Title: %s' % x) for x in rules))
+        for rule in rules:
+            progress.add_result(rule, 'fail')
+        ReportParser(self.report).replace_inplace_risk(scanning_results=progress)
+        results = [(x.rule_id, x.title, x.result)
+                   for x in progress.get_output_data()]
+        self.assertEqual(results,
+                         [(rules[0], 'Title: ' + rules[0], 'needs_inspection'),
+                          (rules[1], 'Title: ' + rules[1], 'needs_action'),
+                          (rules[2], 'Title: ' + rules[2], 'fail')])
+        ordered = sorted(progress.get_output_data(),
+                         key=ScanningHelper.compare_data, reverse=True)
+        self.assertEqual([x.rule_id for x in ordered],
+                         [rules[0], rules[1], rules[2]])
+        ScanningHelper.format_rules_to_table(progress.get_output_data(), "main contents")
+
+
+class TestDeferredWrite(base.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.report = create_risk_report(self.temp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_deferred_write(self):
+        rp = ReportParser(self.report)
+        tree = rp.target_tree
+        original = FileHelper.get_file_content(self.report, 'rb', decode_flag=False)
+        with rp.deferred_write():
+            rp.strip_whitespaces()
+            rp.replace_inplace_risk()
+            rp.remove_debug_info()
+            rp.update_check_description()
+            self.assertEqual(FileHelper.get_file_content(self.report, 'rb', decode_flag=False),
+                             original)
+        # the tree is not parsed again
+        self.assertTrue(rp.target_tree is tree)
+        results = [x.text for x in rp.get_all_results()]
+        self.assertEqual(results[:2], ['needs_inspection', 'needs_action'])
+        rp.reload_xml(self.report)
+        self.assertEqual([x.text for x in rp.get_all_results()], results)
+
+    def test_failed_block(self):
+        rp = ReportParser(self.report)
+        original = FileHelper.get_file_content(self.report, 'rb', decode_flag=False)
+        try:
+            with rp.deferred_write():
+                rp.replace_inplace_risk()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(FileHelper.get_file_content(self.report, 'rb', decode_flag=False),
+                         original)
+        rp.write_xml()
+        self.assertNotEqual(FileHelper.get_file_content(self.report, 'rb', decode_flag=False),
+                            original)
+
+
+class FakeTerminal(io.StringIO):
+
+    def isatty(self):
+        return True
+
+
+class TestProgressOutput(base.TestCase):
+
+    names = {'xccdf_rule_a': 'Module A', 'xccdf_rule_b': 'Module B',
+             'xccdf_rule_c': 'Module C'}
+
+    def test_machine_readable(self):
+        stream = io.StringIO()
+        progress = ScanProgress(3, False, stream=stream)
+        progress.set_names(self.names)
+        progress.start()
+        progress.show_progress('xccdf_rule_b:pass\n')
+        events = [json.loads(x) for x in stream.getvalue().splitlines()]
+        self.assertEqual(events[0], {'event': 'start', 'current': 0, 'total': 3})
+        self.assertEqual(events[1]['rule'], 'xccdf_rule_b')
+        self.assertEqual(events[1]['title'], 'Module B')
+        self.assertEqual(events[1]['result'], 'pass')
+        self.assertEqual(events[1]['current'], 1)
+
+    def test_throttled_redraw(self):
+        stream = FakeTerminal()
+        progress = ScanProgress(3, False, stream=stream)
+        progress.set_names(self.names)
+        old_frame_rate = settings.progress_frame_rate
+        settings.progress_frame_rate = 0.01
+        try:
+            progress.start()
+            progress.show_progress('xccdf_rule_a:pass\n')
+            progress.show_progress('xccdf_rule_b:fail\n')
+        finally:
+            settings.progress_frame_rate = old_frame_rate
+            if progress.timer is not None:
+                progress.timer.cancel()
+        output = stream.getvalue()
+        # just the first running line is drawn within the frame
+        self.assertEqual(output.count('...running'), 1)
+        self.assertEqual(output.count('...done'), 2)
+        self.assertTrue(progress.timer is not None)
+
+
+class TestParallelScan(base.TestCase):
+    temp_dir = None
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _get_parallel_scan(self, jobs):
+        content = os.path.join(self.temp_dir, settings.all_xccdf_xml_filename)
+        shutil.copyfile("tests/generated_results/inplace_risk_test.xml",
+                        content)
+        helper = OpenSCAPHelper(self.temp_dir, "result", "result.xml",
+                                "result.html", content)
+        return ParallelScan(helper, ReportParser(content), jobs)
+
+    def test_split_rules(self):
+        scan = self._get_parallel_scan(2)
+        selected = [x.get('idref') for x in
+                    scan.report_parser.get_allowed_selected_rules()]
+        # both modules belong to group dummy
+        self.assertEqual(scan.split_rules(), [selected])
+        scan.get_rule_groups = lambda: {}
+        units = scan.split_rules()
+        self.assertEqual(len(units),
+                         min(len(selected), 2 * settings.scan_units_per_job))
+        self.assertEqual(sorted(sum(units, [])), sorted(selected))
+
+    def test_write_unit_content(self):
+        scan = self._get_parallel_scan(2)
+        unit = scan.split_rules()[0]
+        unit_path = scan.write_unit_content(0, unit)
+        self.assertEqual(os.path.dirname(unit_path), self.temp_dir)
+        rp = ReportParser(unit_path)
+        self.assertEqual(sorted(x.get('idref') for x in
+                                rp.get_allowed_selected_rules()),
+                         sorted(unit))
+        # selection in the original content is not changed
+        self.assertEqual(scan.report_parser.get_number_checks(),
+                         len(sum(scan.split_rules(), [])))
+
+    def test_running_modules(self):
+        scan = self._get_parallel_scan(2)
+        progress = ScanProgress(4, False, stream=io.StringIO())
+        progress.set_names({'a': 'Module A', 'b': 'Module B',
+                            'c': 'Module C', 'd': 'Module D'})
+        scan.function = progress.show_progress
+        scan.running = progress.set_running
+        scan.units = [['a', 'b'], ['c', 'd']]
+        scan._set_pending(0, scan.units[0])
+        scan._set_pending(1, scan.units[1])
+        self.assertEqual(progress.running, ['a', 'c'])
+        self.assertEqual(progress.get_running_name(), '2 modules: Module A, Module C')
+        scan._show_progress(1, 'c:pass\n')
+        self.assertEqual(progress.running, ['a', 'd'])
+        scan._set_pending(0, None)
+        self.assertEqual(progress.get_running_name(), 'Module D')
+
+    def _write_unit_result(self, name, results, start_time):
+        tree = ElementTree.parse(
+            "tests/generated_results/inplace_risk_test.xml").getroot()
+        test_result = tree.find(XMLNS + "TestResult")
+        test_result.set('start-time', start_time)
+        for rule_result in test_result.findall(XMLNS + "rule-result"):
+            rule_result.find(XMLNS + "result").text = \
+                results[rule_result.get('idref')]
+        path = os.path.join(self.temp_dir, name)
+        ElementTree.ElementTree(tree).write(path)
+        return path
+
+    def test_merge_results(self):
+        dummy = "xccdf_preupg_rule_dummy_preupg_dummy"
+        diff = "xccdf_preupg_rule_dummy_preupg_diff"
+        first = self._write_unit_result(
+            "first.xml", {dummy: "pass", diff: "notselected"},
+            "2016-08-24T17:39:07")
+        second = self._write_unit_result(
+            "second.xml", {dummy: "notselected", diff: "fail"},
+            "2016-08-24T17:38:00")
+        output = os.path.join(self.temp_dir, "result.xml")
+        ParallelScan.merge_results([first, second],
+                                   {dummy: "true", diff: "true"}, output)
+        test_result = ElementTree.parse(output).getroot().find(
+            XMLNS + "TestResult")
+        results = dict((x.get('idref'), x.findtext(XMLNS + "result"))
+                       for x in test_result.findall(XMLNS + "rule-result"))
+        self.assertEqual(results, {dummy: "pass", diff: "fail"})
+        self.assertEqual(test_result.get('start-time'), "2016-08-24T17:38:00")
+        scores = dict((x.get('system'), (x.text, x.get('maximum')))
+                      for x in test_result.findall(XMLNS + "score"))
+        self.assertEqual(scores, {
+            "urn:xccdf:scoring:default": ("50.000000", "100.000000"),
+            "urn:xccdf:scoring:flat": ("1.000000", "2.000000")})
+
+
+class FakeSubmission(object):
+    """ in-memory counterpart of submit.* XML-RPC methods of the UI """
+
+    def __init__(self, fail_at=None, down=0, fail_commit=False):
+        self.data = b''
+        self.info = None
+        self.fail_at = fail_at
+        # count of calls failing after the chunk at fail_at
+        self.down = down
+        self.fail_commit = fail_commit
+
+    def _network(self):
+        if self.down:
+            self.down -= 1
+            raise socket.error("Network is unreachable")
+
+    def begin(self, opts):
+        if 'upload_id' not in opts:
+            # XML-RPC integers have 32 bits
+            assert isinstance(opts['size'], str)
+            self.info = dict(opts, size=int(opts['size']))
+        else:
+            self._network()
+        return {'status': 'OK', 'upload_id': 'x', 'offset': str(len(self.data))}
+
+    def chunk(self, upload_id, offset, data, checksum):
+        if int(offset) == self.fail_at:
+            self.fail_at = None
+            # the chunk is stored, but the response is lost
+            self.data += data.data
+            raise socket.error("Connection reset by peer")
+        self._network()
+        if int(offset) != len(self.data):
+            return {'status': 'ERROR', 'offset': str(len(self.data))}
+        self.data += data.data
+        return {'status': 'OK', 'offset': str(len(self.data))}
+
+    def commit(self, upload_id):
+        if self.fail_commit:
+            self.fail_commit = False
+            raise socket.error("Connection timed out")
+        return {'status': 'OK', 'size': len(self.data), 'info': self.info}
+
+
+class FakeProxy(object):
+    def __init__(self, submit):
+        self.submit = submit
+
+
+class TestChunkedUpload(base.TestCase):
+
+    temp_dir = None
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='preupg')
+        self.tarball = os.path.join(self.temp_dir, "results.tar.gz")
+        FileHelper.write_to_file(self.tarball, "wb", os.urandom(1000), False)
+        self.saved = (settings.upload_chunk_size, settings.upload_retry_delay)
+        settings.upload_chunk_size = 300
+        settings.upload_retry_delay = 0
+
+    def tearDown(self):
+        settings.upload_chunk_size, settings.upload_retry_delay = self.saved
+        shutil.rmtree(self.temp_dir)
+
+    def _upload(self, submit):
+        response = Application.upload_in_chunks(FakeProxy(submit),
+                                                self.tarball, "host")
+        self.assertEqual(submit.data, FileHelper.get_file_content(
+            self.tarball, "rb", False, False))
+        self.assertEqual(response['info']['size'], 1000)
+        self.assertEqual(response['info']['host'], "host")
+
+    def test_upload(self):
+        self._upload(FakeSubmission())
+
+    def test_resume_upload(self):
+        self._upload(FakeSubmission(fail_at=300))
+
+    def test_network_down(self):
+        # resume itself fails while the network is down
+        self._upload(FakeSubmission(fail_at=300, down=2, fail_commit=True))
+        self.assertRaises(socket.error, Application.upload_in_chunks,
+                          FakeProxy(FakeSubmission(fail_at=300, down=10)),
+                          self.tarball, "host")
+
+
+class TestTarball(base.TestCase):
+
+    temp_dir = None
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='preupg')
+        self.saved = (settings.assessment_results_dir,
+                      settings.tarball_result_dir)
+        settings.assessment_results_dir = os.path.join(self.temp_dir, "preupgrade")
+        settings.tarball_result_dir = os.path.join(self.temp_dir, "results")
+        os.mkdir(settings.tarball_result_dir)
+        for dir_name in settings.preupgrade_dirs:
+            os.makedirs(os.path.join(settings.assessment_results_dir, dir_name))
+        for file_name in [settings.PREUPG_README, "result.xml", "result.html",
+                          os.path.join("dirtyconf", "etc.conf"), "other.log"]:
+            FileHelper.write_to_file(os.path.join(
+                settings.assessment_results_dir, file_name), "wb", file_name)
+
+    def tearDown(self):
+        settings.assessment_results_dir, settings.tarball_result_dir = self.saved
+        shutil.rmtree(self.temp_dir)
+
+    def _check_tarball(self, tarball):
+        tar = tarfile.open(tarball)
+        try:
+            tarball_dir = os.path.basename(tarball).split('.')[0]
+            names = tar.getnames()
+            self.assertEqual(names[0], tarball_dir)
+            self.assertTrue(os.path.join(tarball_dir, "dirtyconf", "etc.conf") in names)
+            self.assertTrue(os.path.join(tarball_dir, "result.html") in names)
+            self.assertFalse(os.path.join(tarball_dir, "other.log") in names)
+            for member in tar.getmembers():
+                self.assertEqual((member.uname, member.gname), ("", ""))
+            self.assertEqual(tar.extractfile(os.path.join(
+                tarball_dir, "result.xml")).read(), b"result.xml")
+        finally:
+            tar.close()
+
+    def test_gzip(self):
+        tarball = TarballHelper.tarball_result_dir(settings.tarball_name, False)
+        self.assertEqual(os.path.dirname(tarball), settings.tarball_result_dir)
+        self.assertTrue(tarball.endswith(".tar.gz"))
+        self.assertEqual(os.listdir(settings.tarball_result_dir),
+                         [os.path.basename(tarball)])
+        self._check_tarball(tarball)
+
+    def test_xz(self):
+        tarball = TarballHelper.tarball_result_dir(settings.tarball_name, False,
+                                                   compression='xz', parallel=True)
+        if tarball.endswith(".tar.xz"):
+            tar_xz = subprocess.Popen(["xz", "-dc", tarball], stdout=subprocess.PIPE)
+            tarball = tarball[:-len(".xz")]
+            FileHelper.write_to_file(tarball, "wb", tar_xz.communicate()[0], False)
+        self._check_tarball(tarball)
+
+    def test_add_to_tarball(self):
+        class OldTarFile(tarfile.TarFile):
+            # TarFile.add of Python 2.6, there is no filter argument
+            def add(self, name, arcname=None, recursive=True, exclude=None):
+                raise AssertionError("TarFile.add is not used")
+
+        tarball = os.path.join(self.temp_dir, "test.tar")
+        os.symlink("etc.conf", os.path.join(settings.assessment_results_dir,
+                                            "dirtyconf", "link"))
+        names = []
+
+        def tarinfo_filter(tarinfo):
+            tarinfo.uname = ""
+            names.append(tarinfo.name)
+            return tarinfo if tarinfo.name != "x/kickstart" else None
+        tar = OldTarFile.open(tarball, "w")
+        try:
+            TarballHelper.add_to_tarball(tar, settings.assessment_results_dir,
+                                         "x", tarinfo_filter)
+        finally:
+            tar.close()
+        tar = tarfile.open(tarball)
+        try:
+            self.assertEqual(tar.getnames(), [x for x in names if x != "x/kickstart"])
+            self.assertEqual(tar.getnames(), sorted(tar.getnames()))
+            self.assertFalse([x for x in tar.getnames() if x.startswith("x/kickstart")])
+            self.assertTrue(tar.getmember("x/dirtyconf/link").issym())
+            self.assertEqual(tar.extractfile("x/dirtyconf/etc.conf").read(),
+                             b"dirtyconf/etc.conf")
+        finally:
+            tar.close()
+
+    def test_get_xattr(self):
+        # byte string path with non-ASCII characters
+        file_path = os.path.join(self.temp_dir.encode(settings.defenc),
+                                 b"\xc5\xbelu\xc5\xa5ou\xc4\x8dk\xc3\xbd")
+        FileHelper.write_to_file(file_path, "wb", b"data", False)
+        try:
+            self.assertEqual(TarballHelper.get_xattr(file_path, "user.missing"), None)
+        finally:
+            # rmtree of the unicode temp_dir can't join the name
+            os.unlink(file_path)
+
+    def test_acl_to_text(self):
+        acl = struct.pack(str('<I'), 2) + b''.join(
+            struct.pack(str('<HHI'), tag, perm, entry_id)
+            for tag, perm, entry_id in [(0x01, 6, 0xffffffff), (0x02, 4, 1000),
+                                        (0x04, 4, 0xffffffff), (0x10, 5, 0xffffffff),
+                                        (0x20, 0, 0xffffffff)])
+        self.assertEqual(TarballHelper.acl_to_text(acl),
+                         "user::rw-,user:1000:r--,group::r--,mask::r-x,other::---")
+
+
 class TestCLI(base.TestCase):
     def test_opts(self):
         """ basic test of several options """
@@ -260,6 +724,29 @@ class TestSolutionReplacement(base.TestCase):
         line = xml_manager.tag_formating(solution_text)
         self.assertEqual(expected_text, line)
 
+    def test_update_report(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            module_set = os.path.join(temp_dir, 'FOOBAR6_7')
+            solutions = {'bar': 'Solution of bar <x>',
+                         os.path.join('foo', 'bar'): 'Solution of foo/bar\n'}
+            for module, text in solutions.items():
+                module_dir = os.path.join(module_set, module)
+                os.makedirs(module_dir)
+                FileHelper.write_to_file(os.path.join(module_dir, settings.check_script), 'wb', '')
+                FileHelper.write_to_file(os.path.join(module_dir, settings.solution_txt),
+                                         'wb', text)
+            report = os.path.join(temp_dir, 'result.html')
+            FileHelper.write_to_file(report, 'wb', 'A _foo_bar_SOLUTION_MSG B\n'
+                                                   '_bar_SOLUTION_MSG\u017e\n')
+            manager = xml_manager.XmlManager(temp_dir, module_set)
+            manager.update_report('result.html')
+            self.assertEqual(FileHelper.get_file_content(report, 'rb'),
+                             'A Solution of foo/bar<br/>\n B\n'
+                             'Solution of bar &lt;x&gt;\u017e\n')
+        finally:
+            shutil.rmtree(temp_dir)
+
 
 class TestModuleSet(base.TestCase):
     '''
@@ -360,9 +847,16 @@ def suite():
     suite.addTest(loader.loadTestsFromTestCase(TestPreupgMigrate))
     suite.addTest(loader.loadTestsFromTestCase(TestPreupgUpgrade))
     suite.addTest(loader.loadTestsFromTestCase(TestCLI))
+    suite.addTest(loader.loadTestsFromTestCase(TestScanProgress))
+    suite.addTest(loader.loadTestsFromTestCase(TestDeferredWrite))
+    suite.addTest(loader.loadTestsFromTestCase(TestProgressOutput))
+    suite.addTest(loader.loadTestsFromTestCase(TestParallelScan))
+    suite.addTest(loader.loadTestsFromTestCase(TestChunkedUpload))
+    suite.addTest(loader.loadTestsFromTestCase(TestTarball))
     suite.addTest(loader.loadTestsFromTestCase(TestHashes))
     suite.addTest(loader.loadTestsFromTestCase(TestSolutionReplacement))
     suite.addTest(loader.loadTestsFromTestCase(TestXMLUpdates))
+    suite.addTest(loader.loadTestsFromTestCase(TestRuleIndex))
     suite.addTest(loader.loadTestsFromTestCase(TestModuleSet))
     suite.addTest(loader.loadTestsFromTestCase(TestModuleSetConfigParse))
     suite.addTest(loader.loadTestsFromTestCase(TestModuleSetConfigContent))